@@ -0,0 +1,253 @@
+"""
+Concurrent sensor acquisition for the thermostat.
+
+All of the configured analog pins are read at the same time using the
+asyncio side of pymata-aio (PyMata3.core) instead of one blocking
+analog_read after another.  Every sample is timestamped and the whole set
+is handed to the Thermostat at once so it always sees a consistent snapshot.
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+import asyncio
+import time
+from collections import namedtuple
+
+LOGGER = logging.getLogger("__main__.acquisition.py")
+
+# Bytes in one Firmata analog report
+ANALOG_REPORT_BYTES = 3
+# Milliseconds between analog reports when nothing sets it
+FIRMATA_SAMPLING_INTERVAL = 19
+
+# One reading from one sensor.  latency is the seconds analog_read took.
+Sample = namedtuple("Sample", ["location", "pin", "raw", "timestamp", "latency"], defaults=[None])
+
+class AcquisitionEngine:
+	"""
+	Reads every sensor in a Thermostat concurrently and updates the Thermostat
+	with the results.
+	"""
+	def __init__(self, thermostat, core, clock=time.time, locations=None):
+		"""
+		thermostat => The Thermostat that owns the sensors
+
+		core => The asyncio board interface.  For a real board this is PyMata3().core,
+			for testing use fakeboard.FakeBoard().core
+
+		<optional> clock => Function returning the current time in seconds
+
+		<optional> locations => Only read these sensors, for when they are on
+			more than one board.  All of them if not given.
+		"""
+		self.LOGGER = logging.getLogger("__main__.acquisition.AcquisitionEngine")
+
+		self.thermostat = thermostat
+		self.core = core
+		self.clock = clock
+		self.locations = [location.upper() for location in locations] if locations else None
+
+		self.listeners = []
+		self.cycles = 0
+		self.lastCycleTime = None
+		self.lastSnapshot = {}
+
+	def addListener(self, callback):
+		"""
+		callback => Called with the snapshot every time a new one is ready
+		"""
+		self.listeners.append(callback)
+
+	async def readSensor(self, location, sensor):
+		"""
+		Read a single sensor and stamp it with the time the value came back
+		"""
+		start = time.perf_counter()
+		raw = await self.core.analog_read(sensor.controlPin)
+		return Sample(location, sensor.controlPin, raw, self.clock(), time.perf_counter() - start)
+
+	async def readSensors(self):
+		"""
+		Read all of the sensors at once.
+
+		Returns a dict of {location: Sample}
+		"""
+		start = time.perf_counter()
+		sensors = self.thermostat.tempSensors
+		locations = self.locations or list(sensors)
+		samples = await asyncio.gather(*[self.readSensor(location, sensors[location]) for location in locations])
+		snapshot = {sample.location: sample for sample in samples}
+		self.lastCycleTime = time.perf_counter() - start
+		self.cycles += 1
+		self.LOGGER.debug("Read %s sensors in %.4fs", len(snapshot), self.lastCycleTime)
+		return snapshot
+
+	async def cycle(self):
+		"""
+		Read all of the sensors and hand the snapshot to the Thermostat
+		"""
+		snapshot = await self.readSensors()
+		self.publish(snapshot)
+		return snapshot
+
+	def publish(self, snapshot):
+		"""
+		Hand a snapshot to the Thermostat and the listeners
+		"""
+		self.thermostat.updateReadings(snapshot)
+		self.lastSnapshot = snapshot
+		for callback in self.listeners:
+			callback(snapshot)
+
+	async def run(self, interval):
+		"""
+		Keep reading the sensors every interval seconds until cancelled
+		"""
+		while True:
+			started = self.clock()
+			try:
+				await self.cycle()
+			except Exception as e:
+				self.LOGGER.error("Could not read the sensors.  {}".format(e))
+			await asyncio.sleep(max(0, interval - (self.clock() - started)))
+
+class ReportingEngine(AcquisitionEngine):
+	"""
+	Gets the sensor values from the analog reports Firmata sends on its own,
+	instead of reading them on a timer.
+
+	Firmata sends every analog pin every samplingInterval milliseconds.  A
+	report that is within delta of the last value handed on is dropped right
+	in the callback, so the Thermostat only does work when a temp moves.  An
+	unchanged value is still handed on every heartbeat seconds so it doesn't
+	go stale.
+	"""
+	def __init__(self, thermostat, core, clock=time.time, locations=None, samplingInterval=1000, delta=1, heartbeat=60, batchDelay=0.05, pollInterval=15):
+		"""
+		<optional> samplingInterval => Milliseconds between reports from the board
+
+		<optional> delta => Raw values that change by this much or less are dropped
+
+		<optional> heartbeat => Seconds before an unchanged value is handed on anyway
+
+		<optional> batchDelay => Seconds to wait for the rest of the pins after a
+			report, so they are handed on in one snapshot
+
+		<optional> pollInterval => The read interval polling would use, to work
+			out what was saved
+		"""
+		self.started = None
+		super().__init__(thermostat, core, clock, locations)
+		self.LOGGER = logging.getLogger("__main__.acquisition.ReportingEngine")
+
+		self.samplingInterval = samplingInterval
+		self.delta = delta
+		self.heartbeat = heartbeat
+		self.batchDelay = batchDelay
+		self.pollInterval = pollInterval
+
+		sensors = thermostat.tempSensors
+		# {pin: location}
+		self.pins = {sensors[location].controlPin: location for location in self.locations or sensors}
+		# {pin: (raw, time)} of the last value handed on
+		self.forwarded = {}
+		# {location: Sample} waiting for the rest of the pins
+		self.pending = {}
+
+		self.reports = 0
+		self.passed = 0
+		self.dropped = 0
+		self.lastReport = None
+		self._flush = None
+
+	async def attach(self, boards, name):
+		"""
+		Ask the board for analog reports.  Called by BoardManager.run.
+
+		boards => The BoardManager, so the callbacks are set again after a reconnect
+
+		name => The board the sensors are on
+		"""
+		from pymata_aio.constants import Constants
+		for pin in self.pins:
+			await boards.setPinMode(name, pin, Constants.ANALOG, self.analogChanged)
+		await boards.setSamplingInterval(name, self.samplingInterval)
+		self.started = self.clock()
+
+	@property
+	def core(self):
+		return self._core
+
+	@core.setter
+	def core(self, core):
+		# Connected again, give it time to start reporting
+		self._core = core
+		self.lastReport = None
+		if self.started is not None:
+			self.started = self.clock()
+
+	def analogChanged(self, data):
+		"""
+		The callback for the analog pins.  pymata calls it as callback([pin, value, ...])
+		"""
+		location = self.pins.get(data[0])
+		if location is None:
+			return
+		pin, raw = data[0], data[1]
+		now = self.clock()
+		self.reports += 1
+		self.lastReport = now
+		last = self.forwarded.get(pin)
+		if last is not None and abs(raw - last[0]) <= self.delta and now - last[1] < self.heartbeat:
+			self.dropped += 1
+			return
+		self.passed += 1
+		self.forwarded[pin] = (raw, now)
+		self.pending[location] = Sample(location, pin, raw, now)
+		if self._flush is None:
+			self._flush = asyncio.get_event_loop().call_later(self.batchDelay, self.flush)
+
+	def flush(self):
+		"""
+		Hand on the values waiting for the rest of the pins
+		"""
+		self._flush = None
+		snapshot, self.pending = self.pending, {}
+		if snapshot:
+			self.cycles += 1
+			self.LOGGER.debug("%s sensors changed", len(snapshot))
+			self.publish(snapshot)
+
+	async def cycle(self):
+		"""
+		Nothing is read, the reports come in by themselves.  Raises TimeoutError
+		if the board stopped sending them so BoardManager reconnects it.
+		"""
+		now = self.clock()
+		silence = now - (self.lastReport or self.started or now)
+		if silence > max(self.heartbeat, 10 * self.samplingInterval / 1000):
+			raise asyncio.TimeoutError("No analog reports for {:.0f}s".format(silence))
+		return self.lastSnapshot
+
+	def metrics(self):
+		"""
+		Returns a dict with the reports, and the serial bytes and Thermostat
+		updates saved compared with reading every pin every pollInterval
+		seconds at Firmata's default sampling interval
+		"""
+		elapsed = self.clock() - self.started if self.started is not None else 0
+		serialBytes = self.reports * ANALOG_REPORT_BYTES
+		defaultBytes = int(len(self.pins) * ANALOG_REPORT_BYTES * elapsed * 1000 / FIRMATA_SAMPLING_INTERVAL)
+		polledUpdates = len(self.pins) * int(elapsed / self.pollInterval)
+		return {
+			"reports": self.reports,
+			"passed": self.passed,
+			"dropped": self.dropped,
+			"serialBytes": serialBytes,
+			"serialBytesSaved": max(0, defaultBytes - serialBytes),
+			"updates": self.passed,
+			"updatesSaved": max(0, polledUpdates - self.passed),
+			}
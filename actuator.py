@@ -0,0 +1,394 @@
+"""
+Turn the HVAC on and off through a queue instead of pulsing the relays
+straight from the control loop.
+
+Asking for a change returns right away.  A worker task pulses the latching
+relays in the background, so the control loop never waits on a pulse:
+
+	* Asking for what is already on its way, or already set, does nothing.
+	  Only the newest request is kept.
+	* The furnace and A/C are kept on for at least minOnTime and off for at
+	  least minOffTime seconds so they don't short cycle.  A request made too
+	  soon waits, and is dropped if something else is asked for first.
+	* After a pulse the HEAT_SENSE / COOL_SENSE pin has to show the relay
+	  changed before HVAC.state is changed.  If it doesn't the pulse is tried
+	  again, then given up on.
+	* At start up, and every time the board connects again, the sense pins
+	  are read to find out what the relays are doing.  If the board isn't
+	  there yet, that waits until it is.
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+import asyncio
+import time
+
+LOGGER = logging.getLogger("__main__.actuator.py")
+
+class RelayQueue:
+	"""
+	Queued, verified control of the latching relays on an HVAC.  It can be
+	used anywhere an actuate(heatCool, onOff) coroutine function is needed,
+	and as the hvac of a Zone.
+	"""
+	def __init__(self, hvac, core, minOnTime=180, minOffTime=180, pulseTime=0.1, confirmTimeout=2.0, retries=2, clock=time.time, retryDelay=5.0):
+		"""
+		hvac => The HVAC with the control pins.  Its state is only changed
+			once the sense pin agrees.
+
+		core => The asyncio board interface, or a function that returns it
+			(for a board that can reconnect)
+
+		<optional> minOnTime, minOffTime => The shortest time in seconds the
+			furnace or A/C runs, or stays off, before it can change again
+
+		<optional> pulseTime => Seconds the relay pin is held high
+
+		<optional> confirmTimeout => Seconds to wait for the sense pin after a pulse
+
+		<optional> retries => Pulses to try again when the sense pin doesn't change
+
+		<optional> clock => Function returning the current time in seconds
+
+		<optional> retryDelay => Seconds to wait after a pulse fails with an error
+		"""
+		self.LOGGER = logging.getLogger("__main__.actuator.RelayQueue")
+
+		self.hvac = hvac
+		self.getCore = core if callable(core) else lambda: core
+		self.minOnTime = minOnTime
+		self.minOffTime = minOffTime
+		self.pulseTime = pulseTime
+		self.confirmTimeout = confirmTimeout
+		self.retries = retries
+		self.clock = clock
+		self.retryDelay = retryDelay
+
+		# The state asked for, "OFF", "HEAT" or "COOL"
+		self.desired = hvac.state
+		self.lastChange = None
+		# (heatCool, onOff) pulses to send no matter what the state is
+		self.forced = []
+		# {pin: value} from the sense pin callbacks
+		self.senseValues = {}
+		# False until the relays have been read with sync(), once start() asks for it
+		self.synced = True
+		# What sync() is given, {"state": ..., "lastChange": ...}
+		self.saved = None
+
+		self.requests = 0
+		self.merged = 0
+		self.pulses = 0
+		self.failures = 0
+
+		self._changed = None
+		self._sensed = None
+
+	async def __call__(self, heatCool, onOff):
+		self.request(heatCool, onOff)
+
+	def request(self, heatCool, onOff, force=False):
+		"""
+		Ask for the heat or A/C to turn on or off.  Returns right away.
+
+		heatCool => Either the heater or A/C
+			Valid entrys -- "heat"  "cool"
+
+		onOff => Turn the HVAC on or off
+			Valid entrys -- "on"  "off"
+
+		<optional> force => Pulse the relay even if the state already matches,
+			like at start up when the relays could be in any state
+		"""
+		heatCool = heatCool.upper()
+		onOff = onOff.upper()
+		if heatCool not in ("HEAT", "COOL"):
+			raise AttributeError("Only 'heat' and 'cool' are valid attributes")
+		if onOff not in ("ON", "OFF"):
+			raise AttributeError("Only 'on' or 'off' are valid attributes")
+		self.requests += 1
+
+		if onOff == "ON":
+			desired = heatCool
+		elif self.desired == heatCool:
+			desired = "OFF"
+		else:
+			# Turning off something that isn't on
+			desired = self.desired
+
+		if force:
+			self.forced.append((heatCool, onOff))
+		elif desired == self.desired:
+			self.merged += 1
+			return
+		self.LOGGER.debug("HVAC asked to go to %s", desired)
+		self.desired = desired
+		if self._changed:
+			self._changed.set()
+
+	@property
+	def state(self):
+		"""
+		The state the HVAC is going to.  This lets the queue stand in for the
+		HVAC in a Zone, so a request that is still waiting can be taken back.
+		"""
+		return self.desired
+
+	@property
+	def pending(self):
+		return not self.synced or bool(self.forced) or self.desired != self.hvac.state
+
+	def senseChanged(self, data):
+		"""
+		The callback for the sense pins.  pymata calls it as callback([pin, value, ...])
+		"""
+		self.senseValues[data[0]] = data[1]
+		if self._sensed:
+			self._sensed.set()
+
+	async def sync(self, saved=None, settle=0.5):
+		"""
+		Find out what the latching relays are set to from the sense pins, so a
+		restart can carry on without turning the equipment off and on.
+
+		<optional> saved => {"state": ..., "lastChange": ...} saved before the
+			restart.  lastChange is kept if the relays still match, so the min
+			on / off times carry on too.
+
+		<optional> settle => Seconds to give the board to report the pins
+
+		Returns the state, or None if it couldn't be worked out
+		"""
+		core = self.getCore()
+		if core is None:
+			return None
+		await core.sleep(settle)
+		heatSense = self.hvac.heatControl[2]
+		coolSense = self.hvac.coolControl[2]
+		heat = self.senseValues.get(heatSense)
+		if heat is None:
+			heat = await core.digital_read(heatSense)
+		cool = self.senseValues.get(coolSense)
+		if cool is None:
+			cool = await core.digital_read(coolSense)
+		if heat and cool:
+			self.LOGGER.error("The heat and A/C relays are both on")
+			return None
+
+		state = "HEAT" if heat else "COOL" if cool else "OFF"
+		self.hvac.state = state
+		self.desired = state
+		if saved and saved.get("state") == state:
+			self.lastChange = saved.get("lastChange")
+		self.synced = True
+		self.LOGGER.info("The relays were left at {}".format(state))
+		return state
+
+	async def start(self, saved=None):
+		"""
+		Find out what the relays are doing with sync(), or turn both off if
+		that can't be worked out.  If the board isn't connected yet, run()
+		does it once the board connects.
+
+		<optional> saved => The same as for sync()
+		"""
+		self.saved = saved
+		self.synced = False
+		if self.getCore() is not None:
+			await self.resync()
+		elif self._changed:
+			self._changed.set()
+
+	async def resync(self):
+		state = await self.sync(self.saved)
+		self.synced = True
+		if state is None:
+			self.LOGGER.warning("Could not tell what the HVAC was doing, turning it off")
+			self.request("heat", "off", force=True)
+			self.request("cool", "off", force=True)
+		else:
+			# The relays are known now, an off asked for before isn't needed
+			self.forced = []
+
+	def boardConnected(self, name=None):
+		"""
+		Read the relays again, the board may have missed a pulse while it was
+		away.  Can be used as a BoardManager connect listener.
+		"""
+		self.saved = {"state": self.hvac.state, "lastChange": self.lastChange}
+		self.synced = False
+		if self._changed:
+			self._changed.set()
+
+	def controlPins(self, heatCool):
+		return self.hvac.heatControl if heatCool == "HEAT" else self.hvac.coolControl
+
+	def waitTime(self, onOff):
+		"""
+		Returns the seconds until the relays are allowed to turn onOff
+		"""
+		if self.lastChange is None:
+			return 0
+		minimum = self.minOnTime if onOff == "OFF" else self.minOffTime
+		return max(0, self.lastChange + minimum - self.clock())
+
+	async def pulse(self, heatCool, onOff):
+		"""
+		Pulse one relay and wait for its sense pin.  Returns True if the sense
+		pin shows the change.
+		"""
+		onPin, offPin, sensePin = self.controlPins(heatCool)
+		pin = onPin if onOff == "ON" else offPin
+		expected = 1 if onOff == "ON" else 0
+		for attempt in range(self.retries + 1):
+			core = self.getCore()
+			if core is None:
+				raise RuntimeError("The HVAC board is not connected")
+			self._sensed.clear()
+			self.pulses += 1
+			await core.digital_write(pin, 1)
+			await core.sleep(self.pulseTime)
+			await core.digital_write(pin, 0)
+
+			try:
+				await asyncio.wait_for(self._waitForSense(sensePin, expected), self.confirmTimeout)
+				return True
+			except asyncio.TimeoutError:
+				pass
+			# No callback came, ask for the pin in case it was missed
+			if await core.digital_read(sensePin) == expected:
+				self.senseValues[sensePin] = expected
+				return True
+			self.LOGGER.warning("{} relay did not turn {} (try {} of {})".format(heatCool, onOff.lower(), attempt + 1, self.retries + 1))
+		return False
+
+	async def _waitForSense(self, sensePin, expected):
+		while self.senseValues.get(sensePin) != expected:
+			await self._sensed.wait()
+			self._sensed.clear()
+
+	async def _sleep(self, seconds):
+		"""
+		Wait for seconds, or until a new request comes in.  Returns False if it
+		was cut short.
+		"""
+		self._changed.clear()
+		try:
+			await asyncio.wait_for(self._changed.wait(), seconds)
+		except asyncio.TimeoutError:
+			return True
+		return False
+
+	def nextStep(self):
+		"""
+		Returns the (heatCool, onOff) pulse that gets closer to what was asked
+		for, or None if there is nothing to do
+		"""
+		current = self.hvac.state
+		if current == self.desired:
+			return None
+		if current != "OFF":
+			# Turn off what is running before turning on something else
+			return (current, "OFF")
+		return (self.desired, "ON")
+
+	async def step(self):
+		"""
+		Send the next pulse if it is time.  Returns the seconds until it can be
+		sent if it is too soon, or 0.
+		"""
+		if self.forced:
+			heatCool, onOff = self.forced[0]
+			verified = await self.pulse(heatCool, onOff)
+			# Only taken off once it was sent, so it is tried again after an error
+			self.forced.pop(0)
+			self.commit(heatCool, onOff, verified, forced=True)
+			return 0
+
+		change = self.nextStep()
+		if change is None:
+			return 0
+		heatCool, onOff = change
+		wait = self.waitTime(onOff)
+		if wait:
+			self.LOGGER.debug("Waiting %.0fs to turn %s %s", wait, heatCool.lower(), onOff.lower())
+			return wait
+
+		self.commit(heatCool, onOff, await self.pulse(heatCool, onOff))
+		return 0
+
+	async def pump(self):
+		"""
+		Send every pulse that can go now, for running the queue from a loop
+		with its own clock (like simulator.py) instead of run().  Returns the
+		seconds until the next one can be sent, or 0 if nothing is left.
+		"""
+		if self._sensed is None:
+			self._sensed = asyncio.Event()
+		while self.pending:
+			if not self.synced:
+				await self.resync()
+				continue
+			wait = await self.step()
+			if wait:
+				return wait
+		return 0
+
+	def commit(self, heatCool, onOff, verified, forced=False):
+		"""
+		Change HVAC.state after a pulse, if the sense pin showed it worked
+		"""
+		if verified:
+			state = heatCool if onOff == "ON" else "OFF"
+			if forced and onOff == "OFF" and self.hvac.state != heatCool:
+				# Turning off something that wasn't on leaves the state alone
+				state = self.hvac.state
+			if state != self.hvac.state:
+				self.lastChange = self.clock()
+			self.hvac.state = state
+			return
+		self.failures += 1
+		self.LOGGER.error("Could not turn {} {}.  The sense pin didn't change.".format(heatCool.lower(), onOff.lower()))
+		# Stop asking for it.  The next control tick can try again.
+		self.desired = self.hvac.state
+
+	async def run(self):
+		"""
+		Send the pulses as they are asked for.  Runs until cancelled.
+		"""
+		self._changed = asyncio.Event()
+		self._sensed = asyncio.Event()
+		try:
+			while True:
+				if not self.pending or self.getCore() is None:
+					# Nothing can be sent until the board connects
+					await self._changed.wait()
+					self._changed.clear()
+					continue
+				try:
+					if not self.synced:
+						await self.resync()
+					else:
+						wait = await self.step()
+						if wait:
+							await self._sleep(wait)
+				except Exception as e:
+					self.LOGGER.error("Could not change HVAC state.  {}".format(e))
+					self.desired = self.hvac.state
+					# The forced offs are kept and sent when the board is back
+					await self._sleep(self.retryDelay)
+		finally:
+			self._changed = None
+			self._sensed = None
+
+	async def drain(self, timeout=None):
+		"""
+		Wait until every request has been sent
+		"""
+		async def wait():
+			while self.pending:
+				await asyncio.sleep(0.05)
+		await asyncio.wait_for(wait(), timeout)
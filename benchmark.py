@@ -0,0 +1,236 @@
+#! /usr/bin/env python3
+
+"""
+Benchmarks for the parts of the thermostat that run every control tick.
+
+Everything runs against a FakeBoard, so no Arduino is needed.  Each benchmark
+is run with 3, 100 and 10,000 sensors by default and the results are saved as
+JSON so two runs can be compared:
+
+	python3 benchmark.py --output before.json
+	python3 benchmark.py --output after.json --compare before.json
+
+With --compare, anything slower than --threshold (default 20%) is reported
+and the script exits with 1.
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+
+import thermostat
+from sensors import TempSensor
+from hvac import HVAC
+from fakeboard import FakeBoard
+from acquisition import AcquisitionEngine
+from scheduler import ControlScheduler
+
+LOGGER = logging.getLogger("__main__.benchmark.py")
+
+SIZES = [3, 100, 10000]
+# Samples each sensor keeps.  The benchmarks don't look back through the
+# history, and 10,000 full ones don't fit in a Pi's memory.
+HISTORY_SIZE = 64
+
+def timeIt(function, number, repeat):
+	"""
+	Run function number times, repeat times over.
+
+	Returns a list with the seconds per call for each repeat
+	"""
+	times = []
+	for i in range(repeat):
+		start = time.perf_counter()
+		for j in range(number):
+			function()
+		times.append((time.perf_counter() - start) / number)
+	return times
+
+def makeThermostat(size, board=None):
+	"""
+	A Thermostat with size LM35 sensors all in the group HOUSE
+	"""
+	THERMOSTAT = thermostat.Thermostat()
+	THERMOSTAT.createGroup("HOUSE")
+	for pin in range(size):
+		sensor = TempSensor("LM35", pin, HISTORY_SIZE)
+		THERMOSTAT.addSensor(sensor, "SENSOR{}".format(pin))
+		THERMOSTAT.addSensorToGroup("HOUSE", sensor)
+		if board:
+			board.setAnalog(pin, 40 + pin % 10)
+	return THERMOSTAT
+
+def benchGetTempSensor(size):
+	THERMOSTAT = makeThermostat(size)
+	for pin, sensor in enumerate(THERMOSTAT.tempSensors.values()):
+		sensor.tempC = 40 + pin % 10
+	location = "SENSOR{}".format(size - 1)
+	return lambda: THERMOSTAT.getTemp(location)
+
+def benchGetTempGroup(size):
+	THERMOSTAT = makeThermostat(size)
+	for pin, sensor in enumerate(THERMOSTAT.tempSensors.values()):
+		sensor.tempC = 40 + pin % 10
+	return lambda: THERMOSTAT.getTemp("HOUSE")
+
+def benchGetTempGroupAfterChange(size):
+	"""
+	One sensor read again and then the group mean, like a read between every
+	reading.  The two benchmarks above only time the cached answer.
+	"""
+	THERMOSTAT = makeThermostat(size)
+	THERMOSTAT.ttl = 300
+	clock = {"now": time.time()}
+	THERMOSTAT.clock = lambda: clock["now"]
+	sensors = list(THERMOSTAT.tempSensors.values())
+	for pin, sensor in enumerate(sensors):
+		sensor.update(80 + pin % 20, clock["now"])
+	state = {"count": 0}
+	def run():
+		state["count"] += 1
+		clock["now"] += 0.01
+		# A different temp than last time so the change is seen
+		sensors[state["count"] % size].update(100 + state["count"] % 7, clock["now"])
+		return THERMOSTAT.getTemp("HOUSE")
+	return run
+
+def benchConversion(size):
+	"""
+	Setting tempC from a raw value on every sensor, one at a time
+	"""
+	THERMOSTAT = makeThermostat(size)
+	sensors = list(THERMOSTAT.tempSensors.values())
+	state = {"raw": 40}
+	def run():
+		state["raw"] = 40 + (state["raw"] + 1) % 10
+		for sensor in sensors:
+			sensor.tempC = state["raw"]
+	return run
+
+def benchBuildGroup(size):
+	"""
+	Making a group and adding every sensor to it
+	"""
+	THERMOSTAT = makeThermostat(size)
+	sensors = list(THERMOSTAT.tempSensors.values())
+	state = {"count": 0}
+	def run():
+		state["count"] += 1
+		name = "GROUP{}".format(state["count"])
+		THERMOSTAT.createGroup(name)
+		for sensor in sensors:
+			THERMOSTAT.addSensorToGroup(name, sensor)
+	return run
+
+def benchControlTick(size):
+	"""
+	One full tick:  read every sensor, update the Thermostat, run the control decision
+	"""
+	board = FakeBoard()
+	THERMOSTAT = makeThermostat(size, board)
+	hvac = HVAC()
+	async def actuate(heatCool, onOff):
+		hvac.state = "OFF" if onOff == "off" else heatCool.upper()
+	engine = AcquisitionEngine(THERMOSTAT, board.core)
+	scheduler = ControlScheduler(THERMOSTAT, hvac, actuate, area="HOUSE", convert=lambda temp: temp * 1.8 + 32)
+	THERMOSTAT.setpoint = 68
+	THERMOSTAT.state = "HEAT"
+	async def tick():
+		await engine.cycle()
+		await scheduler.tick()
+	return lambda: board.loop.run_until_complete(tick())
+
+BENCHMARKS = {
+	"getTemp.sensor": benchGetTempSensor,
+	"getTemp.group": benchGetTempGroup,
+	"getTemp.groupAfterChange": benchGetTempGroupAfterChange,
+	"tempC.conversion": benchConversion,
+	"createGroup.addSensorToGroup": benchBuildGroup,
+	"controlTick": benchControlTick,
+	}
+
+def run(sizes, names=None, budget=0.2, repeat=5):
+	"""
+	Run the benchmarks.  Each repeat runs for about budget seconds.
+
+	Returns a list of result dicts
+	"""
+	results = []
+	for name, setup in BENCHMARKS.items():
+		if names and name not in names:
+			continue
+		for size in sizes:
+			function = setup(size)
+			# Work out how many calls fit in the budget
+			once = timeIt(function, 1, 1)[0]
+			number = max(1, int(budget / max(once, 1e-9)))
+			times = timeIt(function, number, repeat)
+			result = {
+				"name": name,
+				"sensors": size,
+				"number": number,
+				"repeat": repeat,
+				"min": min(times),
+				"median": statistics.median(times),
+				"mean": statistics.mean(times),
+				"stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+				}
+			results.append(result)
+			print("{:32} {:>6} sensors  {:>12.3f} us".format(name, size, result["median"] * 1e6))
+	return results
+
+def compare(results, old, threshold):
+	"""
+	Print how results changed from an older run.  Returns the slower ones.
+	"""
+	before = {(result["name"], result["sensors"]): result for result in old["results"]}
+	regressions = []
+	for result in results:
+		key = (result["name"], result["sensors"])
+		if key not in before:
+			continue
+		ratio = result["median"] / before[key]["median"]
+		flag = ""
+		if ratio > 1 + threshold:
+			flag = "  SLOWER"
+			regressions.append((key, ratio))
+		print("{:32} {:>6} sensors  {:>6.2f}x{}".format(key[0], key[1], ratio, flag))
+	return regressions
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--sizes", help="Sensor counts to run", type=int, nargs="+", default=SIZES)
+	parser.add_argument("--only", help="Only run these benchmarks", nargs="+", choices=list(BENCHMARKS))
+	parser.add_argument("--budget", help="Seconds per repeat", type=float, default=0.2)
+	parser.add_argument("--repeat", help="Repeats per benchmark", type=int, default=5)
+	parser.add_argument("--output", help="Save the results to this JSON file", default="benchmark.json")
+	parser.add_argument("--compare", help="JSON file from an older run to compare with")
+	parser.add_argument("--threshold", help="How much slower counts as a regression", type=float, default=0.2)
+	args = parser.parse_args()
+
+	# Only time the code, not the logging
+	logging.disable(logging.WARNING)
+
+	results = run(args.sizes, args.only, args.budget, args.repeat)
+	with open(args.output, "w") as output:
+		json.dump({
+			"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+			"python": platform.python_version(),
+			"platform": platform.platform(),
+			"results": results,
+			}, output, indent=2)
+	print("Saved to {}".format(args.output))
+
+	if args.compare:
+		with open(args.compare, "r") as old:
+			regressions = compare(results, json.load(old), args.threshold)
+		if regressions:
+			sys.exit(1)
@@ -0,0 +1,275 @@
+"""
+Run more than one Arduino at a time.
+
+Requirements:
+	pymata-aio => https://github.com/MrYsLab/pymata-aio
+
+The BOARDS setting names each board and its serial port.  Sensors say which
+board they are on with a third value in SENSORS, and the HVAC with
+HVAC.BOARD.  Anything that doesn't say is on the first board.
+
+Each board has its own AcquisitionEngine running in its own asyncio task, so
+a board that is slow or reconnecting only holds up its own sensors.
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+import asyncio
+
+from acquisition import AcquisitionEngine
+
+LOGGER = logging.getLogger("__main__.boards.py")
+
+async def connectPymata(name, comPort, arduinoWait=2):
+	"""
+	Default way to connect to a board.  Returns a started PymataCore.
+
+	Note:  pymata's start_aio blocks for arduinoWait seconds while the board resets
+	"""
+	from pymata_aio.pymata_core import PymataCore
+	core = PymataCore(arduino_wait=arduinoWait, com_port=comPort, port_discovery_exceptions=True, event_loop=asyncio.get_event_loop())
+	await core.start_aio()
+	return core
+
+class BoardManager:
+	"""
+	Keeps track of every board, which sensors are on it, and keeps each one
+	reading and connected.
+	"""
+	def __init__(self, boards, connect=connectPymata, readTimeout=5.0, maxFailures=3, retryDelay=5.0, maxRetryDelay=300.0):
+		"""
+		boards => <dict> {name: serial port} from the BOARDS setting
+
+		<optional> connect => Coroutine function called as connect(name, comPort)
+			that returns the asyncio interface for a board
+
+		<optional> readTimeout => Seconds a board gets to finish reading its sensors
+
+		<optional> maxFailures => Failed reads in a row before reconnecting
+
+		<optional> retryDelay, maxRetryDelay => Seconds to wait before trying to
+			reconnect.  The wait doubles after every try up to maxRetryDelay.
+		"""
+		self.LOGGER = logging.getLogger("__main__.boards.BoardManager")
+
+		self.ports = {name.upper(): comPort for name, comPort in boards.items()}
+		self.connectBoard = connect
+		self.readTimeout = readTimeout
+		self.maxFailures = maxFailures
+		self.retryDelay = retryDelay
+		self.maxRetryDelay = maxRetryDelay
+
+		self.cores = {name: None for name in self.ports}
+		# {board: {pin: (mode, callback, callbackType)}} so they can be set again after a reconnect
+		self.pinModes = {name: {} for name in self.ports}
+		# {board: milliseconds} between analog reports, sent again after a reconnect
+		self.samplingIntervals = {}
+		# {location: board}
+		self.sensorBoards = {}
+		self.engines = {}
+		self.listeners = []
+		self.connectListeners = []
+		# {board: asyncio.Event} set by wakeUp to cut a wait short
+		self._wake = {}
+
+	@property
+	def defaultBoard(self):
+		return next(iter(self.ports))
+
+	def boardName(self, name=None):
+		"""
+		Returns the board name in upper case, or the first board if name is None
+		"""
+		if name is None:
+			return self.defaultBoard
+		name = name.upper()
+		if name not in self.ports:
+			raise KeyError("There is no board {}".format(name))
+		return name
+
+	def core(self, name=None):
+		"""
+		Returns the asyncio interface for a board, or None if it is not connected
+		"""
+		return self.cores[self.boardName(name)]
+
+	def assignSensors(self, settings):
+		"""
+		Map every sensor in SENSORS to the board in its third value
+		"""
+		for location, sensor in settings["SENSORS"].items():
+			self.sensorBoards[location.upper()] = self.boardName(sensor[2] if len(sensor) > 2 else None)
+
+	def addListener(self, callback):
+		"""
+		callback => Called with each board's snapshot when it is read
+		"""
+		self.listeners.append(callback)
+		for engine in self.engines.values():
+			engine.addListener(callback)
+
+	def addConnectListener(self, callback):
+		"""
+		callback => Called as callback(name) every time a board connects, after
+			its pins are set up
+		"""
+		self.connectListeners.append(callback)
+
+	async def setPinMode(self, name, pin, mode, callback=None, callbackType=None):
+		"""
+		Set a pin mode on a board, and again every time the board reconnects
+		"""
+		name = self.boardName(name)
+		self.pinModes[name][pin] = (mode, callback, callbackType)
+		core = self.cores[name]
+		if core:
+			await core.set_pin_mode(pin, mode, callback, callbackType)
+
+	async def setSamplingInterval(self, name, interval):
+		"""
+		Set how often a board sends analog reports, in milliseconds
+		"""
+		name = self.boardName(name)
+		self.samplingIntervals[name] = interval
+		core = self.cores[name]
+		if core:
+			await core.set_sampling_interval(interval)
+
+	async def connect(self, name):
+		"""
+		Connect to a board.  Returns True if it worked.
+		"""
+		name = self.boardName(name)
+		self.LOGGER.info("Connecting to board {} on {}".format(name, self.ports[name]))
+		try:
+			core = await self.connectBoard(name, self.ports[name])
+			for pin, (mode, callback, callbackType) in self.pinModes[name].items():
+				await core.set_pin_mode(pin, mode, callback, callbackType)
+			if name in self.samplingIntervals:
+				await core.set_sampling_interval(self.samplingIntervals[name])
+		except Exception as e:
+			self.LOGGER.error("Could not connect to board {}.  {}".format(name, e))
+			return False
+		self.cores[name] = core
+		if name in self.engines:
+			self.engines[name].core = core
+		for callback in self.connectListeners:
+			try:
+				callback(name)
+			except Exception as e:
+				self.LOGGER.error("Connect listener failed.  {!r}".format(e))
+		return True
+
+	async def connectAll(self):
+		"""
+		Connect to every board at once.  Returns the names of the ones that failed.
+		"""
+		results = await asyncio.gather(*[self.connect(name) for name in self.ports])
+		return [name for name, connected in zip(self.ports, results) if not connected]
+
+	async def disconnect(self, name):
+		"""
+		Reset a board and let go of its serial port
+		"""
+		name = self.boardName(name)
+		core = self.cores[name]
+		self.cores[name] = None
+		if core is None:
+			return
+		try:
+			# Don't use core.shutdown, it stops the event loop for every board
+			if hasattr(core, "send_reset"):
+				await core.send_reset()
+			if getattr(core, "serial_port", None):
+				core.serial_port.close()
+		except Exception as e:
+			self.LOGGER.warning("Problem disconnecting board {}.  {}".format(name, e))
+
+	async def shutdown(self):
+		await asyncio.gather(*[self.disconnect(name) for name in self.ports])
+
+	def wakeUp(self):
+		"""
+		Work out the wait again on every board, for when the interval changes
+		"""
+		for wake in self._wake.values():
+			wake.set()
+
+	async def pause(self, name, interval, started):
+		"""
+		Wait until interval seconds after started.  If interval is a function it
+		is asked again whenever wakeUp is called.
+		"""
+		loop = asyncio.get_event_loop()
+		wake = self._wake[name]
+		wake.clear()
+		while True:
+			wait = (interval() if callable(interval) else interval) - (loop.time() - started)
+			if wait <= 0:
+				return
+			try:
+				await asyncio.wait_for(wake.wait(), wait)
+			except asyncio.TimeoutError:
+				return
+			wake.clear()
+
+	async def runBoard(self, name, interval):
+		"""
+		Read one board every interval seconds, reconnecting when it stops answering
+
+		interval => Seconds, or a function that returns the seconds until the next read
+		"""
+		engine = self.engines[name]
+		failures = 0
+		delay = self.retryDelay
+		while True:
+			if self.cores[name] is None:
+				if not await self.connect(name):
+					self.LOGGER.warning("Trying board {} again in {}s".format(name, delay))
+					await asyncio.sleep(delay)
+					delay = min(delay * 2, self.maxRetryDelay)
+					continue
+				delay = self.retryDelay
+
+			started = asyncio.get_event_loop().time()
+			try:
+				await asyncio.wait_for(engine.cycle(), self.readTimeout)
+				failures = 0
+			except Exception as e:
+				failures += 1
+				self.LOGGER.warning("Board {} failed to read ({} in a row).  {!r}".format(name, failures, e))
+				if failures >= self.maxFailures:
+					await self.disconnect(name)
+					failures = 0
+					continue
+			await self.pause(name, interval, started)
+
+	async def run(self, thermostat, interval, engine=AcquisitionEngine):
+		"""
+		Start an AcquisitionEngine for each board that has sensors and keep them
+		all running until cancelled
+
+		interval => Seconds between reads, or a function that returns the
+			seconds until the next read like sampling.AdaptiveSampler.nextInterval
+
+		<optional> engine => The engine class, or a function called as
+			engine(thermostat, core, locations=locations).  Use
+			acquisition.ReportingEngine to get the values from Firmata's
+			analog reports instead of reading them.
+		"""
+		makeEngine = engine
+		for name in self.ports:
+			locations = [location for location, board in self.sensorBoards.items() if board == name]
+			if not locations:
+				continue
+			engine = makeEngine(thermostat, self.cores[name], locations=locations)
+			for callback in self.listeners:
+				engine.addListener(callback)
+			self.engines[name] = engine
+			self._wake[name] = asyncio.Event()
+			if hasattr(engine, "attach"):
+				await engine.attach(self, name)
+		await asyncio.gather(*[self.runBoard(name, interval) for name in self.engines])
@@ -0,0 +1,277 @@
+"""
+The control strategies that decide when to run the heat and the A/C.
+
+A controller gets the zone temp, setpoint, state and what the HVAC is doing
+on every tick and returns the commands to send.  It only keeps a few numbers
+between ticks, so a decision is the same small amount of work no matter how
+long it has been running.
+
+	HYSTERESIS			<- On below setpoint - DEADBAND, off above setpoint + DEADBAND
+	TIME_PROPORTIONAL	<- On for part of every CYCLE_TIME, longer the colder it is
+	PID					<- Like TIME_PROPORTIONAL, with the on time from a PID loop
+
+Every controller handles the AUTO state.  In AUTO the zone is heated to the
+setpoint when the WINTER program is in use and only cooled above setpoint +
+CHANGEOVER_BAND, and the other way around with the SUMMER program.  Without a
+program it is kept between setpoint - CHANGEOVER_BAND and setpoint +
+CHANGEOVER_BAND.
+
+The controllers don't keep the HVAC on or off for a minimum time.  The
+RelayQueue does that with the HVAC MIN_ON_TIME and MIN_OFF_TIME settings, and
+holds back a command that comes too soon.
+
+Temps and bands are in the same units as the setpoint.
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+
+from utils import camelCase
+
+LOGGER = logging.getLogger("__main__.controllers.py")
+
+class Controller:
+	"""
+	The part every strategy shares.  A strategy only has to say if the HVAC
+	should be running with demand().
+	"""
+	def __init__(self, changeoverBand=2):
+		"""
+		<optional> changeoverBand => How far from the setpoint the AUTO state
+			lets the temp go before heating or cooling
+		"""
+		self.LOGGER = logging.getLogger("__main__.controllers.Controller")
+
+		self.changeoverBand = changeoverBand
+
+		# "HEAT" or "COOL", the way the zone was last being pushed
+		self.direction = None
+		# Time the answer may change with no new reading, or None
+		self.wakeAt = None
+
+	# How far either side of the target the answer changes, for thresholds()
+	band = 0.0
+
+	def reset(self):
+		"""
+		Forget what the strategy has learned, like when the direction changes
+		"""
+		pass
+
+	def targets(self, setpoint, state, prefer=None):
+		"""
+		Returns {"HEAT": temp, "COOL": temp} with the temps the state heats
+		and cools to
+		"""
+		if state == "AUTO":
+			return {
+				"HEAT": setpoint if prefer == "HEAT" else setpoint - self.changeoverBand,
+				"COOL": setpoint if prefer == "COOL" else setpoint + self.changeoverBand,
+				}
+		if state in ("HEAT", "COOL"):
+			return {state: setpoint}
+		return {}
+
+	def thresholds(self, setpoint, state, prefer=None):
+		"""
+		Returns the temps where the HVAC turns on or off, lowest first.  Used
+		to read the sensors faster near them.
+		"""
+		if setpoint is None:
+			return []
+		return sorted({point for target in self.targets(setpoint, state, prefer).values() for point in (target - self.band, target + self.band)})
+
+	def demand(self, error, running, now):
+		"""
+		Returns True if the HVAC should be running
+
+		error => How far the temp is from the target, more than 0 when it
+			needs heating (or cooling in the COOL direction)
+
+		running => True if the HVAC is running now
+
+		now => Time in seconds
+		"""
+		raise NotImplementedError
+
+	def decide(self, temp, setpoint, state, hvacState, now, prefer=None):
+		"""
+		Returns a list of (heatCool, onOff) commands.  An empty list means
+		leave everything alone.
+
+		<optional> prefer => In AUTO, "HEAT" or "COOL" for the way the program
+			in use pushes.  That way goes to the setpoint, the other one stops
+			CHANGEOVER_BAND short of it.
+		"""
+		self.wakeAt = None
+		if state == "OFF":
+			if hvacState != "OFF":
+				return [(hvacState.lower(), "off")]
+			return []
+		if temp is None or setpoint is None:
+			return []
+
+		targets = self.targets(setpoint, state, prefer)
+		if not targets:
+			# FAN is not implemented yet
+			return []
+		if state == "AUTO":
+			if hvacState in ("HEAT", "COOL"):
+				direction = hvacState
+			elif temp < (targets["HEAT"] + targets["COOL"]) / 2:
+				direction = "HEAT"
+			else:
+				direction = "COOL"
+		else:
+			direction = state
+		target = targets[direction]
+
+		if direction != self.direction:
+			self.direction = direction
+			self.reset()
+
+		# Running the wrong way for the state
+		if hvacState not in ("OFF", direction):
+			return [(hvacState.lower(), "off")]
+
+		error = target - temp if direction == "HEAT" else temp - target
+		running = hvacState == direction
+		wanted = self.demand(error, running, now)
+		if running and not wanted:
+			return [(direction.lower(), "off")]
+		if not running and wanted:
+			return [(direction.lower(), "on")]
+		return []
+
+class HysteresisController(Controller):
+	"""
+	Bang-bang with a deadband around the setpoint
+	"""
+	def __init__(self, deadband=0.5, **kwargs):
+		"""
+		<optional> deadband => How far past the setpoint the temp goes before
+			turning on or off.  0.5 is the same as rounding the temp.
+		"""
+		super().__init__(**kwargs)
+		self.LOGGER = logging.getLogger("__main__.controllers.HysteresisController")
+		self.deadband = deadband
+
+	@property
+	def band(self):
+		return self.deadband
+
+	def demand(self, error, running, now):
+		if running:
+			return error > -self.deadband
+		return error > self.deadband
+
+class TimeProportionalController(Controller):
+	"""
+	Runs the HVAC for part of every cycle.  The share of the cycle is worked
+	out at the start of the cycle from how far the temp is from the setpoint.
+	"""
+	def __init__(self, proportionalBand=2, cycleTime=900, **kwargs):
+		"""
+		<optional> proportionalBand => The temp range from always off to always
+			on.  At the setpoint the HVAC runs half of each cycle.
+
+		<optional> cycleTime => Seconds in a cycle
+		"""
+		super().__init__(**kwargs)
+		self.LOGGER = logging.getLogger("__main__.controllers.TimeProportionalController")
+		self.proportionalBand = proportionalBand
+		self.cycleTime = cycleTime
+
+		self.cycleStart = None
+		# The share of the current cycle to run, 0 to 1
+		self.duty = 0.0
+
+	@property
+	def band(self):
+		# Always off or always on past here
+		return self.proportionalBand / 2
+
+	def reset(self):
+		self.cycleStart = None
+
+	def output(self, error, now):
+		"""
+		Returns the share of the next cycle to run, 0 to 1
+		"""
+		return 0.5 + error / self.proportionalBand
+
+	def demand(self, error, running, now):
+		if self.cycleStart is None or now - self.cycleStart >= self.cycleTime:
+			self.cycleStart = now
+			self.duty = min(1.0, max(0.0, self.output(error, now)))
+		onUntil = self.cycleStart + self.duty * self.cycleTime
+		if now < onUntil:
+			self.wakeAt = onUntil
+			return True
+		self.wakeAt = self.cycleStart + self.cycleTime
+		return False
+
+class PIDController(TimeProportionalController):
+	"""
+	Time proportional, with the share of each cycle from a PID loop
+	"""
+	def __init__(self, kp=0.5, ki=0.0002, kd=0.0, cycleTime=900, **kwargs):
+		"""
+		<optional> kp => Share of a cycle per degree from the target
+
+		<optional> ki => Share of a cycle per degree second of error
+
+		<optional> kd => Share of a cycle per degree per second of change
+		"""
+		super().__init__(cycleTime=cycleTime, **kwargs)
+		self.LOGGER = logging.getLogger("__main__.controllers.PIDController")
+		self.kp = kp
+		self.ki = ki
+		self.kd = kd
+
+		self.integral = 0.0
+		self.lastError = None
+		self.lastTime = None
+
+	# The on time changes all the way up to the target
+	band = 0.0
+
+	def reset(self):
+		super().reset()
+		self.integral = 0.0
+		self.lastError = None
+		self.lastTime = None
+
+	def output(self, error, now):
+		derivative = 0.0
+		if self.lastTime is not None and now > self.lastTime:
+			seconds = now - self.lastTime
+			derivative = (error - self.lastError) / seconds
+			integral = self.integral + error * seconds
+			# Only wind up while the output isn't pinned at off or on
+			if self.ki and 0 <= self.kp * error + self.ki * integral <= 1:
+				self.integral = integral
+		self.lastError = error
+		self.lastTime = now
+		return self.kp * error + self.ki * self.integral + self.kd * derivative
+
+CONTROLLER_TYPES = {
+	"HYSTERESIS": HysteresisController,
+	"TIME_PROPORTIONAL": TimeProportionalController,
+	"PID": PIDController,
+	}
+
+def makeController(settings=None):
+	"""
+	settings => {"TYPE": "PID", "KP": 0.5, "CYCLE_TIME": 600}  Everything but
+		TYPE is passed on to the controller, CYCLE_TIME as cycleTime and so
+		on.  A HysteresisController if not given.
+	"""
+	settings = dict(settings or {"TYPE": "HYSTERESIS"})
+	kind = settings.pop("TYPE").upper()
+	if kind not in CONTROLLER_TYPES:
+		raise KeyError("No controller type {}".format(kind))
+	return CONTROLLER_TYPES[kind](**{camelCase(key): value for key, value in settings.items()})
@@ -0,0 +1,175 @@
+"""
+Formulas to change a raw analog reading into degrees C.
+
+Each type of sensor has its own formula in CONVERSIONS.  A new type can be
+added with the registerConversion decorator.  The formulas are written so they
+work on a single number or on a whole NumPy array, so every sensor of the same
+type can be converted at once with ConversionPlan.
+
+Optional:
+	numpy => https://numpy.org
+		Without it, batches are converted one value at a time.  It is only
+		imported once a plan has NUMPY_MIN_SENSORS sensors, below that the
+		plain loop is faster and startup doesn't pay for the import.
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+import math
+from importlib.util import find_spec
+
+LOGGER = logging.getLogger("__main__.conversions.py")
+
+# NumPy is optional, but makes converting a lot of sensors much faster.
+# It is imported by loadNumpy when it is first needed.
+np = None
+NUMPY_ENABLED = find_spec("numpy") is not None
+if not NUMPY_ENABLED:
+	LOGGER.warning("Package numpy is not installed.  Sensors will be converted one at a time")
+
+# Plans with fewer sensors than this are faster without NumPy
+NUMPY_MIN_SENSORS = 20
+
+def loadNumpy():
+	"""
+	Import NumPy the first time it is needed.  Returns the module, or None if
+	it is not installed.
+	"""
+	global np, NUMPY_ENABLED
+	if np is None and NUMPY_ENABLED:
+		try:
+			import numpy as np
+		except ImportError as e:
+			NUMPY_ENABLED = False
+			LOGGER.warning("Could not import numpy.  Sensors will be converted one at a time.  {}".format(e))
+	return np
+
+# The Arduino has a 10 bit ADC with a 5 volt reference
+ADC_STEPS = 1024
+VREF = 5.0
+
+# Anything at or below this came from a broken or unplugged sensor
+ABSOLUTE_ZERO = -273.15
+
+# {moduleType: (function, parameters)}
+CONVERSIONS = {}
+
+def registerConversion(moduleType, **parameters):
+	"""
+	Decorator to add a formula for a type of sensor.
+
+	moduleType => Name of the sensor type (LM35, etc...)
+
+	<optional> parameters => Default values passed to the formula as keywords.
+
+	The formula is called as function(raw, lib, **parameters) where lib is
+	either numpy or math, so it should only use lib.log and such.
+	"""
+	def decorator(function):
+		CONVERSIONS[moduleType.upper()] = (function, parameters)
+		return function
+	return decorator
+
+def setParameters(moduleType, **parameters):
+	"""
+	Change the default parameters of a formula, for example the Steinhart-Hart
+	coefficients of a different thermistor.
+	"""
+	function, current = CONVERSIONS[moduleType.upper()]
+	current = dict(current)
+	current.update(parameters)
+	CONVERSIONS[moduleType.upper()] = (function, current)
+
+@registerConversion("LM35")
+def lm35(raw, lib):
+	# 10mV per degree C
+	return raw * (VREF * 100 / ADC_STEPS)
+
+@registerConversion("TMP36")
+def tmp36(raw, lib):
+	# 10mV per degree C with a 500mV offset
+	return (raw * (VREF * 1000 / ADC_STEPS) - 500) / 10
+
+@registerConversion("NTC", seriesResistor=10000.0, a=1.009249522e-03, b=2.378405444e-04, c=2.019202697e-07)
+def ntc(raw, lib, seriesResistor, a, b, c):
+	"""
+	Thermistor between the analog pin and ground, with seriesResistor between
+	the pin and VREF.  The default coefficients fit a common 10K NTC.
+	"""
+	resistance = seriesResistor * raw / (ADC_STEPS - 1 - raw)
+	logR = lib.log(resistance)
+	return 1 / (a + b * logR + c * logR * logR * logR) + ABSOLUTE_ZERO
+
+def convert(moduleType, rawValue, offset=0.0, gain=1.0):
+	"""
+	Convert one raw reading.  Returns None if the type is unknown or the value
+	is out of range for the formula.
+	"""
+	if moduleType not in CONVERSIONS or rawValue is None:
+		return None
+	function, parameters = CONVERSIONS[moduleType]
+	try:
+		temp = function(rawValue, math, **parameters)
+	except (ValueError, ZeroDivisionError):
+		return None
+	if temp <= ABSOLUTE_ZERO:
+		return None
+	return temp * gain + offset
+
+class ConversionPlan:
+	"""
+	Converts the readings of a fixed list of sensors in one go.
+
+	The sensors are sorted by type once when the plan is made, then each
+	batch is one array operation per type instead of one call per sensor.
+	"""
+	def __init__(self, sensors):
+		"""
+		sensors => List of TempSensor.  Their moduleType, offset and gain are
+			read now, so make a new plan if they change.
+		"""
+		self.LOGGER = logging.getLogger("__main__.conversions.ConversionPlan")
+
+		self.size = len(sensors)
+		self.moduleTypes = [sensor.moduleType for sensor in sensors]
+		self.offsets = [sensor.offset for sensor in sensors]
+		self.gains = [sensor.gain for sensor in sensors]
+
+		# {moduleType: [positions]}
+		self.positions = {}
+		for position, moduleType in enumerate(self.moduleTypes):
+			if moduleType in CONVERSIONS:
+				self.positions.setdefault(moduleType, []).append(position)
+			else:
+				self.LOGGER.warning("No conversion for sensor type {}".format(moduleType))
+
+		self.vectorised = self.size >= NUMPY_MIN_SENSORS and loadNumpy() is not None
+		if self.vectorised:
+			self.positions = {moduleType: np.array(positions) for moduleType, positions in self.positions.items()}
+			self.offsets = np.array(self.offsets, dtype=float)
+			self.gains = np.array(self.gains, dtype=float)
+
+	def convert(self, rawValues):
+		"""
+		rawValues => Raw readings in the same order as the sensors.  Use None
+			for sensors that were not read.
+
+		Returns a list of temps in C, with None where there was no reading or
+		no formula.
+		"""
+		if not self.vectorised:
+			return [convert(moduleType, raw, offset, gain) for moduleType, raw, offset, gain in zip(self.moduleTypes, rawValues, self.offsets, self.gains)]
+
+		raws = np.array(rawValues, dtype=float)
+		temps = np.full(self.size, np.nan)
+		with np.errstate(all="ignore"):
+			for moduleType, positions in self.positions.items():
+				function, parameters = CONVERSIONS[moduleType]
+				temps[positions] = function(raws[positions], np, **parameters)
+			temps[temps <= ABSOLUTE_ZERO] = np.nan
+			temps = temps * self.gains + self.offsets
+		# Anything that could not be worked out is None
+		return [None if math.isnan(temp) or math.isinf(temp) else temp for temp in temps.tolist()]
@@ -0,0 +1,165 @@
+#! /usr/bin/env python3
+
+"""
+A stand-in for a PyMata3 board so the thermostat can be run without an Arduino.
+
+FakeBoard has the same blocking calls that start.py uses and FakeBoard.core has
+the asyncio calls that the acquisition engine uses.  Each read can be given a
+delay to act like the serial link.
+
+Run it directly to measure a read cycle with a lot of sensors:
+	python3 fakeboard.py --sensors 48 --latency 0.005
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+import asyncio
+
+LOGGER = logging.getLogger("__main__.fakeboard.py")
+
+# Same values as pymata_aio.constants.Constants
+INPUT = 0
+OUTPUT = 1
+ANALOG = 2
+
+class FakeCore:
+	"""
+	The asyncio half of the fake board, the same as PyMataCore
+	"""
+	def __init__(self, latency=0.0, default=43):
+		"""
+		<optional> latency => Seconds each analog_read takes
+
+		<optional> default => Raw value returned for pins that were not set.
+			43 is about 70F on a LM35
+		"""
+		self.LOGGER = logging.getLogger("__main__.fakeboard.FakeCore")
+
+		self.latency = latency
+		self.default = default
+
+		self.analogValues = {}
+		self.digitalValues = {}
+		self.pinModes = {}
+		self.callbacks = {}
+
+		# Milliseconds between analog reports, Firmata's default
+		self.samplingInterval = 19
+
+		self.analogReads = 0
+		self.analogReports = 0
+		self.digitalWrites = 0
+
+	async def analog_read(self, pin):
+		self.analogReads += 1
+		if self.latency:
+			await asyncio.sleep(self.latency)
+		return self.analogValues.get(pin, self.default)
+
+	async def digital_read(self, pin):
+		return self.digitalValues.get(pin, 0)
+
+	async def digital_write(self, pin, value):
+		self.digitalWrites += 1
+		self.digitalValues[pin] = value
+
+	async def set_pin_mode(self, pin_number, pin_state, callback=None, callback_type=None):
+		self.pinModes[pin_number] = pin_state
+		if callback:
+			self.callbacks[pin_number] = callback
+
+	async def set_sampling_interval(self, interval):
+		self.samplingInterval = interval
+
+	async def stream(self):
+		"""
+		Send analog reports for every ANALOG pin with a callback, like Firmata
+		does, until cancelled
+		"""
+		loop = asyncio.get_event_loop()
+		while True:
+			for pin, callback in self.callbacks.items():
+				if self.pinModes.get(pin) == ANALOG:
+					self.analogReports += 1
+					loop.call_soon(callback, [pin, self.analogValues.get(pin, self.default), ANALOG])
+			await asyncio.sleep(self.samplingInterval / 1000)
+
+	async def sleep(self, sleep_time):
+		await asyncio.sleep(sleep_time)
+
+	async def shutdown(self):
+		pass
+
+class FakeBoard:
+	"""
+	The blocking half of the fake board, the same as PyMata3
+	"""
+	def __init__(self, latency=0.0, default=43, loop=None):
+		self.LOGGER = logging.getLogger("__main__.fakeboard.FakeBoard")
+
+		self.loop = loop or asyncio.new_event_loop()
+		self.core = FakeCore(latency, default)
+
+	def setAnalog(self, pin, value):
+		"""
+		Set the raw value that a pin will return
+		"""
+		self.core.analogValues[pin] = value
+
+	def analog_read(self, pin):
+		return self.loop.run_until_complete(self.core.analog_read(pin))
+
+	def digital_read(self, pin):
+		return self.loop.run_until_complete(self.core.digital_read(pin))
+
+	def digital_write(self, pin, value):
+		self.loop.run_until_complete(self.core.digital_write(pin, value))
+
+	def set_pin_mode(self, pin_number, pin_state, callback=None, cb_type=None):
+		self.loop.run_until_complete(self.core.set_pin_mode(pin_number, pin_state, callback, cb_type))
+
+	def sleep(self, sleep_time):
+		self.loop.run_until_complete(self.core.sleep(sleep_time))
+
+	def shutdown(self):
+		self.loop.run_until_complete(self.core.shutdown())
+
+if __name__ == "__main__":
+	import argparse
+	import time
+
+	import thermostat
+	from sensors import TempSensor
+	from acquisition import AcquisitionEngine
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--sensors", help="Number of sensors", type=int, default=48)
+	parser.add_argument("--latency", help="Seconds per analog_read", type=float, default=0.005)
+	parser.add_argument("--cycles", help="Number of read cycles", type=int, default=10)
+	args = parser.parse_args()
+
+	board = FakeBoard(latency=args.latency)
+	THERMOSTAT = thermostat.Thermostat()
+	for pin in range(args.sensors):
+		THERMOSTAT.addSensor(TempSensor("LM35", pin), "sensor{}".format(pin))
+	engine = AcquisitionEngine(THERMOSTAT, board.core)
+
+	# The old way, one sensor after another
+	start = time.perf_counter()
+	for i in range(args.cycles):
+		for sensor in THERMOSTAT.tempSensors.values():
+			sensor.tempC = board.analog_read(sensor.controlPin)
+	serial = (time.perf_counter() - start) / args.cycles
+
+	# All at once
+	start = time.perf_counter()
+	for i in range(args.cycles):
+		board.loop.run_until_complete(engine.cycle())
+	concurrent = (time.perf_counter() - start) / args.cycles
+
+	print("{} sensors, {}s per read".format(args.sensors, args.latency))
+	print("serial:      {:.4f}s per cycle".format(serial))
+	print("concurrent:  {:.4f}s per cycle".format(concurrent))
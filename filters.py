@@ -0,0 +1,167 @@
+"""
+Filters to take the noise out of the sensor readings before the thermostat
+sees them.
+
+Each sensor has its own FilterChain.  Every new temp goes through the
+filters in order, one sample at a time, and each filter only keeps a fixed
+amount of state so the memory used never grows.
+
+	OUTLIER		<- Drops a sample that jumps more than MAX_STEP degrees C
+					from the last good one.  After MAX_REJECTS in a row it is
+					taken as a real change.
+	MEDIAN		<- The median of the last SIZE samples
+	EMA			<- Exponential moving average.  ALPHA for a fixed weight, or
+					TIME_CONSTANT in seconds so it works the same however
+					often the sensor is read.
+
+The SENSOR_FILTERS setting has the chain for each sensor location, or
+DEFAULT for every sensor that isn't named:
+	"DEFAULT": [{"TYPE": "OUTLIER", "MAX_STEP": 2.0}, {"TYPE": "MEDIAN", "SIZE": 3}]
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+import math
+from bisect import insort, bisect_left
+from collections import deque
+
+from utils import camelCase
+
+LOGGER = logging.getLogger("__main__.filters.py")
+
+class MedianFilter:
+	"""
+	The median of the last size samples
+	"""
+	def __init__(self, size=3):
+		if size < 1:
+			raise ValueError("size must be at least 1")
+		self.size = size
+		self.reset()
+
+	def reset(self):
+		self.window = deque()
+		# The same samples kept in order so the median is in the middle
+		self.ordered = []
+
+	def update(self, value, timestamp=None):
+		self.window.append(value)
+		insort(self.ordered, value)
+		if len(self.window) > self.size:
+			del self.ordered[bisect_left(self.ordered, self.window.popleft())]
+		middle = len(self.ordered) // 2
+		if len(self.ordered) % 2:
+			return self.ordered[middle]
+		return (self.ordered[middle - 1] + self.ordered[middle]) / 2
+
+class EMAFilter:
+	"""
+	Exponential moving average
+	"""
+	def __init__(self, alpha=0.5, timeConstant=None):
+		"""
+		<optional> alpha => Weight of each new sample, 0 to 1
+
+		<optional> timeConstant => Seconds to average over.  If given, the
+			weight comes from the time since the last sample instead of alpha.
+		"""
+		if not 0 < alpha <= 1:
+			raise ValueError("alpha must be more than 0 and at most 1")
+		self.alpha = alpha
+		self.timeConstant = timeConstant
+		self.reset()
+
+	def reset(self):
+		self.value = None
+		self.timestamp = None
+
+	def update(self, value, timestamp=None):
+		if self.value is None:
+			self.value = value
+		else:
+			alpha = self.alpha
+			if self.timeConstant and timestamp is not None and self.timestamp is not None:
+				alpha = 1 - math.exp(-max(0, timestamp - self.timestamp) / self.timeConstant)
+			self.value += alpha * (value - self.value)
+		self.timestamp = timestamp
+		return self.value
+
+class OutlierFilter:
+	"""
+	Drops samples that jump too far from the last good one
+	"""
+	def __init__(self, maxStep=2.0, maxRejects=3):
+		"""
+		<optional> maxStep => The most, in degrees C, a sample can be from the
+			last good one
+
+		<optional> maxRejects => Samples in a row to drop before the jump is
+			believed
+		"""
+		self.maxStep = maxStep
+		self.maxRejects = maxRejects
+		self.reset()
+
+	def reset(self):
+		self.last = None
+		self.rejects = 0
+		self.rejected = 0
+
+	def update(self, value, timestamp=None):
+		if self.last is not None and abs(value - self.last) > self.maxStep and self.rejects < self.maxRejects:
+			self.rejects += 1
+			self.rejected += 1
+			return None
+		self.rejects = 0
+		self.last = value
+		return value
+
+FILTER_TYPES = {
+	"MEDIAN": MedianFilter,
+	"EMA": EMAFilter,
+	"OUTLIER": OutlierFilter,
+	}
+
+class FilterChain:
+	"""
+	Runs a sample through a list of filters
+	"""
+	def __init__(self, filters=None):
+		self.filters = list(filters or [])
+
+	def __len__(self):
+		return len(self.filters)
+
+	def reset(self):
+		for stage in self.filters:
+			stage.reset()
+
+	def update(self, value, timestamp=None):
+		"""
+		Returns the filtered value, or None if a filter dropped the sample
+		"""
+		for stage in self.filters:
+			value = stage.update(value, timestamp)
+			if value is None:
+				return None
+		return value
+
+def makeFilter(settings):
+	"""
+	settings => {"TYPE": "MEDIAN", "SIZE": 3}  Everything but TYPE is passed
+		on to the filter, MAX_STEP as maxStep and so on.
+	"""
+	settings = dict(settings)
+	kind = settings.pop("TYPE").upper()
+	if kind not in FILTER_TYPES:
+		raise KeyError("No filter type {}".format(kind))
+	return FILTER_TYPES[kind](**{camelCase(key): value for key, value in settings.items()})
+
+def makeFilterChain(settings):
+	"""
+	settings => A list of filter settings for makeFilter
+	"""
+	return FilterChain([makeFilter(stage) for stage in settings or []])
@@ -0,0 +1,351 @@
+"""
+A compact history of every reading and state change, kept on disk.
+
+Every sensor sample and every HVAC / Thermostat state change is appended to
+a file of fixed size binary records, 16 bytes each.  The samples are also
+rolled up into 1 minute and 1 hour records with the count, mean, min and max
+so long ranges don't need every sample.  Reading uses mmap and a binary
+search on the time, so nothing is parsed and only the pages in the range are
+read from the SD card.
+
+The files in the history directory are:
+	channels.json		<- {name: number} so each record only stores a number
+	raw.bin				<- (time, channel, kind, value) for every sample and change
+	1m.bin, 1h.bin		<- (start time, channel, count, mean, min, max)
+
+At 15 second reads each sensor takes about 92kB a day raw, 34kB a day in the
+1 minute rollup and under 1kB a day in the 1 hour rollup.  Old raw and
+1 minute records can be dropped with prune().
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+import json
+import math
+import mmap
+import os
+import struct
+from pathlib import Path
+
+from thermostat import MODE, STATES
+
+LOGGER = logging.getLogger("__main__.historylog.py")
+
+# time, channel, kind, pad, value
+RECORD = struct.Struct("<dHBxf")
+# bucket start time, channel, count, mean, min, max
+ROLLUP = struct.Struct("<dHHfff")
+
+# Record kinds
+SAMPLE = 0
+TRANSITION = 1
+
+# A state change is stored as its place in this list.  The AUTO state and
+# mode share a place, so the places are the same as before there was one.
+TRANSITION_STATES = list(dict.fromkeys(STATES + MODE))
+
+# (name, seconds) of each rollup
+ROLLUPS = (("1m", 60), ("1h", 3600))
+
+class RecordFile:
+	"""
+	An append only file of fixed size records, read back with mmap
+	"""
+	def __init__(self, path, record):
+		"""
+		path => The file
+
+		record => The struct.Struct for each record.  The first field must be
+			the time.
+		"""
+		self.LOGGER = logging.getLogger("__main__.historylog.RecordFile")
+
+		self.path = Path(path)
+		self.record = record
+		self._file = None
+
+	def open(self):
+		if self._file is None:
+			self._file = open(self.path, "ab")
+			# Drop half a record left by a crash so the rest stay lined up
+			extra = self._file.tell() % self.record.size
+			if extra:
+				self.LOGGER.warning("Dropping {} bytes from the end of {}".format(extra, self.path))
+				self._file.truncate(self._file.tell() - extra)
+				self._file.seek(0, os.SEEK_END)
+
+	def append(self, *values):
+		self.open()
+		self._file.write(self.record.pack(*values))
+
+	def flush(self):
+		if self._file:
+			self._file.flush()
+
+	def close(self):
+		if self._file:
+			self._file.close()
+			self._file = None
+
+	def __len__(self):
+		self.flush()
+		try:
+			return self.path.stat().st_size // self.record.size
+		except FileNotFoundError:
+			return 0
+
+	def _search(self, view, count, when):
+		"""
+		Returns the index of the first record at or after when
+		"""
+		low, high = 0, count
+		while low < high:
+			middle = (low + high) // 2
+			if struct.unpack_from("<d", view, middle * self.record.size)[0] < when:
+				low = middle + 1
+			else:
+				high = middle
+		return low
+
+	def read(self, start=None, end=None):
+		"""
+		Returns a list of every record with start <= time < end
+		"""
+		count = len(self)
+		if not count:
+			return []
+		with open(self.path, "rb") as f:
+			with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+				first = 0 if start is None else self._search(view, count, start)
+				last = count if end is None else self._search(view, count, end)
+				if first >= last:
+					return []
+				return list(self.record.iter_unpack(view[first * self.record.size:last * self.record.size]))
+
+	def prune(self, before):
+		"""
+		Drop every record older than before.  The file is rewritten.
+
+		Returns the number of records dropped
+		"""
+		count = len(self)
+		if not count:
+			return 0
+		self.close()
+		with open(self.path, "rb") as f:
+			with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+				first = self._search(view, count, before)
+				if not first:
+					return 0
+				temp = self.path.with_suffix(".tmp")
+				with open(temp, "wb") as out:
+					out.write(view[first * self.record.size:count * self.record.size])
+		os.replace(temp, self.path)
+		self.LOGGER.info("Dropped {} records from {}".format(first, self.path))
+		return first
+
+class Rollup:
+	"""
+	Keeps the count, total, min and max for each channel in the current
+	bucket and writes them out when the bucket is over.
+
+	Every channel's bucket is written as soon as any channel gets a sample
+	for a later bucket, so the file stays in time order for the binary
+	search even when a sensor goes quiet.
+	"""
+	def __init__(self, records, seconds):
+		"""
+		records => The RecordFile to write to
+
+		seconds => Length of each bucket
+		"""
+		self.records = records
+		self.seconds = seconds
+		# {channel: [bucket start, count, total, min, max]}
+		self.buckets = {}
+		# Start of the newest bucket
+		self.current = None
+
+	def add(self, channel, value, timestamp):
+		start = timestamp - timestamp % self.seconds
+		if self.current is None or start > self.current:
+			self.flush(start)
+			self.current = start
+		elif start < self.current:
+			# Its bucket may be written already.  It is counted in the current
+			# one so nothing is written out of order.
+			start = self.current
+		bucket = self.buckets.get(channel)
+		if bucket is None:
+			self.buckets[channel] = [start, 1, value, value, value]
+			return
+		bucket[1] += 1
+		bucket[2] += value
+		if value < bucket[3]:
+			bucket[3] = value
+		if value > bucket[4]:
+			bucket[4] = value
+
+	def flush(self, before):
+		"""
+		Write out every bucket that started before before
+		"""
+		for channel, bucket in list(self.buckets.items()):
+			if bucket[0] < before:
+				self.write(channel, bucket)
+				del self.buckets[channel]
+
+	def write(self, channel, bucket):
+		start, count, total, low, high = bucket
+		self.records.append(start, channel, min(count, 0xFFFF), total / count, low, high)
+
+	def close(self):
+		"""
+		Write out the buckets that aren't over yet.  read() merges them with
+		the rest of the bucket after a restart.
+		"""
+		for channel, bucket in self.buckets.items():
+			self.write(channel, bucket)
+		self.buckets = {}
+
+class HistoryLog:
+	"""
+	The readings and state changes for every sensor and device, by name
+	"""
+	def __init__(self, directory):
+		"""
+		directory => Where to keep the files.  Made if it doesn't exist.
+		"""
+		self.LOGGER = logging.getLogger("__main__.historylog.HistoryLog")
+
+		self.directory = Path(directory)
+		os.makedirs(self.directory, exist_ok=True)
+
+		self.channelFile = self.directory.joinpath("channels.json")
+		self.channels = {}
+		if self.channelFile.exists():
+			with open(self.channelFile, "r") as channels:
+				self.channels = json.load(channels)
+
+		self.raw = RecordFile(self.directory.joinpath("raw.bin"), RECORD)
+		self.rollups = {name: Rollup(RecordFile(self.directory.joinpath("{}.bin".format(name)), ROLLUP), seconds) for name, seconds in ROLLUPS}
+
+	def channel(self, name):
+		"""
+		Returns the number for a channel name, adding it if it is new
+		"""
+		name = name.upper()
+		if name not in self.channels:
+			self.channels[name] = len(self.channels)
+			with open(self.channelFile, "w") as channels:
+				json.dump(self.channels, channels, indent=2)
+		return self.channels[name]
+
+	def addSample(self, name, value, timestamp):
+		"""
+		name => The sensor location
+
+		value => The temp.  Samples with no temp are skipped.
+
+		timestamp => Time of the sample in seconds since the epoch
+		"""
+		if value is None or math.isnan(value):
+			return
+		channel = self.channel(name)
+		self.raw.append(timestamp, channel, SAMPLE, value)
+		for rollup in self.rollups.values():
+			rollup.add(channel, value, timestamp)
+
+	def addTransition(self, name, state, timestamp):
+		"""
+		name => What changed, like "HVAC" or "THERMOSTAT"
+
+		state => The new state, one of TRANSITION_STATES
+
+		timestamp => Time of the change in seconds since the epoch
+		"""
+		self.raw.append(timestamp, self.channel(name), TRANSITION, TRANSITION_STATES.index(state))
+		self.flush()
+
+	def addSnapshot(self, snapshot, sensors):
+		"""
+		Add one read of the board.  Can be used as an AcquisitionEngine listener
+		with functools.partial.
+
+		snapshot => <dict> {location: acquisition.Sample}
+
+		sensors => <dict> {location: TempSensor} to get the converted temps from
+		"""
+		for location, sample in snapshot.items():
+			sensor = sensors.get(location)
+			if sensor is not None:
+				self.addSample(location, sensor.tempC, sample.timestamp)
+		self.flush()
+
+	def flush(self):
+		self.raw.flush()
+		for rollup in self.rollups.values():
+			rollup.records.flush()
+
+	def close(self):
+		for rollup in self.rollups.values():
+			rollup.close()
+			rollup.records.close()
+		self.raw.close()
+
+	def samples(self, name, start=None, end=None):
+		"""
+		Returns [(time, temp)] for a sensor with start <= time < end
+		"""
+		channel = self.channels.get(name.upper())
+		return [(when, value) for when, number, kind, value in self.raw.read(start, end) if number == channel and kind == SAMPLE]
+
+	def transitions(self, name, start=None, end=None):
+		"""
+		Returns [(time, state)] for everything name changed to between start and end
+		"""
+		channel = self.channels.get(name.upper())
+		return [(when, TRANSITION_STATES[int(value)]) for when, number, kind, value in self.raw.read(start, end) if number == channel and kind == TRANSITION]
+
+	def summary(self, name, start=None, end=None, resolution="1m"):
+		"""
+		Returns [(bucket start, count, mean, min, max)] for a sensor
+
+		<optional> resolution => "1m" or "1h"
+		"""
+		channel = self.channels.get(name.upper())
+		rollup = self.rollups[resolution]
+		# The bucket being filled hasn't been written yet
+		self.flush()
+		records = rollup.records.read(start, end)
+		if channel in rollup.buckets:
+			bucket = rollup.buckets[channel]
+			if (start is None or bucket[0] >= start) and (end is None or bucket[0] < end):
+				records.append((bucket[0], channel, bucket[1], bucket[2] / bucket[1], bucket[3], bucket[4]))
+
+		# A bucket can be split in two by a restart, put it back together
+		buckets = {}
+		for when, number, count, mean, low, high in records:
+			if number != channel:
+				continue
+			if when in buckets:
+				old = buckets[when]
+				total = old[1] * old[2] + count * mean
+				count += old[1]
+				buckets[when] = (when, count, total / count, min(low, old[3]), max(high, old[4]))
+			else:
+				buckets[when] = (when, count, mean, low, high)
+		return list(buckets.values())
+
+	def prune(self, rawBefore=None, minuteBefore=None):
+		"""
+		Drop raw records older than rawBefore and 1 minute records older than
+		minuteBefore.  The 1 hour records are kept.
+		"""
+		if rawBefore is not None:
+			self.raw.prune(rawBefore)
+		if minuteBefore is not None:
+			self.rollups["1m"].records.prune(minuteBefore)
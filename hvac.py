@@ -13,6 +13,61 @@ class HVAC:
 		self._coolControl = ()
 		self._state = "OFF"
 
+		self.listeners = []
+
+	def addListener(self, callback):
+		"""
+		callback => Called as callback(hvac, old state, new state) when the state changes
+		"""
+		self.listeners.append(callback)
+
+	def loadSettings(self, settings):
+		"""
+		Set the control pins from the config
+
+		settings => The config with HVAC.CONTROL_PINS
+		"""
+		pins = settings["HVAC"]["CONTROL_PINS"]
+		self.heatControl = (pins["HEAT_ON"], pins["HEAT_OFF"], pins["HEAT_SENSE"])
+		self.coolControl = (pins["COOL_ON"], pins["COOL_OFF"], pins["COOL_SENSE"])
+
+	async def turnOnOff(self, core, heatCool, onOff):
+		"""
+		Pulse the latching relay to turn the heat or A/C on or off
+
+		core => The asyncio board interface, PyMata3().core
+
+		heatCool => Either the heater or A/C
+			Valid entrys -- "heat"  "cool"
+
+		onOff => Turn the HVAC on or off
+			Valid entrys -- "on"  "off"
+		"""
+		self.LOGGER.debug("in turnOnOff: %s  %s", heatCool, onOff)
+		if heatCool.upper() == "HEAT":
+			hc = self.heatControl
+		elif heatCool.upper() == "COOL":
+			hc = self.coolControl
+		else:
+			raise AttributeError("Only 'heat' and 'cool' are valid attributes")
+
+		if onOff.upper() == "ON":
+			pin = hc[0]
+		elif onOff.upper() == "OFF":
+			pin = hc[1]
+		else:
+			raise AttributeError("Only 'on' or 'off' are valid attributes")
+
+		if onOff.upper() == "OFF":
+			self.state = "OFF"
+		else:
+			self.state = heatCool.upper()
+
+		await core.digital_write(pin, 1)
+		await core.sleep(0.1)
+		await core.digital_write(pin, 0)
+		await core.sleep(0.1)
+
 	@property
 	def heatControl(self):
 		return self._heatControl
@@ -47,11 +102,15 @@ class HVAC:
 
 	@state.setter
 	def state(self, state):
+		old = self._state
 		if state in STATES:
 			self._state = state
 		else:
 			self._state = "OFF"
 		self.LOGGER.info("HVAC state set to {}".format(self.state))
+		if self._state != old:
+			for callback in self.listeners:
+				callback(self, old, self._state)
 
 	#def setHeatState(self):
 		#if self.state == "OFF":
@@ -0,0 +1,124 @@
+"""
+Logging that doesn't write to the SD card from the control loop.
+
+The loggers only put each record on a queue.  A thread takes them off, does
+the formatting and writes them to a log file that is rotated when it gets
+to maxBytes, keeping backupCount old files:
+
+	thermostat.log, thermostat.log.1, ... thermostat.log.<backupCount>
+
+If the queue fills up because the card is stuck, records are dropped and
+counted instead of holding up the loop.
+
+Worker processes forked from the control process get their own thread and
+write to the same file, but only the control process rotates it.
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+import logging.handlers
+import os
+import queue
+
+LOGGER = logging.getLogger("__main__.logqueue.py")
+
+class _QueueHandler(logging.handlers.QueueHandler):
+	"""
+	Puts the record on the queue as it is.  The message is formatted by the
+	thread, not by the caller like logging.handlers.QueueHandler does.
+	"""
+	def __init__(self, recordQueue):
+		super().__init__(recordQueue)
+		self.dropped = 0
+
+	def prepare(self, record):
+		return record
+
+	def enqueue(self, record):
+		try:
+			self.queue.put_nowait(record)
+		except queue.Full:
+			self.dropped += 1
+
+class QueuedLogging:
+	"""
+	Sends a logger's records through a queue to a rotating log file and any
+	other handlers, written by a background thread
+	"""
+	def __init__(self, logger, path, maxBytes=1048576, backupCount=5, queueSize=10000, formatter=None):
+		"""
+		logger => The logger to send through the queue, usually the "__main__" one
+
+		path => The log file
+
+		<optional> maxBytes => Size the log file is rotated at.  0 never rotates.
+
+		<optional> backupCount => Old log files to keep
+
+		<optional> queueSize => Records waiting to be written before new ones
+			are dropped
+
+		<optional> formatter => The logging.Formatter for the log file
+		"""
+		self.logger = logger
+		self.queue = queue.Queue(queueSize)
+		self.fileHandler = logging.handlers.RotatingFileHandler(path, maxBytes=maxBytes, backupCount=backupCount, delay=True)
+		if formatter:
+			self.fileHandler.setFormatter(formatter)
+		self.handlers = [self.fileHandler]
+		self.queueHandler = _QueueHandler(self.queue)
+		self.listener = None
+
+		logger.addHandler(self.queueHandler)
+		os.register_at_fork(after_in_child=self._afterFork)
+
+	@property
+	def dropped(self):
+		return self.queueHandler.dropped
+
+	def addHandler(self, handler):
+		"""
+		Write to another handler from the thread too, like the console
+		"""
+		self.handlers.append(handler)
+		if self.listener:
+			self.listener.handlers = tuple(self.handlers)
+
+	def rollover(self):
+		"""
+		Start a new log file, moving the old ones along
+		"""
+		if os.path.exists(self.fileHandler.baseFilename) and os.path.getsize(self.fileHandler.baseFilename):
+			self.fileHandler.doRollover()
+
+	def start(self):
+		if self.listener is None:
+			# Each handler checks its own level
+			self.listener = logging.handlers.QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+			self.listener.start()
+
+	def stop(self):
+		"""
+		Write what is left on the queue and stop the thread
+		"""
+		if self.listener:
+			self.listener.stop()
+			self.listener = None
+		if self.dropped:
+			self.fileHandler.handle(logging.makeLogRecord({"name": LOGGER.name, "levelno": logging.WARNING, "levelname": "WARNING", "msg": "Dropped {} log records".format(self.dropped)}))
+		for handler in self.handlers:
+			handler.close()
+
+	def _afterFork(self):
+		# The thread didn't come along with the fork, and the queue may hold
+		# records the parent is writing
+		if self.listener is None:
+			return
+		self.queue = queue.Queue(self.queue.maxsize)
+		self.queueHandler.queue = self.queue
+		self.fileHandler.maxBytes = 0
+		self.listener = None
+		self.start()
@@ -25,6 +25,7 @@ import json
 from pathlib import Path
 import argparse
 import sys
+import time
 
 # Set up the parser
 parser = argparse.ArgumentParser()
@@ -74,18 +75,10 @@ try:
 except ModuleNotFoundError as e:
 	LOGGER.error(e)
 
-# paho-mqtt is optional, but recommended for ease of communication
-try:
-	import paho.mqtt.client as mqtt
-	import paho.mqtt.publish as mqtt_pub
-	MQTT_ENABLED = True
-except ModuleNotFoundError:
-	MQTT_ENABLED = False
-	LOGGER.warning("Package paho-mqtt is not installed.  MQTT communication will be disabled")
-
 # Import local libraries
 import thermostat
 from sensors import TempSensor
+from acquisition import Sample
 
 # Override with user settings
 try:
@@ -121,28 +114,42 @@ THERMOSTAT.addSensorToGroup("house", THERMOSTAT.tempSensors["HALLWAY"])
 THERMOSTAT.addSensorToGroup("house", THERMOSTAT.tempSensors["MASTERBED"])
 THERMOSTAT.addSensorToGroup("house", THERMOSTAT.tempSensors["LIVINGROOM"])
 	
+# Read every sensor once.  Everything below uses these readings.
+THERMOSTAT.ttl = SETTINGS.get("READING_TTL")
+THERMOSTAT.updateReadings({location: Sample(location, sensor.controlPin, board.analog_read(sensor.controlPin), time.time()) for location, sensor in THERMOSTAT.tempSensors.items()})
+
 def publishTemp():
-	baseTopic = "ziggy/house/climate/temp/"
-	for location, sensor in THERMOSTAT.tempSensors.items():
-		# Get the value from the sensor
-		temp = str(round(THERMOSTAT.getTemp(location)))
-		topic = baseTopic + location.lower()
-		mqtt_pub.single(topic, temp, hostname="ziggyhome.mooo.com", port=8884, auth={"username": "ziggy", "password": "ziggy"}, qos=1, retain=True)
+	# Send every sensor in one batch over the one connection
+	readings = {}
+	for location in THERMOSTAT.tempSensors:
+		temp = THERMOSTAT.getTemp(location)
+		if temp is not None:
+			readings[location.lower()] = round(temp)
+	MQTT_PUBLISHER.publish(readings)
 	LOGGER.debug("Published main temp of {}".format(mainTemp))
 	print("Published main temp of {}".format(mainTemp))
-		
-mainTemp = (THERMOSTAT.getTemp("house"))
-		
-LOGGER.info("Temp in {} is {}\xB0".format("house", mainTemp))
+
+mainReading = THERMOSTAT.getReading("house")
+mainTemp = mainReading.temp
+
+LOGGER.info("Temp in {} is {}\xB0 from {} of {} sensors".format("house", mainTemp, mainReading.count, mainReading.total))
 print("mainTemp:  " + str(mainTemp))
 for sensor in THERMOSTAT.tempSensors:
   print(sensor + ":  " + str(THERMOSTAT.getTemp(sensor)))
 
+MQTT = SETTINGS["MQTT"]
+MQTT_ENABLED = False
+if MQTT["ENABLED"]:
+	# paho-mqtt is optional, only load it when it is going to be used
+	from publisher import MQTTPublisher, MQTT_ENABLED
 if MQTT_ENABLED:
+	MQTT_PUBLISHER = MQTTPublisher(MQTT["HOSTNAME"], MQTT["PORT"], MQTT["USERNAME"], MQTT["PASSWORD"], MQTT["BASE_TOPIC"], MQTT["QOS"], MQTT["RETAIN"], MQTT["QUEUE_SIZE"], MQTT["TLS"])
+	MQTT_PUBLISHER.start()
 	try:
 		publishTemp()
 	except Exception as e:
 		print(e)
 		LOGGER.error("Something went wrong with publish.  {}".format(e))
+	MQTT_PUBLISHER.stop()
 		
 board.shutdown()
@@ -0,0 +1,305 @@
+"""
+Counters and latency histograms for the control loop and the serial I/O,
+served in the Prometheus text format.
+
+Recording a value only adds to a number or a bucket, so it costs a few
+microseconds.  The text is only made when something asks for /metrics.
+
+	thermostat_analog_read_seconds			<- Histogram of analog_read time per sensor pin
+	thermostat_read_cycle_seconds			<- Histogram of the time to read a whole board
+	thermostat_control_tick_seconds			<- Histogram of the time a control tick takes
+	thermostat_hvac_transitions_total		<- Times each HVAC went into each state
+	thermostat_hvac_state_seconds_total		<- Seconds each HVAC has spent in each state
+	thermostat_hvac_duty_cycle				<- Part of the time, 0 to 1, spent in each state
+	thermostat_relay_pulses_total			<- Relay pulses sent, and the ones that failed
+	thermostat_sensor_age_seconds			<- Seconds since each sensor was last read
+	thermostat_stalest_reading_seconds		<- The oldest of those
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+import time
+from bisect import bisect_left
+
+from hvac import STATES
+from webapi import HTTPServer
+
+LOGGER = logging.getLogger("__main__.metrics.py")
+
+# Upper bounds in seconds.  Firmata over serial takes a few ms a read.
+READ_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+TICK_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def _labelText(names, values):
+	if not names:
+		return ""
+	pairs = ('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in zip(names, values))
+	return "{" + ",".join(pairs) + "}"
+
+def _number(value):
+	if value == float("inf"):
+		return "+Inf"
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+	"""
+	A counter or gauge.  Values are kept for each set of labels.
+	"""
+	kind = "untyped"
+
+	def __init__(self, name, help, labels=(), collect=None):
+		"""
+		name => The metric name
+
+		help => One line about what it is
+
+		<optional> labels => The label names
+
+		<optional> collect => Function returning {label values: value}, asked
+			each time the metrics are made instead of keeping the values here
+		"""
+		self.name = name
+		self.help = help
+		self.labels = tuple(labels)
+		self.collect = collect
+		self.values = {}
+
+	def samples(self):
+		"""
+		Returns [(name, label text, value)]
+		"""
+		values = self.collect() if self.collect else self.values
+		return [(self.name, _labelText(self.labels, key if isinstance(key, tuple) else (key,)), value) for key, value in values.items()]
+
+	def render(self):
+		lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind)]
+		lines.extend("{}{} {}".format(name, labels, _number(value)) for name, labels, value in self.samples())
+		return lines
+
+class Counter(Metric):
+	kind = "counter"
+
+	def inc(self, labels=(), amount=1):
+		self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+	kind = "gauge"
+
+	def set(self, labels=(), value=0):
+		self.values[labels] = value
+
+class Histogram(Metric):
+	kind = "histogram"
+
+	def __init__(self, name, help, labels=(), buckets=READ_BUCKETS):
+		"""
+		<optional> buckets => The upper bound of each bucket, smallest first
+		"""
+		super().__init__(name, help, labels)
+		self.buckets = tuple(buckets)
+
+	def observe(self, labels=(), value=0):
+		# [count in each bucket + the +Inf bucket, sum]
+		data = self.values.get(labels)
+		if data is None:
+			data = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+		data[0][bisect_left(self.buckets, value)] += 1
+		data[1] += value
+
+	def samples(self):
+		samples = []
+		for key, (counts, total) in self.values.items():
+			running = 0
+			for bound, count in zip(self.buckets + (float("inf"),), counts):
+				running += count
+				samples.append((self.name + "_bucket", _labelText(self.labels + ("le",), key + (_number(bound),)), running))
+			samples.append((self.name + "_sum", _labelText(self.labels, key), total))
+			samples.append((self.name + "_count", _labelText(self.labels, key), running))
+		return samples
+
+class Registry:
+	"""
+	Holds every metric and turns them into the text format
+	"""
+	def __init__(self):
+		self.metrics = {}
+
+	def add(self, metric):
+		if metric.name in self.metrics:
+			raise KeyError("There is already a metric {}".format(metric.name))
+		self.metrics[metric.name] = metric
+		return metric
+
+	def counter(self, name, help, labels=(), collect=None):
+		return self.add(Counter(name, help, labels, collect))
+
+	def gauge(self, name, help, labels=(), collect=None):
+		return self.add(Gauge(name, help, labels, collect))
+
+	def histogram(self, name, help, labels=(), buckets=READ_BUCKETS):
+		return self.add(Histogram(name, help, labels, buckets))
+
+	def render(self):
+		"""
+		Returns the metrics as bytes in the Prometheus text format
+		"""
+		lines = []
+		for metric in self.metrics.values():
+			try:
+				lines.extend(metric.render())
+			except Exception as e:
+				LOGGER.error("Could not collect {}.  {!r}".format(metric.name, e))
+		return ("\n".join(lines) + "\n").encode()
+
+class ThermostatMetrics:
+	"""
+	Records the control loop, the sensor reads and the HVAC into a Registry
+	"""
+	def __init__(self, scheduler, registry=None, clock=time.time):
+		"""
+		scheduler => The ControlScheduler.  Its tick time and its thermostat's
+			sensors are recorded.
+
+		<optional> registry => Where to keep the metrics, a new Registry if not given
+
+		<optional> clock => Function returning the current time in seconds
+		"""
+		self.LOGGER = logging.getLogger("__main__.metrics.ThermostatMetrics")
+
+		self.scheduler = scheduler
+		self.thermostat = scheduler.thermostat
+		self.registry = registry or Registry()
+		self.clock = clock
+
+		# {name: [HVAC, state, time it went into that state, {state: seconds before that}]}
+		self.hvacs = {}
+		# {name: RelayQueue}
+		self.relays = {}
+		self.boards = None
+		self.started = clock()
+
+		registry = self.registry
+		self.readTime = registry.histogram("thermostat_analog_read_seconds", "Time analog_read took for one sensor", ("location", "pin"), READ_BUCKETS)
+		self.cycleTime = registry.histogram("thermostat_read_cycle_seconds", "Time to read every sensor on a board", (), READ_BUCKETS)
+		self.tickTime = registry.histogram("thermostat_control_tick_seconds", "Time a control tick took to decide and queue changes", (), TICK_BUCKETS)
+		self.ticks = registry.counter("thermostat_control_ticks_total", "Control ticks run", collect=lambda: {(): scheduler.ticks})
+		self.transitions = registry.counter("thermostat_hvac_transitions_total", "Times an HVAC went into a state", ("hvac", "state"))
+		registry.counter("thermostat_hvac_state_seconds_total", "Seconds an HVAC has spent in each state", ("hvac", "state"), self.stateSeconds)
+		registry.gauge("thermostat_hvac_duty_cycle", "Part of the time an HVAC has spent in each state", ("hvac", "state"), self.dutyCycle)
+		registry.counter("thermostat_relay_pulses_total", "Relay pulses sent", ("hvac", "result"), self.relayPulses)
+		registry.gauge("thermostat_sensor_age_seconds", "Seconds since a sensor was last read", ("location",), self.sensorAges)
+		registry.gauge("thermostat_stalest_reading_seconds", "Seconds since the sensor read longest ago was read", (), self.stalestReading)
+
+		scheduler.addListener(self.recordTick)
+
+	def watchBoards(self, boards):
+		"""
+		boards => The BoardManager.  Every read is recorded.
+		"""
+		self.boards = boards
+		boards.addListener(self.recordSnapshot)
+
+	def watchHVAC(self, name, hvac):
+		"""
+		Count the state changes of an HVAC and the time spent in each state
+		"""
+		self.hvacs[name] = [hvac, hvac.state, self.clock(), {state: 0.0 for state in STATES}]
+		hvac.addListener(lambda device, old, new: self.recordTransition(name, old, new))
+
+	def watchRelays(self, name, relays):
+		"""
+		Count the pulses sent by a RelayQueue.  Its HVAC is watched too.
+		"""
+		self.relays[name] = relays
+		self.watchHVAC(name, relays.hvac)
+
+	def recordSnapshot(self, snapshot):
+		for sample in snapshot.values():
+			if sample.latency is not None:
+				self.readTime.observe((sample.location, sample.pin), sample.latency)
+		# The engine that read it has already kept it as its lastSnapshot
+		for engine in self.engines():
+			if engine.lastSnapshot is snapshot and engine.lastCycleTime is not None:
+				self.cycleTime.observe((), engine.lastCycleTime)
+				break
+
+	def engines(self):
+		return self.boards.engines.values() if self.boards is not None else ()
+
+	def recordTick(self, scheduler, zones):
+		if scheduler.lastTickTime is not None:
+			self.tickTime.observe((), scheduler.lastTickTime)
+
+	def recordTransition(self, name, old, new):
+		watched = self.hvacs[name]
+		now = self.clock()
+		watched[3][watched[1]] = watched[3].get(watched[1], 0.0) + now - watched[2]
+		watched[1] = new
+		watched[2] = now
+		self.transitions.inc((name, new))
+
+	def stateSeconds(self):
+		now = self.clock()
+		seconds = {}
+		for name, (hvac, state, since, totals) in self.hvacs.items():
+			for total, value in totals.items():
+				seconds[(name, total)] = value + (now - since if total == state else 0.0)
+		return seconds
+
+	def dutyCycle(self):
+		seconds = self.stateSeconds()
+		totals = {}
+		for (name, state), value in seconds.items():
+			totals[name] = totals.get(name, 0.0) + value
+		return {key: value / totals[key[0]] if totals[key[0]] else 0.0 for key, value in seconds.items()}
+
+	def relayPulses(self):
+		pulses = {}
+		for name, relays in self.relays.items():
+			pulses[(name, "sent")] = relays.pulses
+			pulses[(name, "failed")] = relays.failures
+		return pulses
+
+	def sensorAges(self):
+		now = self.clock()
+		return {location: now - sensor.timestamp for location, sensor in self.thermostat.tempSensors.items() if sensor.timestamp is not None}
+
+	def stalestReading(self):
+		now = self.clock()
+		timestamps = [sensor.timestamp for sensor in self.thermostat.tempSensors.values()]
+		if not timestamps:
+			return {}
+		if None in timestamps:
+			# A sensor that was never read is as old as the program
+			return {(): now - self.started}
+		return {(): now - min(timestamps)}
+
+class MetricsServer(HTTPServer):
+	"""
+	Serves GET /metrics for Prometheus.  Anything else gets a 404.
+	"""
+	name = "Metrics"
+
+	def __init__(self, registry, host="127.0.0.1", port=9108, timeout=10):
+		"""
+		registry => The Registry to serve
+
+		<optional> host, port => Where to listen.  Only this machine by default.
+
+		<optional> timeout => Seconds to wait for the request
+		"""
+		super().__init__(host, port, idleTimeout=timeout)
+		self.LOGGER = logging.getLogger("__main__.metrics.MetricsServer")
+
+		self.registry = registry
+		self.scrapes = 0
+		self.routes = {("GET", "/metrics"): self.getMetrics}
+
+	async def getMetrics(self, writer, query, headers, body):
+		self.scrapes += 1
+		await self.respond(writer, 200, self.registry.render(), contentType=CONTENT_TYPE)
@@ -0,0 +1,294 @@
+"""
+Work out if anyone is home, and switch the temp program between the HOME and
+AWAY named settings.
+
+Each probe answers "is someone here?":
+
+	PING		<- A phone or laptop answers a ping on the WiFi
+	BLUETOOTH	<- A phone answers l2ping
+	MOTION		<- A motion detector on a board pin went off in the last HOLD seconds
+
+The probes run at the same time, each with its own timeout, and their
+answers are kept for INTERVAL seconds.  A probe that times out or fails is
+tried again later and later, up to MAX_BACKOFF seconds, and doesn't count
+either way while it has no answer.  Someone is home when any probe says so.
+The state only changes to AWAY after nobody has been home for AWAY_DELAY
+seconds, and to HOME after someone has been for HOME_DELAY seconds, so one
+missed ping doesn't turn the heat down.
+
+The probes run in their own task and only use asyncio subprocesses, so a
+control tick never waits on them.
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+import asyncio
+import time
+
+from utils import camelCase
+
+LOGGER = logging.getLogger("__main__.occupancy.py")
+
+HOME = "HOME"
+AWAY = "AWAY"
+
+class CommandProbe:
+	"""
+	Someone is here if a command exits with 0
+	"""
+	def __init__(self, *command):
+		self.command = command
+		self.name = " ".join(command)
+
+	async def check(self):
+		process = await asyncio.create_subprocess_exec(*self.command, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+		try:
+			return await process.wait() == 0
+		except asyncio.CancelledError:
+			# Timed out, don't leave it running
+			if process.returncode is None:
+				process.kill()
+			raise
+
+class PingProbe(CommandProbe):
+	"""
+	Someone is here if host answers a ping
+	"""
+	def __init__(self, host, wait=1):
+		"""
+		host => The name or address of a phone or laptop on the WiFi
+
+		<optional> wait => Seconds ping waits for an answer
+		"""
+		super().__init__("ping", "-c", "1", "-W", str(wait), host)
+		self.name = "ping " + host
+
+class BluetoothProbe(CommandProbe):
+	"""
+	Someone is here if a Bluetooth device answers l2ping
+	"""
+	def __init__(self, address, wait=1):
+		"""
+		address => The Bluetooth address of a phone
+
+		<optional> wait => Seconds l2ping waits for an answer
+		"""
+		super().__init__("l2ping", "-c", "1", "-t", str(wait), address)
+		self.name = "bluetooth " + address
+
+class MotionProbe:
+	"""
+	Someone is here if a motion detector went off in the last hold seconds
+	"""
+	def __init__(self, pin, board=None, hold=1800, clock=time.time):
+		"""
+		pin => The digital pin the motion detector is on
+
+		<optional> board => The board the pin is on, the first one if not given
+
+		<optional> hold => Seconds after the last motion that someone is still here
+
+		<optional> clock => Function returning the current time in seconds
+		"""
+		self.pin = pin
+		self.board = board
+		self.hold = hold
+		self.clock = clock
+		self.name = "motion {}".format(pin)
+		self.lastMotion = None
+
+	async def attach(self, boards):
+		"""
+		Watch the pin.  Called by OccupancyMonitor.run.
+
+		boards => The BoardManager
+		"""
+		from pymata_aio.constants import Constants
+		await boards.setPinMode(self.board, self.pin, Constants.INPUT, self.motionChanged)
+
+	def motionChanged(self, data):
+		"""
+		The callback for the pin.  pymata calls it as callback([pin, value, ...])
+		"""
+		if data[1]:
+			self.lastMotion = self.clock()
+
+	async def check(self):
+		return self.lastMotion is not None and self.clock() - self.lastMotion < self.hold
+
+PROBE_TYPES = {
+	"PING": PingProbe,
+	"BLUETOOTH": BluetoothProbe,
+	"MOTION": MotionProbe,
+	}
+
+def makeProbe(settings):
+	"""
+	settings => {"TYPE": "PING", "HOST": "phone.lan"}  Everything but TYPE is
+		passed on to the probe, HOLD as hold and so on.
+	"""
+	settings = dict(settings)
+	kind = settings.pop("TYPE").upper()
+	if kind not in PROBE_TYPES:
+		raise KeyError("No probe type {}".format(kind))
+	return PROBE_TYPES[kind](**{camelCase(key): value for key, value in settings.items()})
+
+class _ProbeState:
+	"""
+	The cached answer of one probe and when to ask it again
+	"""
+	def __init__(self, probe):
+		self.probe = probe
+		self.result = None
+		self.checked = None
+		self.nextCheck = 0
+		self.failures = 0
+
+class OccupancyMonitor:
+	"""
+	Runs the probes and keeps the HOME / AWAY state
+	"""
+	def __init__(self, probes, interval=60, timeout=5, maxBackoff=900, awayDelay=900, homeDelay=0, maxConcurrent=16, clock=time.time):
+		"""
+		probes => The probes, anything with an async check() that returns True
+			when someone is here
+
+		<optional> interval => Seconds an answer is kept before asking again
+
+		<optional> timeout => Seconds each probe gets to answer
+
+		<optional> maxBackoff => The longest wait before trying a failing probe again
+
+		<optional> awayDelay => Seconds nobody has to be home before going AWAY
+
+		<optional> homeDelay => Seconds someone has to be home before going HOME
+
+		<optional> maxConcurrent => The most probes running at once
+
+		<optional> clock => Function returning the current time in seconds
+		"""
+		self.LOGGER = logging.getLogger("__main__.occupancy.OccupancyMonitor")
+
+		self.probes = [_ProbeState(probe) for probe in probes]
+		self.interval = interval
+		self.timeout = timeout
+		self.maxBackoff = maxBackoff
+		self.awayDelay = awayDelay
+		self.homeDelay = homeDelay
+		self.maxConcurrent = maxConcurrent
+		self.clock = clock
+
+		# HOME, AWAY, or None until it is known
+		self.state = None
+		# The state the probes say, and since when
+		self.seen = None
+		self.seenSince = None
+
+		self.checks = 0
+		self.failures = 0
+		self.listeners = []
+		self._limit = None
+
+	def addListener(self, callback):
+		"""
+		callback => Called as callback(monitor, state) when the state changes
+		"""
+		self.listeners.append(callback)
+
+	async def checkProbe(self, state):
+		"""
+		Ask one probe, keeping its answer or backing off if it fails
+		"""
+		async with self._limit:
+			now = self.clock()
+			self.checks += 1
+			try:
+				state.result = bool(await asyncio.wait_for(state.probe.check(), self.timeout))
+			except Exception as e:
+				state.failures += 1
+				self.failures += 1
+				wait = min(self.interval * 2 ** state.failures, self.maxBackoff)
+				state.nextCheck = now + wait
+				self.LOGGER.debug("Probe %s failed %s in a row, trying again in %ss.  %r", state.probe.name, state.failures, wait, e)
+				return
+			state.failures = 0
+			state.checked = now
+			state.nextCheck = now + self.interval
+
+	def someoneHome(self):
+		"""
+		Returns True if a probe says someone is here, False if the probes say
+		nobody is, or None if no probe has a fresh answer
+		"""
+		now = self.clock()
+		answers = [state.result for state in self.probes if state.checked is not None and now - state.checked <= self.interval + self.timeout]
+		if not answers:
+			return None
+		return any(answers)
+
+	def update(self):
+		"""
+		Work out the state from the probes.  Returns True if it changed.
+		"""
+		home = self.someoneHome()
+		if home is None:
+			return False
+		now = self.clock()
+		seen = HOME if home else AWAY
+		if seen != self.seen:
+			self.seen = seen
+			self.seenSince = now
+		delay = self.homeDelay if seen == HOME else self.awayDelay
+		# Start out with what the probes say
+		if seen == self.state or (self.state is not None and now - self.seenSince < delay):
+			return False
+		self.LOGGER.info("Occupancy changed from {} to {}".format(self.state, seen))
+		self.state = seen
+		for callback in self.listeners:
+			try:
+				callback(self, seen)
+			except Exception as e:
+				self.LOGGER.error("Occupancy listener failed.  {}".format(e))
+		return True
+
+	async def check(self):
+		"""
+		Ask every probe that is due, all at once, then update the state
+		"""
+		if self._limit is None:
+			self._limit = asyncio.Semaphore(self.maxConcurrent)
+		now = self.clock()
+		due = [state for state in self.probes if now >= state.nextCheck]
+		if due:
+			await asyncio.gather(*[self.checkProbe(state) for state in due])
+		return self.update()
+
+	async def run(self, boards=None):
+		"""
+		Check the probes until cancelled
+
+		<optional> boards => The BoardManager, for probes on a board pin
+		"""
+		for state in self.probes:
+			if hasattr(state.probe, "attach"):
+				await state.probe.attach(boards)
+		while True:
+			await self.check()
+			now = self.clock()
+			wait = min((state.nextCheck for state in self.probes), default=now + self.interval) - now
+			# Wake up in time to go AWAY when the delay is up
+			await asyncio.sleep(max(1, min(wait, self.interval)))
+
+def setOccupancy(scheduler, state):
+	"""
+	Use the named setting for state in every zone's program, and tick the
+	zones so the setpoint changes right away.  Can be used as an
+	OccupancyMonitor listener with functools.partial.
+	"""
+	for zone in scheduler.zones.values():
+		for schedule in zone.schedules.values():
+			schedule.setActive(state if state in schedule.named else None)
+		scheduler.notifyZone(zone)
@@ -0,0 +1,228 @@
+"""
+The outdoor temp and the forecast high and low.
+
+A provider gets the conditions from somewhere:
+
+	SensorProvider		<- A sensor wired to the board like the indoor ones
+	FileProvider		<- A JSON file kept up to date by something else
+	HTTPProvider		<- A JSON document from a URL, like a weather service
+							behind a small proxy
+
+Both the file and the URL hold the same JSON, temps in C and times in seconds
+since the epoch:
+	{"temp": 4.5, "forecast": [[1700000000, 3.0], [1700003600, 2.5], ...]}
+
+OutdoorConditions keeps the last answer and gets a new one in the background
+before it goes stale, so the control loop never waits on a slow provider.
+The daily highs and lows and the hourly forecast are worked out when new
+data comes in, so asking for them is a dict lookup.
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+import asyncio
+import json
+import time
+from datetime import date
+from urllib.request import urlopen
+
+LOGGER = logging.getLogger("__main__.outdoor.py")
+
+class SensorProvider:
+	"""
+	The outdoor temp from a sensor on the board.  There is no forecast.
+	"""
+	# Nothing here waits on I/O, the reading is already in the Thermostat
+	blocking = False
+
+	def __init__(self, thermostat, location):
+		"""
+		thermostat => The Thermostat with the sensor
+
+		location => The sensor location in SENSORS
+		"""
+		self.thermostat = thermostat
+		self.location = location.upper()
+
+	def fetch(self):
+		reading = self.thermostat.getReading(self.location)
+		if reading is None or reading.temp is None:
+			raise ValueError("No reading from sensor {}".format(self.location))
+		return {"temp": reading.temp, "time": reading.timestamp, "forecast": []}
+
+class FileProvider:
+	"""
+	The conditions from a JSON file
+	"""
+	blocking = True
+
+	def __init__(self, path):
+		self.path = path
+
+	def fetch(self):
+		with open(self.path, "r") as conditions:
+			return json.load(conditions)
+
+class HTTPProvider:
+	"""
+	The conditions from a JSON document at a URL
+	"""
+	blocking = True
+
+	def __init__(self, url, timeout=10):
+		"""
+		url => Where to get the JSON
+
+		<optional> timeout => Seconds to wait for an answer
+		"""
+		self.url = url
+		self.timeout = timeout
+
+	def fetch(self):
+		with urlopen(self.url, timeout=self.timeout) as response:
+			return json.loads(response.read().decode())
+
+class OutdoorConditions:
+	"""
+	A cache of the outdoor conditions that refreshes itself in the background
+	"""
+	def __init__(self, provider, ttl=1800, refreshInterval=600, timeout=30, clock=time.time):
+		"""
+		provider => One of the providers above, or anything with fetch()
+
+		<optional> ttl => Seconds the temp is good for.  After that temp is None
+			until a refresh works.
+
+		<optional> refreshInterval => Seconds between refreshes.  Keep it well
+			under ttl so a failed refresh or two doesn't leave it stale.
+
+		<optional> timeout => Seconds a refresh gets before it is given up on
+
+		<optional> clock => Function returning the current time in seconds
+		"""
+		self.LOGGER = logging.getLogger("__main__.outdoor.OutdoorConditions")
+
+		self.provider = provider
+		self.ttl = ttl
+		self.refreshInterval = refreshInterval
+		self.timeout = timeout
+		self.clock = clock
+
+		self._temp = None
+		self.updated = None
+		# {hour since the epoch: temp} from the forecast
+		self.hourly = {}
+		# {date ordinal: (low, high)} from the forecast
+		self.daily = {}
+
+		self.refreshes = 0
+		self.failures = 0
+		self.listeners = []
+
+	def addListener(self, callback):
+		"""
+		callback => Called as callback(conditions) after every refresh that worked
+		"""
+		self.listeners.append(callback)
+
+	@property
+	def temp(self):
+		"""
+		The outdoor temp in C, or None if it is older than ttl
+		"""
+		if self.updated is None or self.clock() - self.updated > self.ttl:
+			return None
+		return self._temp
+
+	def forecast(self, when=None):
+		"""
+		Returns the forecast temp in C for the hour when is in, or None
+		"""
+		when = self.clock() if when is None else when
+		return self.hourly.get(int(when // 3600))
+
+	def highLow(self, when=None):
+		"""
+		Returns the forecast (low, high) in C for the day when is in, or (None, None)
+		"""
+		when = self.clock() if when is None else when
+		return self.daily.get(date.fromtimestamp(when).toordinal(), (None, None))
+
+	def high(self, when=None):
+		return self.highLow(when)[1]
+
+	def low(self, when=None):
+		return self.highLow(when)[0]
+
+	def load(self, conditions):
+		"""
+		Take in what a provider returned and work out the lookups
+		"""
+		temp = conditions.get("temp")
+		if temp is not None:
+			self._temp = float(temp)
+			self.updated = conditions.get("time") or self.clock()
+
+		forecast = conditions.get("forecast") or []
+		if forecast:
+			hourly = {}
+			daily = {}
+			for when, forecastTemp in forecast:
+				forecastTemp = float(forecastTemp)
+				hourly[int(when // 3600)] = forecastTemp
+				day = date.fromtimestamp(when).toordinal()
+				low, high = daily.get(day, (forecastTemp, forecastTemp))
+				daily[day] = (min(low, forecastTemp), max(high, forecastTemp))
+			# Swap them in whole so a lookup never sees half of a refresh
+			self.hourly = hourly
+			self.daily = daily
+
+	async def refresh(self):
+		"""
+		Get new conditions from the provider.  Returns True if it worked.
+		"""
+		try:
+			if self.provider.blocking:
+				loop = asyncio.get_event_loop()
+				conditions = await asyncio.wait_for(loop.run_in_executor(None, self.provider.fetch), self.timeout)
+			else:
+				conditions = self.provider.fetch()
+			self.load(conditions)
+		except Exception as e:
+			self.failures += 1
+			self.LOGGER.warning("Could not get the outdoor conditions.  {!r}".format(e))
+			return False
+		self.refreshes += 1
+		self.LOGGER.debug("Outdoor temp %s low %s high %s", self.temp, *self.highLow())
+		for callback in self.listeners:
+			try:
+				callback(self)
+			except Exception as e:
+				self.LOGGER.error("Outdoor listener failed.  {}".format(e))
+		return True
+
+	async def run(self):
+		"""
+		Refresh every refreshInterval seconds until cancelled
+		"""
+		while True:
+			await self.refresh()
+			await asyncio.sleep(self.refreshInterval)
+
+def makeProvider(settings, thermostat=None):
+	"""
+	Returns the provider from the OUTDOOR settings
+
+	settings => {"PROVIDER": "SENSOR", "SENSOR": "OUTSIDE", "FILE": ..., "URL": ..., "TIMEOUT": 10}
+	"""
+	kind = settings["PROVIDER"].upper()
+	if kind == "SENSOR":
+		return SensorProvider(thermostat, settings["SENSOR"])
+	if kind == "FILE":
+		return FileProvider(settings["FILE"])
+	if kind == "HTTP":
+		return HTTPProvider(settings["URL"], settings.get("TIMEOUT", 10))
+	raise KeyError("No outdoor provider {}".format(kind))
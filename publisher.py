@@ -0,0 +1,174 @@
+"""
+Publish readings to a MQTT broker over one connection that stays open.
+
+Requirements:
+	paho-mqtt => https://github.com/eclipse/paho.mqtt.python
+
+The client connects once and paho keeps it connected in its own thread.  A
+cycle of readings is sent as one batch, values that were already published
+as retained are skipped, and anything published while the broker is down
+waits in a bounded queue until it comes back.
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+import threading
+import time
+from collections import deque
+
+LOGGER = logging.getLogger("__main__.publisher.py")
+
+try:
+	import paho.mqtt.client as mqtt
+	MQTT_ENABLED = True
+except ModuleNotFoundError:
+	MQTT_ENABLED = False
+	LOGGER.warning("Package paho-mqtt is not installed.  MQTT communication will be disabled")
+
+class MQTTPublisher:
+	"""
+	A long lived MQTT connection that publishes batches of readings
+	"""
+	def __init__(self, hostname, port=1883, username=None, password=None, baseTopic="", qos=1, retain=True, queueSize=500, tls=False, client=None):
+		"""
+		hostname => The broker, "localhost" for a broker on the same machine
+
+		<optional> port => Broker port
+
+		<optional> username, password => Login for the broker
+
+		<optional> baseTopic => Put in front of every topic
+
+		<optional> qos, retain => Passed on to every publish
+
+		<optional> queueSize => The most messages to hold while the broker is
+			down.  The oldest are dropped first.
+
+		<optional> tls => Use TLS with the system certificates
+
+		<optional> client => A paho Client, or anything with the same calls.
+			One is made if not given.
+		"""
+		self.LOGGER = logging.getLogger("__main__.publisher.MQTTPublisher")
+
+		self.hostname = hostname
+		self.port = port
+		self.baseTopic = baseTopic
+		self.qos = qos
+		self.retain = retain
+
+		self.queue = deque(maxlen=queueSize)
+		self.lastPayloads = {}
+		self.connected = False
+		self._lock = threading.Lock()
+
+		self.published = 0
+		self.skipped = 0
+		self.dropped = 0
+
+		if client is None:
+			client = mqtt.Client()
+			if username:
+				client.username_pw_set(username, password)
+			if tls:
+				client.tls_set()
+		self.client = client
+		self.client.on_connect = self._onConnect
+		self.client.on_disconnect = self._onDisconnect
+
+	def start(self):
+		"""
+		Connect in the background.  paho keeps trying until the broker answers.
+		"""
+		self.LOGGER.info("Connecting to MQTT broker {}:{}".format(self.hostname, self.port))
+		self.client.connect_async(self.hostname, self.port)
+		self.client.loop_start()
+
+	def stop(self, timeout=5):
+		"""
+		Send what is left in the queue, waiting up to timeout seconds, then disconnect
+		"""
+		deadline = time.monotonic() + timeout
+		while self.queue and time.monotonic() < deadline:
+			if self.connected:
+				self.flush()
+			time.sleep(0.05)
+		if self.queue:
+			self.LOGGER.warning("{} MQTT messages were not sent".format(len(self.queue)))
+		self.client.disconnect()
+		self.client.loop_stop()
+
+	def _onConnect(self, client, userdata, flags, rc):
+		if rc == 0:
+			self.connected = True
+			self.LOGGER.info("Connected to MQTT broker {}".format(self.hostname))
+			self.flush()
+		else:
+			self.LOGGER.error("MQTT broker refused the connection.  {}".format(rc))
+
+	def _onDisconnect(self, client, userdata, rc):
+		self.connected = False
+		if rc != 0:
+			self.LOGGER.warning("Lost the connection to the MQTT broker.  Holding messages until it is back")
+
+	def publish(self, readings):
+		"""
+		Queue a batch of readings and send them if the broker is connected
+
+		readings => <dict> {topic: value}.  baseTopic is put in front of each topic.
+		"""
+		with self._lock:
+			for topic, value in readings.items():
+				topic = self.baseTopic + topic
+				payload = str(value)
+				# Retained values stay on the broker, so don't send the same one twice
+				if self.retain and self.lastPayloads.get(topic) == payload:
+					self.skipped += 1
+					continue
+				if len(self.queue) == self.queue.maxlen:
+					# Full, drop the oldest and make sure it is sent again next time
+					droppedTopic, droppedPayload = self.queue.popleft()
+					if self.lastPayloads.get(droppedTopic) == droppedPayload:
+						del self.lastPayloads[droppedTopic]
+					self.dropped += 1
+				self.queue.append((topic, payload))
+				self.lastPayloads[topic] = payload
+		self.flush()
+
+	def flush(self):
+		"""
+		Send everything in the queue
+		"""
+		with self._lock:
+			while self.queue and self.connected:
+				topic, payload = self.queue[0]
+				info = self.client.publish(topic, payload, qos=self.qos, retain=self.retain)
+				# 0 is MQTT_ERR_SUCCESS
+				if info.rc != 0:
+					self.LOGGER.debug("Publish of %s failed with %s, keeping it for later", topic, info.rc)
+					break
+				self.queue.popleft()
+				self.published += 1
+		self.LOGGER.debug("%s MQTT messages published, %s skipped, %s dropped", self.published, self.skipped, self.dropped)
+
+if __name__ == "__main__":
+	# Send a test batch to a broker, for example a local mosquitto
+	import argparse
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--host", help="Broker hostname", default="localhost")
+	parser.add_argument("--port", help="Broker port", type=int, default=1883)
+	parser.add_argument("--topic", help="Base topic", default="thermostat/test/")
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.DEBUG)
+	publisher = MQTTPublisher(args.host, args.port, baseTopic=args.topic)
+	publisher.start()
+	publisher.publish({"hallway": 20, "masterbed": 21, "livingroom": 22})
+	# The same values again are skipped
+	publisher.publish({"hallway": 20, "masterbed": 21, "livingroom": 23})
+	publisher.stop()
+	print("published {}  skipped {}  dropped {}".format(publisher.published, publisher.skipped, publisher.dropped))
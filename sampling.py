@@ -0,0 +1,178 @@
+"""
+Read the sensors more or less often depending on how close the house is to
+switching the HVAC.
+
+Each zone's controller says at what temps it turns the HVAC on and off.
+Far from those points, and changing slowly, the sensors are read every
+maxInterval seconds.  Within nearBand of one, or just after the HVAC turned
+on or off, they are read every minInterval seconds.  In between, the
+interval is half of the time the temp needs to get to the next switching
+point at the rate it is changing.  If it isn't heading for one the interval
+goes up with the distance instead.
+
+The reads saved compared with reading every fixedInterval seconds are kept
+in metrics().
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+import math
+
+LOGGER = logging.getLogger("__main__.sampling.py")
+
+class AdaptiveSampler:
+	"""
+	Works out the seconds until the next read from the zones in a ControlScheduler
+	"""
+	def __init__(self, scheduler, minInterval=5, maxInterval=120, nearBand=0.25, farBand=4.0, boostTime=120, fixedInterval=15, smoothing=300):
+		"""
+		scheduler => The ControlScheduler with the zones to watch
+
+		<optional> minInterval, maxInterval => The shortest and longest time
+			between reads, in seconds
+
+		<optional> nearBand => Within this many degrees of turning the HVAC on or
+			off, read every minInterval
+
+		<optional> farBand => This many degrees or more from turning the HVAC on
+			or off, read every maxInterval
+
+		<optional> boostTime => Seconds to read every minInterval after the HVAC
+			turns on or off
+
+		<optional> fixedInterval => The fixed interval the savings are measured against
+
+		<optional> smoothing => Seconds the rate of change is averaged over
+		"""
+		self.LOGGER = logging.getLogger("__main__.sampling.AdaptiveSampler")
+
+		if minInterval > maxInterval:
+			raise ValueError("minInterval can't be more than maxInterval")
+		self.scheduler = scheduler
+		self.clock = scheduler.clock
+		self.minInterval = minInterval
+		self.maxInterval = maxInterval
+		self.nearBand = nearBand
+		self.farBand = max(farBand, nearBand)
+		self.boostTime = boostTime
+		self.fixedInterval = fixedInterval
+		self.smoothing = smoothing
+
+		# {zone name: [time, temp, degrees per second]}
+		self.rates = {}
+		# {zone name: HVAC state} to see when a relay changes
+		self.hvacStates = {}
+		self.boostUntil = None
+		self.interval = minInterval
+
+		self.reads = 0
+		self.sensors = set()
+		self.firstRead = None
+		self.lastRead = None
+
+		scheduler.addListener(self.update)
+
+	def boost(self):
+		"""
+		Read fast for boostTime seconds
+		"""
+		self.boostUntil = self.clock() + self.boostTime
+
+	def update(self, scheduler, zones):
+		"""
+		Keep the rate of change for each zone up to date.  Called after every tick.
+		"""
+		now = self.clock()
+		for zone in zones:
+			if self.hvacStates.get(zone.name, zone.hvac.state) != zone.hvac.state:
+				self.LOGGER.debug("%s HVAC changed, reading fast", zone.name)
+				self.boost()
+			self.hvacStates[zone.name] = zone.hvac.state
+
+			temp = scheduler.currentTemp(zone)
+			if temp is None:
+				continue
+			rate = self.rates.get(zone.name)
+			if rate is None:
+				self.rates[zone.name] = [now, temp, 0.0]
+				continue
+			seconds = now - rate[0]
+			if seconds <= 0:
+				continue
+			# Average over about smoothing seconds no matter how often it is called
+			weight = 1 - math.exp(-seconds / self.smoothing)
+			rate[2] += weight * ((temp - rate[1]) / seconds - rate[2])
+			rate[0] = now
+			rate[1] = temp
+
+	def zoneInterval(self, zone):
+		"""
+		Returns the seconds until the next read for one zone
+		"""
+		temp = self.scheduler.currentTemp(zone)
+		if temp is None:
+			return self.minInterval
+		# The temps where the zone turns the HVAC on or off
+		points = zone.thresholds()
+		if not points:
+			return self.maxInterval
+		distance = min(abs(temp - point) for point in points)
+		if distance <= self.nearBand:
+			return self.minInterval
+
+		fraction = min(1.0, (distance - self.nearBand) / max(self.farBand - self.nearBand, 1e-9))
+		interval = self.minInterval + fraction * (self.maxInterval - self.minInterval)
+
+		# When the temp is heading for a switching point, go by how long it will take
+		rate = self.rates.get(zone.name)
+		if rate and rate[2]:
+			if rate[2] > 0:
+				ahead = [point for point in points if point > temp]
+			else:
+				ahead = [point for point in reversed(points) if point < temp]
+			if ahead:
+				untilSwitch = (abs(ahead[0] - temp) - self.nearBand) / abs(rate[2])
+				interval = untilSwitch / 2
+		return interval
+
+	def nextInterval(self):
+		"""
+		Returns the seconds until the next read.  Can be passed as the interval
+		to BoardManager.run.
+		"""
+		if self.boostUntil is not None and self.clock() < self.boostUntil:
+			interval = self.minInterval
+		else:
+			interval = min((self.zoneInterval(zone) for zone in self.scheduler.zones.values()), default=self.maxInterval)
+		self.interval = max(self.minInterval, min(self.maxInterval, interval))
+		return self.interval
+
+	def countReads(self, snapshot):
+		"""
+		Count the reads in a snapshot.  Can be used as a BoardManager listener.
+		"""
+		now = self.clock()
+		if self.firstRead is None:
+			self.firstRead = now
+		self.lastRead = now
+		self.reads += len(snapshot)
+		self.sensors.update(snapshot)
+
+	def metrics(self):
+		"""
+		Returns a dict with the reads done and the reads fixed polling would have done
+		"""
+		fixedReads = 0
+		if self.firstRead is not None:
+			fixedReads = len(self.sensors) * (int((self.lastRead - self.firstRead) / self.fixedInterval) + 1)
+		saved = max(0, fixedReads - self.reads)
+		return {
+			"interval": self.interval,
+			"reads": self.reads,
+			"fixedReads": fixedReads,
+			"readsSaved": saved,
+			"percentSaved": 100.0 * saved / fixedReads if fixedReads else 0.0,
+			}
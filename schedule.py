@@ -0,0 +1,191 @@
+"""
+The weekly temp program from TEMP_SETTINGS.
+
+Each season (WINTER, SUMMER) is compiled once into a table with one entry for
+every minute of the week, so finding the setpoint for a control tick is just
+an index into the table.  A second table holds how many minutes are left until
+the setpoint changes, so the scheduler knows how long it can sleep.
+
+TIME_SETTINGS entries are [start, end, offset] with the times as HHMM.  An end
+before the start wraps past midnight.  An optional fourth value is a list of
+days (0 = Monday) the entry is used on, otherwise it is used every day.
+Entries later in the list win when they overlap.
+
+NAMED_SETTINGS entries are [0, 0, offset] and are added on top of the program
+while that name (HOME, AWAY) is active.
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+import time
+from array import array
+
+LOGGER = logging.getLogger("__main__.schedule.py")
+
+MINUTES_PER_DAY = 1440
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+# Which season to use for each Thermostat state
+SEASONS = {"HEAT": "WINTER", "COOL": "SUMMER"}
+# In the AUTO state, the months that use the SUMMER program when there is no
+# outdoor temp to go by
+SUMMER_MONTHS = (5, 6, 7, 8, 9)
+
+def seasonFor(state, when=None, outdoorTemp=None, changeover=None, current=None, band=0):
+	"""
+	Returns the season whose program a Thermostat state follows, or None
+
+	state => The Thermostat state.  AUTO follows WINTER when it is colder
+		outside than changeover and SUMMER when it is warmer.  Without an
+		outdoor temp it goes by the month.
+
+	<optional> when => Time in seconds, now if not given
+
+	<optional> outdoorTemp, changeover => In the same units.  changeover is
+		a fixed temp, like changeoverTemp(), not the setpoint, which changes
+		with the season.
+
+	<optional> current => The season in use now.  It is kept until the
+		outdoor temp is more than band past changeover.
+
+	<optional> band => How far past changeover the outdoor temp has to go to
+		change seasons
+	"""
+	if state != "AUTO":
+		return SEASONS.get(state)
+	if outdoorTemp is not None and changeover is not None:
+		if current == "WINTER" and outdoorTemp <= changeover + band:
+			return "WINTER"
+		if current == "SUMMER" and outdoorTemp >= changeover - band:
+			return "SUMMER"
+		return "WINTER" if outdoorTemp < changeover else "SUMMER"
+	month = time.localtime(time.time() if when is None else when).tm_mon
+	return "SUMMER" if month in SUMMER_MONTHS else "WINTER"
+
+def changeoverTemp(schedules):
+	"""
+	Returns the temp halfway between the WINTER and SUMMER DEFAULT_TEMP, or
+	None without both
+
+	schedules => {season: Schedule}
+	"""
+	if "WINTER" not in schedules or "SUMMER" not in schedules:
+		return None
+	return (schedules["WINTER"].defaultTemp + schedules["SUMMER"].defaultTemp) / 2
+
+def toMinutes(hhmm):
+	"""
+	hhmm => <int> Time like 1830
+
+	Returns the minute of the day, 1110 for 1830
+	"""
+	return (hhmm // 100) * 60 + hhmm % 100
+
+def minuteOfWeek(when):
+	"""
+	when => <float> Seconds since the epoch
+
+	Returns the minute of the week in local time, with 0 being midnight Monday
+	"""
+	local = time.localtime(when)
+	return local.tm_wday * MINUTES_PER_DAY + local.tm_hour * 60 + local.tm_min
+
+class Schedule:
+	"""
+	One season of the temp program compiled into lookup tables
+	"""
+	def __init__(self, name, settings):
+		"""
+		name => Name of the season (WINTER, SUMMER)
+
+		settings => The season from TEMP_SETTINGS with DEFAULT_TEMP, TIME_SETTINGS
+			and NAMED_SETTINGS
+		"""
+		self.LOGGER = logging.getLogger("__main__.schedule.Schedule")
+
+		self.name = name
+		self.defaultTemp = settings["DEFAULT_TEMP"]
+		self.named = {name.upper(): value[2] for name, value in settings.get("NAMED_SETTINGS", {}).items()}
+		self.active = None
+
+		self.setpoints = array("f", [self.defaultTemp]) * MINUTES_PER_WEEK
+		for entryName, entry in settings.get("TIME_SETTINGS", {}).items():
+			self._addEntry(entryName, entry)
+
+		self.untilChange = self._compileChanges()
+		self.LOGGER.debug("Compiled schedule {}".format(name))
+
+	def _addEntry(self, entryName, entry):
+		start = toMinutes(entry[0])
+		end = toMinutes(entry[1])
+		temp = self.defaultTemp + entry[2]
+		days = entry[3] if len(entry) > 3 else range(7)
+
+		length = (end - start) % MINUTES_PER_DAY or MINUTES_PER_DAY
+		for day in days:
+			first = day * MINUTES_PER_DAY + start
+			for minute in range(first, first + length):
+				self.setpoints[minute % MINUTES_PER_WEEK] = temp
+		self.LOGGER.debug("{} sets {} from {} to {} on days {}".format(entryName, temp, entry[0], entry[1], list(days)))
+
+	def _compileChanges(self):
+		"""
+		Work backwards around the week twice so every minute knows how far away
+		the next different setpoint is
+		"""
+		untilChange = array("H", [0]) * MINUTES_PER_WEEK
+		# Nothing ever changes, check back once a week
+		distance = MINUTES_PER_WEEK
+		for minute in range(2 * MINUTES_PER_WEEK - 1, -1, -1):
+			here = minute % MINUTES_PER_WEEK
+			after = (minute + 1) % MINUTES_PER_WEEK
+			if self.setpoints[here] != self.setpoints[after]:
+				distance = 1
+			else:
+				distance = min(distance + 1, MINUTES_PER_WEEK)
+			untilChange[here] = distance
+		return untilChange
+
+	def setActive(self, name):
+		"""
+		name => A name from NAMED_SETTINGS (HOME, AWAY) or None to use the plain program
+		"""
+		if name is not None:
+			name = name.upper()
+			if name not in self.named:
+				self.LOGGER.warning("{} is not a named setting for {}".format(name, self.name))
+				return False
+		self.active = name
+		return True
+
+	def setpoint(self, when=None):
+		"""
+		Returns the setpoint at a certain time, now if when is None
+		"""
+		if when is None:
+			when = time.time()
+		temp = self.setpoints[minuteOfWeek(when)]
+		if self.active:
+			temp += self.named[self.active]
+		return temp
+
+	def nextTransition(self, when=None):
+		"""
+		Returns the time, in seconds since the epoch, that the setpoint next changes
+		"""
+		if when is None:
+			when = time.time()
+		# Back up to the start of the minute
+		startOfMinute = when - (when % 60)
+		return startOfMinute + self.untilChange[minuteOfWeek(when)] * 60
+
+def compileSchedules(tempSettings):
+	"""
+	tempSettings => TEMP_SETTINGS from the config
+
+	Returns {season: Schedule} for every season in the settings
+	"""
+	return {name: Schedule(name, settings) for name, settings in tempSettings.items() if isinstance(settings, dict)}
@@ -0,0 +1,262 @@
+"""
+Event driven control loop for the thermostat.
+
+Instead of spinning in while loops, the scheduler sleeps until something
+happens:  new sensor data, a setpoint / state / mode change on a zone, or a
+timer that was asked for with wakeAt().  While it is waiting it uses no CPU.
+Only the zones that use the changed sensors or settings get a tick.
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+import asyncio
+import time
+
+from schedule import seasonFor, changeoverTemp
+from zones import Zone
+
+LOGGER = logging.getLogger("__main__.scheduler.py")
+
+class ControlScheduler:
+	"""
+	Decides when the HVAC in each zone should turn on or off.
+	"""
+	def __init__(self, thermostat, hvac=None, actuate=None, area="HOUSE", convert=None, schedules=None, clock=time.time, outdoor=None, controller=None, seasonBand=2):
+		"""
+		thermostat => The Thermostat with the sensors
+
+		<optional> hvac => The HVAC that is being controlled.  If given, a zone
+			named area is made that uses the Thermostat's state, mode and setpoint.
+			More can be added with addZone.
+
+		<optional> actuate => Coroutine function called as actuate(heatCool, onOff)
+			heatCool -- "heat" or "cool"
+			onOff -- "on" or "off"
+
+		<optional> area => The sensor or group used to control the HVAC
+
+		<optional> convert => Function to change the temp from C to the same
+			units as the setpoint
+
+		<optional> schedules => {season: schedule.Schedule} from schedule.compileSchedules.
+			If given, the setpoint follows the program for the season that
+			matches the zone's state, see schedule.seasonFor.
+
+		<optional> clock => Function returning the current time in seconds
+
+		<optional> outdoor => outdoor.OutdoorConditions with the outdoor temp
+			and forecast
+
+		<optional> controller => The controllers.Controller for the zone made
+			for hvac.  A HysteresisController if not given.
+
+		<optional> seasonBand => In AUTO, how far the outdoor temp goes past
+			the middle of the WINTER and SUMMER default temps before changing
+			programs, in the same units as the setpoint
+		"""
+		self.LOGGER = logging.getLogger("__main__.scheduler.ControlScheduler")
+
+		self.thermostat = thermostat
+		self.convert = convert
+		self.clock = clock
+		self.outdoor = outdoor
+		self.seasonBand = seasonBand
+
+		self.zones = {}
+		# {area: [zones]} to find the zones a reading changes
+		self.areaZones = {}
+
+		self.listeners = []
+
+		self.ticks = 0
+		# Seconds the last tick took to decide and queue the changes
+		self.lastTickTime = None
+		self._wake = None
+		self._timers = {}
+		# Zones waiting for a tick.  A dict so they stay in order.
+		self._pending = {}
+
+		if hvac is not None:
+			self.addZone(Zone(area, area, hvac, actuate, schedules, settings=thermostat, controller=controller))
+
+	def addZone(self, zone):
+		"""
+		zone => A zones.Zone to control
+		"""
+		self.zones[zone.name] = zone
+		self.areaZones.setdefault(zone.area, []).append(zone)
+		# Wake up any time the zone settings change
+		zone.settings.addListener(lambda settings, setting: self.notifyZone(zone))
+		self.notifyZone(zone)
+
+	def addListener(self, callback):
+		"""
+		callback => Called as callback(scheduler, zones) after every tick
+		"""
+		self.listeners.append(callback)
+
+	@property
+	def pending(self):
+		return bool(self._pending)
+
+	def notifyZone(self, zone):
+		"""
+		Tell the scheduler one zone needs a tick
+		"""
+		self._pending[zone.name] = zone
+		if self._wake:
+			self._wake.set()
+
+	def notify(self, snapshot=None):
+		"""
+		Tell the scheduler something changed.  Can be used directly as a listener.
+
+		<optional> snapshot => New readings {location: Sample}.  Only the zones
+			using those sensors get a tick.  Every zone does if not given.
+		"""
+		if not isinstance(snapshot, dict):
+			for zone in self.zones.values():
+				self.notifyZone(zone)
+			return
+		for location in snapshot:
+			areas = [location]
+			sensor = self.thermostat.tempSensors.get(location)
+			if sensor is not None:
+				areas.extend(self.thermostat.getGroupsFor(sensor))
+			for area in areas:
+				for zone in self.areaZones.get(area, ()):
+					self.notifyZone(zone)
+
+	def wakeAt(self, zone, when, reason="SCHEDULE"):
+		"""
+		Run a control tick for a zone at a certain time even if nothing else happens
+
+		when => <float> Time in seconds, from the same clock as the scheduler
+
+		<optional> reason => Each reason has its own timer, so the program and
+			the controller don't cancel each other's
+		"""
+		timer = self._timers.get((zone.name, reason))
+		if timer:
+			timer.cancel()
+		loop = asyncio.get_event_loop()
+		self._timers[(zone.name, reason)] = loop.call_later(max(0, when - self.clock()), self.notifyZone, zone)
+
+	def season(self, zone, now=None):
+		"""
+		Returns the season whose program the zone follows, or None.  In AUTO
+		the day's forecast high, or the outdoor temp, is compared with the
+		middle of the WINTER and SUMMER default temps.
+		"""
+		now = self.clock() if now is None else now
+		outdoorTemp = None
+		if zone.settings.state == "AUTO" and self.outdoor is not None:
+			outdoorTemp = self.outdoor.high(now)
+			if outdoorTemp is None:
+				outdoorTemp = self.outdoor.temp
+			if outdoorTemp is not None and self.convert:
+				outdoorTemp = self.convert(outdoorTemp)
+		return seasonFor(zone.settings.state, now, outdoorTemp, changeoverTemp(zone.schedules), zone.season, self.seasonBand)
+
+	def updateSetpoint(self, zone):
+		"""
+		Set the zone to the programmed temp and wake up again when the
+		program changes
+		"""
+		now = self.clock()
+		season = self.season(zone, now)
+		zone.season = season if season in zone.schedules else None
+		if season in zone.schedules:
+			if zone.holdUntil is not None and now < zone.holdUntil:
+				return
+			zone.holdUntil = None
+			zone.settings.setpoint = zone.schedules[season].setpoint(now)
+			self.wakeAt(zone, zone.schedules[season].nextTransition(now))
+			# Changing the setpoint doesn't need another tick
+			self._pending.pop(zone.name, None)
+			if self._wake and not self._pending:
+				self._wake.clear()
+
+	def holdSetpoint(self, zone, setpoint):
+		"""
+		Set a zone to a temp by hand.  It is kept until the program next
+		changes, then the program takes over again.
+		"""
+		season = self.season(zone)
+		if season in zone.schedules:
+			zone.holdUntil = zone.schedules[season].nextTransition(self.clock())
+			self.wakeAt(zone, zone.holdUntil)
+		zone.settings.setpoint = setpoint
+
+	def currentTemp(self, zone):
+		temp = self.thermostat.getTemp(zone.area)
+		if temp is not None and self.convert:
+			temp = self.convert(temp)
+		return temp
+
+	async def tickZone(self, zone):
+		"""
+		Run one control decision for a zone and act on it
+		"""
+		zone.ticks += 1
+		self.updateSetpoint(zone)
+		temp = self.currentTemp(zone)
+		if temp is None:
+			self.LOGGER.debug("No fresh temp for %s, leaving the HVAC alone", zone.name)
+		# Logged with arguments so the message is only made when DEBUG is on
+		self.LOGGER.debug("%s tick %s:  temp %s setpoint %s state %s HVAC %s", zone.name, zone.ticks, temp, zone.settings.setpoint, zone.settings.state, zone.hvac.state)
+		commands = zone.decide(temp, self.clock())
+		# A time proportional controller changes its answer with no new reading
+		if zone.controller.wakeAt is not None:
+			self.wakeAt(zone, zone.controller.wakeAt, "CONTROLLER")
+		for heatCool, onOff in commands:
+			self.LOGGER.info("Turning {} {} for {}".format(heatCool, onOff, zone.name))
+			try:
+				await zone.actuate(heatCool, onOff)
+			except AttributeError as e:
+				self.LOGGER.warning(e)
+			except Exception as e:
+				self.LOGGER.error("Could not change HVAC state.  {}".format(e))
+
+	async def tick(self, zones=None):
+		"""
+		Run the control decisions
+
+		<optional> zones => The zones to tick, all of them if not given
+		"""
+		self.ticks += 1
+		start = time.perf_counter()
+		if zones is None:
+			zones = list(self.zones.values())
+		for zone in zones:
+			self._pending.pop(zone.name, None)
+		if self._wake and not self._pending:
+			self._wake.clear()
+		for zone in zones:
+			await self.tickZone(zone)
+		self.lastTickTime = time.perf_counter() - start
+		for callback in self.listeners:
+			try:
+				callback(self, zones)
+			except Exception as e:
+				self.LOGGER.error("Tick listener failed.  {}".format(e))
+
+	async def run(self):
+		"""
+		Wait for something to happen, then tick the zones that need it.
+		Runs until cancelled.
+		"""
+		self._wake = asyncio.Event()
+		try:
+			while True:
+				if not self._pending:
+					await self._wake.wait()
+				self._wake.clear()
+				await self.tick(list(self._pending.values()))
+		finally:
+			for timer in self._timers.values():
+				timer.cancel()
+			self._wake = None
@@ -4,22 +4,233 @@ https://github.com/builderjer/ZiggyAI
 """
 
 __author__ = "builderjer"
-__version__ = "0.1.2"
+__version__ = "0.1.3"
 
 import logging
+from array import array
+from collections import deque
+
+import conversions
 
 LOGGER = logging.getLogger("__main__.sensors.py")
 
+# 3 days of readings at one every 15 seconds
+HISTORY_SIZE = 17280
+# Rolling windows, in seconds, that are kept up to date on every sample
+HISTORY_WINDOWS = (60, 900, 3600)
+# The most a raw reading can be and still fit in the history
+RAW_MAX = 65535
+
+class _Window:
+	"""
+	Running totals for the samples in the last <seconds> of a SampleHistory.
+
+	The sums make mean and slope O(1), and the two monotonic deques make
+	min and max O(1).  Each sample is added and removed once, so keeping it
+	up to date is O(1) per sample.
+	"""
+	def __init__(self, history, seconds):
+		self.history = history
+		self.seconds = seconds
+
+		# Sequence number of the oldest sample in the window
+		self.start = history.count
+		self.n = 0
+		self.sumT = 0.0
+		self.sumY = 0.0
+		self.sumTT = 0.0
+		self.sumTY = 0.0
+		self.mins = deque()
+		self.maxs = deque()
+
+	def add(self, seq):
+		h = self.history
+		i = seq % h.capacity
+		t = h.timestamps[i] - h.epoch
+		y = h.temps[i]
+		self.n += 1
+		self.sumT += t
+		self.sumY += y
+		self.sumTT += t * t
+		self.sumTY += t * y
+		while self.mins and h.temps[self.mins[-1] % h.capacity] >= y:
+			self.mins.pop()
+		self.mins.append(seq)
+		while self.maxs and h.temps[self.maxs[-1] % h.capacity] <= y:
+			self.maxs.pop()
+		self.maxs.append(seq)
+
+	def evict(self, beforeSeq=None, beforeTime=None):
+		"""
+		Drop samples older than a sequence number or a timestamp
+		"""
+		h = self.history
+		while self.n:
+			i = self.start % h.capacity
+			if beforeSeq is not None and self.start < beforeSeq:
+				pass
+			elif beforeTime is not None and h.timestamps[i] < beforeTime:
+				pass
+			else:
+				break
+			t = h.timestamps[i] - h.epoch
+			y = h.temps[i]
+			self.n -= 1
+			self.sumT -= t
+			self.sumY -= y
+			self.sumTT -= t * t
+			self.sumTY -= t * y
+			if self.mins and self.mins[0] == self.start:
+				self.mins.popleft()
+			if self.maxs and self.maxs[0] == self.start:
+				self.maxs.popleft()
+			self.start += 1
+		if not self.n:
+			# Start the sums fresh so rounding errors don't build up
+			self.start = h.count
+			self.sumT = self.sumY = self.sumTT = self.sumTY = 0.0
+
+class SampleHistory:
+	"""
+	A fixed size ring buffer of (timestamp, raw, tempC) readings.
+
+	The samples are kept in typed arrays so each one only takes 14 bytes.
+	The arrays grow as samples come in and never past the capacity, so a
+	sensor that is only read for a while doesn't hold a full buffer.
+	"""
+	def __init__(self, capacity=HISTORY_SIZE, windows=HISTORY_WINDOWS):
+		"""
+		<optional> capacity => The most samples to keep.  The oldest are overwritten.
+
+		<optional> windows => Window sizes in seconds to keep rolling stats for.
+			Other sizes are added the first time they are asked for.
+		"""
+		self.capacity = capacity
+		self.timestamps = array("d")
+		self.raws = array("H")
+		self.temps = array("f")
+
+		# Total number of samples ever added
+		self.count = 0
+		# Timestamps are stored as is, but the sums use time since the first sample
+		self.epoch = None
+
+		self.windows = {}
+		for seconds in windows:
+			self.addWindow(seconds)
+
+	def __len__(self):
+		return min(self.count, self.capacity)
+
+	def addWindow(self, seconds):
+		"""
+		Start keeping rolling stats for the last <seconds>.  Any samples
+		already in the history that fit are added.
+		"""
+		if seconds not in self.windows:
+			window = _Window(self, seconds)
+			if self.count:
+				latest = self.timestamps[(self.count - 1) % self.capacity]
+				window.start = self.count - len(self)
+				while window.start < self.count and self.timestamps[window.start % self.capacity] < latest - seconds:
+					window.start += 1
+				for seq in range(window.start, self.count):
+					window.add(seq)
+			self.windows[seconds] = window
+		return self.windows[seconds]
+
+	def append(self, timestamp, rawValue, tempC):
+		"""
+		Add a sample.  Timestamps are expected to only go forward.
+		"""
+		if self.epoch is None:
+			self.epoch = timestamp
+		seq = self.count
+		# Make room if the buffer is full
+		if seq >= self.capacity:
+			for window in self.windows.values():
+				window.evict(beforeSeq=seq - self.capacity + 1)
+
+		try:
+			raw = min(RAW_MAX, max(0, int(rawValue)))
+		except (TypeError, ValueError, OverflowError):
+			# None, nan or inf, there is no raw number to keep
+			raw = 0
+
+		if seq < self.capacity:
+			self.timestamps.append(timestamp)
+			self.raws.append(raw)
+			self.temps.append(tempC)
+		else:
+			i = seq % self.capacity
+			self.timestamps[i] = timestamp
+			self.raws[i] = raw
+			self.temps[i] = tempC
+		self.count += 1
+
+		for window in self.windows.values():
+			window.add(seq)
+			window.evict(beforeTime=timestamp - window.seconds)
+
+	def latest(self):
+		"""
+		Returns the newest (timestamp, raw, tempC) or None
+		"""
+		if not self.count:
+			return None
+		i = (self.count - 1) % self.capacity
+		return (self.timestamps[i], self.raws[i], self.temps[i])
+
+	def samples(self):
+		"""
+		Yields every (timestamp, raw, tempC) from oldest to newest
+		"""
+		for seq in range(self.count - len(self), self.count):
+			i = seq % self.capacity
+			yield (self.timestamps[i], self.raws[i], self.temps[i])
+
+	def mean(self, seconds):
+		window = self.addWindow(seconds)
+		if not window.n:
+			return None
+		return window.sumY / window.n
+
+	def min(self, seconds):
+		window = self.addWindow(seconds)
+		if not window.n:
+			return None
+		return self.temps[window.mins[0] % self.capacity]
+
+	def max(self, seconds):
+		window = self.addWindow(seconds)
+		if not window.n:
+			return None
+		return self.temps[window.maxs[0] % self.capacity]
+
+	def slope(self, seconds):
+		"""
+		Least squares rate of change over the window in degrees C per second.
+		Returns None if there are not enough samples.
+		"""
+		window = self.addWindow(seconds)
+		n = window.n
+		denominator = n * window.sumTT - window.sumT * window.sumT
+		if n < 2 or denominator <= 0:
+			return None
+		return (n * window.sumTY - window.sumT * window.sumY) / denominator
+
 class TempSensor:
 	"""
 	A class to create a temperature sensor for use with an Arduino or other microcontroller
 	"""
-	def __init__(self, moduleType, controlPin):
+	def __init__(self, moduleType, controlPin, historySize=HISTORY_SIZE):
 		"""
 		<string> moduleType => type of sensor (LM35, etc...)
 			It is required because each sensor uses a different forumla to determine the temp
 
 		<int> controlPin => The pin on the microcontroller the sensor is connected to.
+
+		<optional> <int> historySize => How many readings to keep in the history
 		"""
 		self.LOGGER = logging.getLogger("__main__.  sensors.TempSensor")
 		self.LOGGER.debug("Created TempSensor with moduleType {} and controlPin {}".format(moduleType, controlPin))
@@ -32,6 +243,26 @@ class TempSensor:
 			self._controlPin = None
 
 		self._tempC = None
+		self.rawValue = None
+		self.timestamp = None
+
+		# Calibration, tempC = formula(raw) * gain + offset
+		self.offset = 0.0
+		self.gain = 1.0
+
+		self.history = SampleHistory(historySize)
+		self.listeners = []
+		# A filters.FilterChain for the temps, or None to use them as they are
+		self.filter = None
+		self.rejected = 0
+
+	def addListener(self, callback):
+		"""
+		callback => Called as callback(sensor, oldTempC, newTempC) when tempC
+			changes, and after every update() even if it is the same temp so
+			the time of the reading can be picked up
+		"""
+		self.listeners.append(callback)
 
 	@property
 	def controlPin(self):
@@ -49,18 +280,63 @@ class TempSensor:
 	@tempC.setter
 	def tempC(self, rawValue):
 		"""
+		rawValue => The raw value from the sensor.  It is changed to C with the
+			formula for the moduleType in conversions.CONVERSIONS
+		"""
+
+		# Logged with arguments so the message is only made when DEBUG is on
+		self.LOGGER.debug("Setting tempC with rawValue %s", rawValue)
+		self._setTemp(conversions.convert(self.moduleType, rawValue, self.offset, self.gain))
+
+	def _setTemp(self, tempC, always=False):
+		oldTemp = self._tempC
+		self._tempC = tempC
 
-		dataList => A two value touple containing the sensor type and raw value
-				from the sensor
+		if always or self._tempC != oldTemp:
+			for callback in self.listeners:
+				callback(self, oldTemp, self._tempC)
+
+	def calibrate(self, offset=0.0, gain=1.0):
 		"""
+		Correct a sensor that reads high or low.
 
-		self.LOGGER.debug("Setting tempC with rawValue {}".format(rawValue))
-		if self.moduleType == "LM35":
-			self._tempC = rawValue * 0.48828125
-		#if dataList[0] == "LM35":
-			#self._tempC = dataList[1] * 0.48828125
-		else:
-			self._tempC = None
+		offset => Degrees C added after the gain
+
+		gain => Multiplied by the temp from the formula
+		"""
+		self.LOGGER.debug("Calibrating sensor on pin {} with offset {} and gain {}".format(self.controlPin, offset, gain))
+		self.offset = offset
+		self.gain = gain
+
+	def update(self, rawValue, timestamp, tempC=None):
+		"""
+		Set the value of the sensor along with the time it was read
+
+		rawValue => The value read from the pin
+
+		timestamp => <float> Seconds since the epoch when the value was read
+
+		<optional> tempC => The temp if it was already converted, like by a
+			conversions.ConversionPlan
+
+		Returns False if the filter dropped the reading and the temp was left alone
+		"""
+		if tempC is None:
+			tempC = conversions.convert(self.moduleType, rawValue, self.offset, self.gain)
+		self.rawValue = rawValue
+		self.timestamp = timestamp
+		if tempC is not None and self.filter is not None:
+			tempC = self.filter.update(tempC, timestamp)
+			if tempC is None:
+				self.rejected += 1
+				self.LOGGER.debug("Dropped reading %s on pin %s", rawValue, self.controlPin)
+				# The old temp is still fresh as of this read
+				self._setTemp(self._tempC, True)
+				return False
+		self._setTemp(tempC, True)
+		if self.tempC is not None:
+			self.history.append(timestamp, rawValue, self.tempC)
+		return True
 
 class PhotoSensor:
 	"""
@@ -0,0 +1,224 @@
+"""
+A ring buffer of readings and state changes in shared memory, so other
+processes can follow what the control process sees.
+
+The control process is the only writer.  Readers in other processes attach
+to the ring by name and read the fixed size records straight out of the
+shared memory with struct.unpack_from.  Nothing is pickled or sent through
+a pipe, and a reader that is slow or stops only misses records.  It never
+holds up the writer.
+
+Layout:
+	header			<- magic, version, slot count, record count written so far
+	names			<- JSON {"channels": [...], "states": [...]} so a record only
+						stores numbers
+	slots			<- RING_SLOTS records of RECORD
+
+Each record starts with its sequence number.  The writer sets it to 0, writes
+the rest, then writes the real number, so a reader that sees the same number
+before and after reading knows the record wasn't changed under it.
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+import json
+import math
+import struct
+import time
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+from historylog import SAMPLE, TRANSITION, TRANSITION_STATES
+
+LOGGER = logging.getLogger("__main__.sharedring.py")
+
+MAGIC = b"THRM"
+RING_VERSION = 1
+
+# magic, version, slots, record size, names size, records written
+HEADER = struct.Struct("<4sHIHIQ")
+HEADER_SIZE = 64
+# Where the count of records written is in the header
+COUNT = struct.Struct("<Q")
+COUNT_OFFSET = HEADER.size - COUNT.size
+NAMES_SIZE = 4096
+
+# sequence, time, kind, pad, channel, raw, value, pad
+RECORD = struct.Struct("<QdBxHff4x")
+SEQUENCE = struct.Struct("<Q")
+
+# One record read back from the ring.  value is the temp in C for a sample
+# and the state for a transition.
+RingRecord = namedtuple("RingRecord", ["sequence", "timestamp", "kind", "name", "raw", "value"])
+
+def ringSize(slots):
+	return HEADER_SIZE + NAMES_SIZE + slots * RECORD.size
+
+class SharedRing:
+	"""
+	The writing side of the ring.  Made by the control process.
+	"""
+	def __init__(self, name, channels, slots=4096):
+		"""
+		name => The shared memory name the readers attach to
+
+		channels => Every sensor location and state name that will be written
+
+		<optional> slots => Records kept before the oldest is written over
+		"""
+		self.LOGGER = logging.getLogger("__main__.sharedring.SharedRing")
+
+		self.name = name
+		self.slots = slots
+		self.channels = {channel.upper(): number for number, channel in enumerate(dict.fromkeys(channel.upper() for channel in channels))}
+		self.states = {state: number for number, state in enumerate(TRANSITION_STATES)}
+		self.count = 0
+
+		names = json.dumps({"channels": list(self.channels), "states": TRANSITION_STATES}).encode()
+		if len(names) > NAMES_SIZE:
+			raise ValueError("Too many channel names for the ring")
+
+		size = ringSize(slots)
+		try:
+			self.memory = shared_memory.SharedMemory(name, create=True, size=size)
+		except FileExistsError:
+			# Left behind by a run that didn't shut down
+			self.LOGGER.warning("Shared memory {} was left behind, making it again".format(name))
+			old = shared_memory.SharedMemory(name)
+			old.close()
+			old.unlink()
+			self.memory = shared_memory.SharedMemory(name, create=True, size=size)
+
+		self.buffer = self.memory.buf
+		self.buffer[HEADER_SIZE:HEADER_SIZE + len(names)] = names
+		HEADER.pack_into(self.buffer, 0, MAGIC, RING_VERSION, slots, RECORD.size, len(names), 0)
+
+	def write(self, kind, name, raw, value, timestamp):
+		"""
+		Add one record.  Names that weren't given to the ring are skipped.
+
+		kind => historylog.SAMPLE or historylog.TRANSITION
+
+		name => The sensor location or what changed state
+
+		raw => The raw reading, None for a transition
+
+		value => The temp in C, or the new state for a transition
+		"""
+		channel = self.channels.get(name.upper())
+		if channel is None:
+			self.LOGGER.debug("%s is not a ring channel", name)
+			return False
+		if kind == TRANSITION:
+			value = self.states[value]
+		elif value is None:
+			value = math.nan
+		self.count += 1
+		offset = HEADER_SIZE + NAMES_SIZE + (self.count - 1) % self.slots * RECORD.size
+		RECORD.pack_into(self.buffer, offset, 0, timestamp, kind, channel, math.nan if raw is None else raw, value)
+		SEQUENCE.pack_into(self.buffer, offset, self.count)
+		COUNT.pack_into(self.buffer, COUNT_OFFSET, self.count)
+		return True
+
+	def addSnapshot(self, snapshot, sensors):
+		"""
+		Add one read of a board, with the temps after conversion and filtering.
+		Can be used as a BoardManager listener with functools.partial.
+
+		snapshot => <dict> {location: acquisition.Sample}
+
+		sensors => <dict> {location: TempSensor}
+		"""
+		for location, sample in snapshot.items():
+			sensor = sensors.get(location)
+			self.write(SAMPLE, location, sample.raw, sensor.tempC if sensor is not None else None, sample.timestamp)
+
+	def addSample(self, name, value, timestamp):
+		self.write(SAMPLE, name, None, value, timestamp)
+
+	def addTransition(self, name, state, timestamp=None):
+		self.write(TRANSITION, name, None, state, time.time() if timestamp is None else timestamp)
+
+	def close(self):
+		"""
+		Let go of the ring and remove it.  Readers still attached keep their copy.
+		"""
+		self.buffer = None
+		self.memory.close()
+		try:
+			self.memory.unlink()
+		except FileNotFoundError:
+			pass
+
+class RingReader:
+	"""
+	The reading side of the ring, for a process that follows the control process
+	"""
+	def __init__(self, name, fromStart=False, after=None):
+		"""
+		name => The shared memory name the ring was made with
+
+		<optional> fromStart => Read the records already in the ring.  Otherwise
+			only the ones written after attaching are read.
+
+		<optional> after => Read the records written after this sequence number,
+			like the last one handled before a restart.  Used instead of fromStart.
+		"""
+		self.LOGGER = logging.getLogger("__main__.sharedring.RingReader")
+
+		self.memory = shared_memory.SharedMemory(name)
+		self.buffer = self.memory.buf
+		magic, version, self.slots, recordSize, namesSize, count = HEADER.unpack_from(self.buffer, 0)
+		if magic != MAGIC or version != RING_VERSION or recordSize != RECORD.size:
+			self.close()
+			raise ValueError("Shared memory {} is not a ring this version can read".format(name))
+		names = json.loads(bytes(self.buffer[HEADER_SIZE:HEADER_SIZE + namesSize]))
+		self.channels = names["channels"]
+		self.states = names["states"]
+
+		if after is not None:
+			self.next = min(after, count) + 1
+		else:
+			self.next = max(1, count - self.slots + 1) if fromStart else count + 1
+		# Records written over before they were read
+		self.missed = 0
+
+	@property
+	def written(self):
+		return COUNT.unpack_from(self.buffer, COUNT_OFFSET)[0]
+
+	def read(self, limit=None):
+		"""
+		Returns a list of RingRecord written since the last read
+
+		<optional> limit => The most records to return
+		"""
+		count = self.written
+		oldest = count - self.slots + 1
+		if self.next < oldest:
+			self.missed += oldest - self.next
+			self.LOGGER.warning("Fell behind, missed {} records".format(oldest - self.next))
+			self.next = oldest
+		if limit is not None:
+			count = min(count, self.next + limit - 1)
+
+		records = []
+		while self.next <= count:
+			offset = HEADER_SIZE + NAMES_SIZE + (self.next - 1) % self.slots * RECORD.size
+			sequence, timestamp, kind, channel, raw, value = RECORD.unpack_from(self.buffer, offset)
+			if sequence != self.next or SEQUENCE.unpack_from(self.buffer, offset)[0] != sequence:
+				# Written over while reading
+				self.missed += 1
+			else:
+				if kind == TRANSITION:
+					value = self.states[int(value)]
+				records.append(RingRecord(sequence, timestamp, kind, self.channels[channel], None if math.isnan(raw) else raw, None if kind == SAMPLE and math.isnan(value) else value))
+			self.next += 1
+		return records
+
+	def close(self):
+		self.buffer = None
+		self.memory.close()
@@ -0,0 +1,418 @@
+#! /usr/bin/env python3
+
+"""
+A pretend house for trying out the control loop faster than real time.
+
+SimulatedBoard has the same calls start.py uses (analog_read, digital_write,
+set_pin_mode, sleep) but the analog pins read the temp of zones in a simple
+thermal model, and the relay pins turn a pretend furnace and A/C on and off.
+Time comes from a VirtualClock, so sleeping just moves the clock forward and
+runs the model.  A week of control takes seconds.
+
+Run it directly to replay a week with the default config:
+	python3 simulator.py --days 7
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+import asyncio
+import inspect
+import math
+import random
+import time
+
+import thermostat
+from hvac import HVAC
+from fakeboard import FakeCore, FakeBoard, INPUT
+from actuator import RelayQueue
+from acquisition import AcquisitionEngine
+from scheduler import ControlScheduler
+from schedule import compileSchedules, changeoverTemp
+from sampling import AdaptiveSampler
+from controllers import makeController
+
+LOGGER = logging.getLogger("__main__.simulator.py")
+
+# Turns a temp in C back into the raw reading each type of sensor would give
+RAW_VALUES = {
+	"LM35": lambda temp: temp * 1024 / 500,
+	"TMP36": lambda temp: (temp * 10 + 500) * 1024 / 5000,
+	}
+# The Arduino ADC is 10 bits
+ADC_MAX = 1023
+
+class VirtualClock:
+	"""
+	A clock that only moves when it is told to.  Call it to get the time, so it
+	can be passed anywhere that takes clock=time.time
+	"""
+	def __init__(self, start=None):
+		self.now = time.time() if start is None else start
+
+	def __call__(self):
+		return self.now
+
+	def advance(self, seconds):
+		self.now += seconds
+
+class Zone:
+	"""
+	One area of the house with its own temp and sensor
+	"""
+	def __init__(self, name, pin, temp=20.0, moduleType="LM35", share=1.0, loss=1 / 28800):
+		"""
+		name => Name of the zone, usually the sensor location
+
+		pin => The analog pin its sensor reads on
+
+		<optional> temp => Starting temp in C
+
+		<optional> moduleType => The sensor type, LM35 or TMP36
+
+		<optional> share => How much of the furnace and A/C output this zone gets
+			compared to the others
+
+		<optional> loss => How fast the zone drifts to the outdoor temp, per second
+		"""
+		self.name = name
+		self.pin = pin
+		self.temp = temp
+		self.moduleType = moduleType.upper()
+		self.share = share
+		self.loss = loss
+
+	def raw(self):
+		# Like the real ADC, it can't go below 0 or above ADC_MAX
+		return min(ADC_MAX, max(0, int(round(RAW_VALUES[self.moduleType](self.temp)))))
+
+class HouseModel:
+	"""
+	A lumped thermal model.  Each zone loses heat to the outside, mixes a little
+	with the rest of the house, and gets its share of the furnace or A/C.
+	"""
+	def __init__(self, zones, outdoorMean=0.0, outdoorSwing=5.0, heatRate=4.0, coolRate=3.0, mixing=1 / 3600, noise=0.0):
+		"""
+		zones => List of Zone
+
+		<optional> outdoorMean, outdoorSwing => The outdoor temp in C goes from
+			mean - swing at 3am to mean + swing at 3pm
+
+		<optional> heatRate, coolRate => Degrees C per hour the furnace or A/C
+			moves a zone with a share of 1
+
+		<optional> mixing => How fast the zones even out, per second
+
+		<optional> noise => Standard deviation of the sensor noise in raw steps
+		"""
+		self.zones = zones
+		self.outdoorMean = outdoorMean
+		self.outdoorSwing = outdoorSwing
+		self.heatRate = heatRate / 3600
+		self.coolRate = coolRate / 3600
+		self.mixing = mixing
+		self.noise = noise
+
+		self.heating = False
+		self.cooling = False
+
+	def outdoorTemp(self, when):
+		local = time.localtime(when)
+		hour = local.tm_hour + local.tm_min / 60
+		return self.outdoorMean - self.outdoorSwing * math.cos((hour - 3) / 24 * 2 * math.pi)
+
+	def step(self, when, seconds):
+		"""
+		Run the model forward.  Long steps are split up so it stays stable.
+		"""
+		while seconds > 0:
+			dt = min(seconds, 60)
+			outdoor = self.outdoorTemp(when)
+			average = sum(zone.temp for zone in self.zones) / len(self.zones)
+			for zone in self.zones:
+				change = (outdoor - zone.temp) * zone.loss + (average - zone.temp) * self.mixing
+				if self.heating:
+					change += self.heatRate * zone.share
+				if self.cooling:
+					change -= self.coolRate * zone.share
+				zone.temp += change * dt
+			when += dt
+			seconds -= dt
+
+class SimulatedOutdoor:
+	"""
+	The outdoor temp of a HouseModel, the same as outdoor.OutdoorConditions
+	with no forecast
+	"""
+	def __init__(self, model, clock):
+		self.model = model
+		self.clock = clock
+
+	@property
+	def temp(self):
+		return self.model.outdoorTemp(self.clock())
+
+	def high(self, when=None):
+		return None
+
+	def low(self, when=None):
+		return None
+
+	def highLow(self, when=None):
+		return (None, None)
+
+class SimulatedCore(FakeCore):
+	"""
+	The asyncio board calls, backed by a HouseModel and a VirtualClock
+	"""
+	def __init__(self, model, clock, heatControl, coolControl):
+		"""
+		model => The HouseModel
+
+		clock => The VirtualClock
+
+		heatControl, coolControl => (on pin, off pin, sensor pin) the same as HVAC
+		"""
+		FakeCore.__init__(self)
+		self.LOGGER = logging.getLogger("__main__.simulator.SimulatedCore")
+
+		self.model = model
+		self.clock = clock
+		self.heatControl = heatControl
+		self.coolControl = coolControl
+		self.zonePins = {zone.pin: zone for zone in model.zones}
+
+		self.relayChanges = 0
+
+	async def analog_read(self, pin):
+		self.analogReads += 1
+		if pin not in self.zonePins:
+			return self.analogValues.get(pin, self.default)
+		raw = self.zonePins[pin].raw()
+		if self.model.noise:
+			raw = min(ADC_MAX, max(0, raw + int(round(random.gauss(0, self.model.noise)))))
+		return raw
+
+	async def digital_write(self, pin, value):
+		await FakeCore.digital_write(self, pin, value)
+		# The latching relays change on the rising edge of a pulse
+		if not value:
+			return
+		if pin == self.heatControl[0]:
+			self._setRelay("heating", True, self.heatControl[2])
+		elif pin == self.heatControl[1]:
+			self._setRelay("heating", False, self.heatControl[2])
+		elif pin == self.coolControl[0]:
+			self._setRelay("cooling", True, self.coolControl[2])
+		elif pin == self.coolControl[1]:
+			self._setRelay("cooling", False, self.coolControl[2])
+
+	def _setRelay(self, name, on, sensePin):
+		if getattr(self.model, name) == on:
+			return
+		setattr(self.model, name, on)
+		self.relayChanges += 1
+		self.digitalValues[sensePin] = int(on)
+		# Let anything watching the sense pin know, like pymata does
+		callback = self.callbacks.get(sensePin)
+		if callback:
+			result = callback([sensePin, int(on)])
+			if inspect.isawaitable(result):
+				asyncio.ensure_future(result)
+
+	async def sleep(self, sleep_time):
+		self.model.step(self.clock.now, sleep_time)
+		self.clock.advance(sleep_time)
+		# Give other tasks a turn without waiting for real
+		await asyncio.sleep(0)
+
+class SimulatedBoard(FakeBoard):
+	"""
+	The blocking board calls, the same as PyMata3, on top of a SimulatedCore
+	"""
+	def __init__(self, model, clock, heatControl, coolControl, loop=None):
+		FakeBoard.__init__(self, loop=loop)
+		self.LOGGER = logging.getLogger("__main__.simulator.SimulatedBoard")
+
+		self.model = model
+		self.clock = clock
+		self.core = SimulatedCore(model, clock, heatControl, coolControl)
+
+class Simulation:
+	"""
+	The thermostat, HVAC and control loop from start.py hooked up to a
+	SimulatedBoard
+	"""
+	def __init__(self, settings, model=None, start=None, interval=None, state="HEAT", adaptive=False, controller=None):
+		"""
+		settings => The config, the same as start.py uses
+
+		<optional> model => A HouseModel.  One zone per sensor in the config is
+			made if not given.
+
+		<optional> start => Time in seconds since the epoch to start at
+
+		<optional> interval => Seconds between sensor reads, READ_INTERVAL if not given
+
+		<optional> state => The Thermostat state to run in
+
+		<optional> adaptive => Use an AdaptiveSampler with the SAMPLING settings
+			instead of reading every interval seconds
+
+		<optional> controller => The controllers.Controller to try, the one from
+			the CONTROL settings if not given
+		"""
+		self.LOGGER = logging.getLogger("__main__.simulator.Simulation")
+
+		self.settings = settings
+		self.interval = interval or settings.get("READ_INTERVAL", 15)
+		self.clock = VirtualClock(start)
+
+		self.thermostat = thermostat.Thermostat()
+		self.thermostat.loadSettings(settings)
+		self.thermostat.clock = self.clock
+		self.hvac = HVAC()
+		self.hvac.loadSettings(settings)
+
+		if model is None:
+			zones = [Zone(area, sensor.controlPin, moduleType=sensor.moduleType) for area, sensor in self.thermostat.tempSensors.items()]
+			model = HouseModel(zones)
+		self.model = model
+
+		self.board = SimulatedBoard(model, self.clock, self.hvac.heatControl, self.hvac.coolControl)
+		self.engine = AcquisitionEngine(self.thermostat, self.board.core, clock=self.clock)
+		# Switched the same way start.py does it, so the minimum run and off
+		# times hold here too
+		hvacSettings = settings["HVAC"]
+		self.relays = RelayQueue(self.hvac, self.board.core, hvacSettings["MIN_ON_TIME"], hvacSettings["MIN_OFF_TIME"], clock=self.clock)
+		for pin in (self.hvac.heatControl[2], self.hvac.coolControl[2]):
+			self.board.set_pin_mode(pin, INPUT, self.relays.senseChanged)
+		self.scheduler = ControlScheduler(self.thermostat, self.relays, self.relays, area="HOUSE", convert=self.toOutput, schedules=compileSchedules(settings["TEMP_SETTINGS"]), clock=self.clock, outdoor=SimulatedOutdoor(model, self.clock), controller=controller or makeController(settings.get("CONTROL")), seasonBand=settings.get("SEASON_BAND", 2))
+
+		self.thermostat.setpoint = settings["TEMP_SETTINGS"]["DEFAULT_TEMP"]
+		self.thermostat.state = state
+
+		self.sampler = None
+		if adaptive:
+			sampling = settings["SAMPLING"]
+			self.sampler = AdaptiveSampler(self.scheduler, sampling["MIN_INTERVAL"], sampling["MAX_INTERVAL"], sampling["NEAR_BAND"], sampling["FAR_BAND"], sampling["BOOST_TIME"], self.interval)
+			self.engine.addListener(self.sampler.countReads)
+
+		# (time, house temp, outdoor temp, setpoint, HVAC state, season)
+		self.records = []
+
+	def toOutput(self, temp):
+		if self.settings.get("OUTPUT_FORMAT") == "F":
+			temp = (temp * 1.8) + 32
+		return temp
+
+	async def _run(self, seconds):
+		end = self.clock.now + seconds
+		while self.clock.now < end:
+			started = self.clock.now
+			await self.engine.cycle()
+			# Pulsing a relay moves the clock on, so keep the time the tick saw
+			ticked = self.clock.now
+			await self.scheduler.tick()
+			wait = await self.relays.pump()
+			self.records.append((ticked, self.thermostat.getTemp("HOUSE"), self.model.outdoorTemp(ticked), self.thermostat.setpoint, self.hvac.state, self.scheduler.zones["HOUSE"].season))
+			interval = self.sampler.nextInterval() if self.sampler else self.interval
+			if wait:
+				# Come back when the relay that had to wait can be switched
+				interval = min(interval, wait)
+			await self.board.core.sleep(max(0, interval - (self.clock.now - started)))
+
+	def run(self, seconds):
+		"""
+		Run the control loop for seconds of virtual time
+		"""
+		self.board.loop.run_until_complete(self._run(seconds))
+		return self.summary()
+
+	def checkProgram(self):
+		"""
+		Returns the (time, setpoint, programmed setpoint) of every read where
+		the setpoint wasn't the one in the program for the season used at that
+		tick, and (time, old season, new season) for every change of season
+		the outdoor temp wasn't past the SEASON_BAND for
+		"""
+		zone = self.scheduler.zones["HOUSE"]
+		changeover = changeoverTemp(zone.schedules)
+		band = self.scheduler.seasonBand
+		wrong = []
+		last = None
+		for when, temp, outdoor, setpoint, hvacState, season in self.records:
+			if season not in zone.schedules:
+				wrong.append((when, setpoint, None))
+				continue
+			programmed = zone.schedules[season].setpoint(when)
+			if setpoint != programmed:
+				wrong.append((when, setpoint, programmed))
+			if last is not None and season != last and changeover is not None:
+				outdoor = self.toOutput(outdoor)
+				if (season == "SUMMER" and outdoor <= changeover + band) or (season == "WINTER" and outdoor >= changeover - band):
+					wrong.append((when, last, season))
+			last = season
+		return wrong
+
+	def summary(self):
+		"""
+		Returns a dict of how well the house was kept at the setpoint
+		"""
+		if not self.records:
+			return {}
+		# Each record lasts until the next one
+		lengths = [after[0] - before[0] for before, after in zip(self.records, self.records[1:])]
+		# (error, seconds) so the reads don't have to be evenly spaced
+		errors = [(abs(self.toOutput(record[1]) - record[3]), length) for record, length in zip(self.records, lengths) if record[1] is not None and record[3] is not None]
+		errorTime = sum(length for error, length in errors)
+		summary = {
+			"seconds": self.records[-1][0] - self.records[0][0],
+			"ticks": len(self.records),
+			"relayChanges": self.board.core.relayChanges,
+			"heatHours": sum(length for record, length in zip(self.records, lengths) if record[4] == "HEAT") / 3600,
+			"coolHours": sum(length for record, length in zip(self.records, lengths) if record[4] == "COOL") / 3600,
+			"seasonChanges": sum(1 for before, after in zip(self.records, self.records[1:]) if before[5] != after[5]),
+			"meanError": sum(error * length for error, length in errors) / errorTime if errorTime else None,
+			"maxError": max(error for error, length in errors) if errors else None,
+			}
+		if self.sampler:
+			summary["sampling"] = self.sampler.metrics()
+		return summary
+
+if __name__ == "__main__":
+	import argparse
+	import json
+	from pathlib import Path
+	import sys
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--days", help="Days to simulate", type=float, default=7)
+	parser.add_argument("--state", help="HEAT, COOL or AUTO", default="HEAT")
+	parser.add_argument("--outdoor", help="Average outdoor temp in C", type=float, default=0.0)
+	parser.add_argument("--adaptive", help="Read the sensors with the adaptive sampler", action="store_true")
+	parser.add_argument("--noise", help="Sensor noise in raw steps", type=float, default=0.0)
+	parser.add_argument("--check", help="Exit with 1 if the setpoint didn't follow the program", action="store_true")
+	parser.add_argument("--controller", help="HYSTERESIS, TIME_PROPORTIONAL or PID with its default settings, CONTROL from the config if not given")
+	args = parser.parse_args()
+
+	with open(Path(sys.path[0]).joinpath("config/default.json"), "r") as settings:
+		SETTINGS = json.load(settings)
+
+	if args.controller:
+		SETTINGS["CONTROL"] = {"TYPE": args.controller}
+	simulation = Simulation(SETTINGS, state=args.state.upper(), adaptive=args.adaptive)
+	simulation.model.outdoorMean = args.outdoor
+	simulation.model.noise = args.noise
+	started = time.perf_counter()
+	summary = simulation.run(args.days * 86400)
+	summary["wallSeconds"] = time.perf_counter() - started
+	print(json.dumps(summary, indent=2))
+	if args.check:
+		wrong = simulation.checkProgram()
+		if wrong:
+			print("The setpoint didn't follow the program at {} of {} reads, first at {}".format(len(wrong), len(simulation.records), wrong[0]))
+			sys.exit(1)
+		print("The setpoint followed the program at all {} reads".format(len(simulation.records)))
@@ -24,6 +24,8 @@ import sys
 import os
 import time
 import signal
+import asyncio
+import functools
 
 # Set up the parser
 parser = argparse.ArgumentParser()
@@ -39,21 +41,18 @@ SETTINGS = {}
 with open(CONFIG_FILE, "r") as settings:
 	SETTINGS = json.load(settings)
 
-# Check if there is already a log file
-if Path(Path.home().joinpath(SETTINGS["USER_DIR"]).joinpath(SETTINGS["LOG_FILE"])).exists():
+os.makedirs(Path(Path.home().joinpath(SETTINGS["USER_DIR"])), exist_ok=True)
 
-	# Move it to a backup file
-	Path(Path.home().joinpath(SETTINGS["USER_DIR"]).joinpath(SETTINGS["LOG_FILE"])).rename(Path.home().joinpath(SETTINGS["USER_DIR"]).joinpath(SETTINGS["LOG_FILE"] + ".old"))
-else:
-	os.makedirs(Path(Path.home().joinpath(SETTINGS["USER_DIR"])), exist_ok=True)
-
-# Create a logger
+# Create a logger.  The records are written to the file by a thread, so the
+# control loop never waits on the SD card.
+from logqueue import QueuedLogging
 LOGGER = logging.getLogger(__name__)
-FILE_LOGGER = logging.FileHandler(Path.home().joinpath(SETTINGS["USER_DIR"]).joinpath(SETTINGS["LOG_FILE"]))
-FILE_LOGGER.setFormatter(logging.Formatter('%(asctime)s : %(levelname)s : %(name)s : %(lineno)d : %(message)s'))
+LOG_QUEUE = QueuedLogging(LOGGER, Path.home().joinpath(SETTINGS["USER_DIR"]).joinpath(SETTINGS["LOG_FILE"]), SETTINGS["LOG_MAX_BYTES"], SETTINGS["LOG_BACKUP_COUNT"], SETTINGS["LOG_QUEUE_SIZE"], logging.Formatter('%(asctime)s : %(levelname)s : %(name)s : %(lineno)d : %(message)s'))
+# Start each run with a new log file, the last ones are kept as .1, .2, ...
+LOG_QUEUE.rollover()
+FILE_LOGGER = LOG_QUEUE.fileHandler
 CONSOLE_LOGGER = logging.StreamHandler()
 CONSOLE_LOGGER.setFormatter(logging.Formatter("%(levelname)s : %(name)s : %(lineno)d : %(message)s"))
-LOGGER.addHandler(FILE_LOGGER)
 
 # FIXME:  Logging is not quite right
 
@@ -64,16 +63,17 @@ if args.debug:
 
 if args.verbose:
 	CONSOLE_LOGGER.setLevel(logging.DEBUG)
-	LOGGER.addHandler(CONSOLE_LOGGER)
+	LOG_QUEUE.addHandler(CONSOLE_LOGGER)
 	LOGGER.setLevel(logging.DEBUG)
 
 else:
 	FILE_LOGGER.setLevel(logging.INFO)
 	LOGGER.setLevel(logging.INFO)
 
+LOG_QUEUE.start()
+
 # Import PyMata libraries
 try:
-	from pymata_aio.pymata3 import PyMata3
 	from pymata_aio.constants import Constants
 except ModuleNotFoundError as e:
 	LOGGER.error(e)
@@ -92,98 +92,120 @@ except FileNotFoundError:
 
 # Import local libraries
 import thermostat
-from sensors import TempSensor
 from hvac import HVAC as hvac
+from boards import BoardManager
+from acquisition import AcquisitionEngine, ReportingEngine
+from scheduler import ControlScheduler
+from zones import Zone, SharedUnit, Damper
+from controllers import makeController
+from actuator import RelayQueue
+from historylog import HistoryLog
+from statefile import StateStore, captureSettings, restoreSettings, captureReadings, restoreReadings
 
 thermostat_time = time.ctime(time.time())
 
-# Start up the Arduino board
-# Specify a com_port so that more than one board can be used
-board = PyMata3(com_port="/dev/ttyACM0")
+# What was going on before the last shutdown, and the compiled temp programs
+STATE_SETTINGS = SETTINGS["STATE"]
+STATE = StateStore(Path.home().joinpath(SETTINGS["USER_DIR"]).joinpath(STATE_SETTINGS["FILE"]))
+SAVED_STATE = STATE.load()
+
+# Start up the Arduino boards
+# Each board is named in the config with its com_port so that more than one board can be used
+BOARDS = BoardManager(SETTINGS["BOARDS"])
 
 # Setup the thermostat
 
-#THERMOSTAT = thermostat.Thermostat(board=board)
 THERMOSTAT = thermostat.Thermostat()
 
-# Add the temp sensors to the thermostat
+# Add the temp sensors and groups to the thermostat
 if SETTINGS["SENSORS"]:
-	for area, sensor in SETTINGS["SENSORS"].items():
-		THERMOSTAT.addSensor(TempSensor(sensor[0], sensor[1]), area)
-		# Add it to the board
-		board.set_pin_mode(THERMOSTAT.tempSensors[area].controlPin, Constants.ANALOG)
-		LOGGER.debug("Sensor {} of type {} added on pin {}".format(sensor, THERMOSTAT.tempSensors[area].moduleType, THERMOSTAT.tempSensors[area].controlPin))
+	THERMOSTAT.loadSettings(SETTINGS)
+	BOARDS.assignSensors(SETTINGS)
 else:
 	LOGGER.error("No sensors in config file")
 	sys.exit()
 
-# Create a group to get an average temp of the house
-if SETTINGS["SENSOR_GROUPS"]:
-	for group, sensors in SETTINGS["SENSOR_GROUPS"].items():
-		THERMOSTAT.createGroup(group)
-		# Add the sensors to the group
-		for sensor in sensors:
-			if sensor in THERMOSTAT.tempSensors:
-				THERMOSTAT.addSensorToGroup(group, THERMOSTAT.tempSensors[sensor])
-				LOGGER.debug("Sensor {} added to group {}".format(sensor, group))
-
 # Set up the HVAC
 HVAC = hvac()
 
 # Set the pins for heating and cooling control
-HVAC.heatControl = (SETTINGS["HVAC"]["CONTROL_PINS"]["HEAT_ON"], SETTINGS["HVAC"]["CONTROL_PINS"]["HEAT_OFF"], SETTINGS["HVAC"]["CONTROL_PINS"]["HEAT_SENSE"])
-HVAC.coolControl = (SETTINGS["HVAC"]["CONTROL_PINS"]["COOL_ON"], SETTINGS["HVAC"]["CONTROL_PINS"]["COOL_OFF"], SETTINGS["HVAC"]["CONTROL_PINS"]["COOL_SENSE"])
+HVAC.loadSettings(SETTINGS)
 
-# Add them to the board
-board.set_pin_mode(HVAC.heatControl[0], Constants.OUTPUT)
-board.set_pin_mode(HVAC.heatControl[1], Constants.OUTPUT)
+HVAC_BOARD = BOARDS.boardName(SETTINGS["HVAC"].get("BOARD"))
 
-board.set_pin_mode(HVAC.coolControl[0], Constants.OUTPUT)
-board.set_pin_mode(HVAC.coolControl[1], Constants.OUTPUT)
-
-# Set up the signal handler for shutdown
-def shutdown(sig, frame):
-	if board:
-		board.shutdown()
-	sys.exit()
+def makeActuator(device, boardName):
+	"""
+	Returns a coroutine function that turns device (a Damper) on or off
+	through the board it is on
 
-signal.signal(signal.SIGTERM, shutdown)
-signal.signal(signal.SIGINT, shutdown)
+	device => The Damper
 
-def turnOnOff(heatCool, onOff):
+	boardName => The name of the board in BOARDS
 	"""
-	heatCool => Either the heater or A/C
-		Valid entrys -- "heat"  "cool"
-	onOff => Turn the HVAC on or off
-		Valid entrys -- "on"  "off"
+	async def turnOnOff(heatCool, onOff):
+		"""
+		heatCool => Either the heater or A/C
+			Valid entrys -- "heat"  "cool"
+		onOff => Turn the HVAC on or off
+			Valid entrys -- "on"  "off"
+		"""
+		core = BOARDS.core(boardName)
+		if core is None:
+			raise RuntimeError("Board {} is not connected".format(boardName))
+		await device.turnOnOff(core, heatCool, onOff)
+	return turnOnOff
+
+def makeRelayQueue(device, boardName):
 	"""
-	LOGGER.debug("in turnOnOff: {}  {}".format(heatCool, onOff))
-	if heatCool.upper() == "HEAT":
-		hc = HVAC.heatControl
-		#HVAC.state = heatCool.upper()
-	elif heatCool.upper() == "COOL":
-		hc = HVAC.coolControl
-		#HVAC.state = heatCool.upper()
-	else:
-		raise AttributeError("Only 'heat' and 'cool' are valid attributes")
-
-	if onOff.upper() == "OFF":
-		HVAC.state = "OFF"
-	else:
-		HVAC.state = heatCool.upper()
-
-	if onOff.upper() == "ON":
-		board.digital_write(hc[0], 1)
-		board.sleep(0.1)
-		board.digital_write(hc[0], 0)
-		board.sleep(0.1)
-	elif onOff.upper() == "OFF":
-		board.digital_write(hc[1], 1)
-		board.sleep(0.1)
-		board.digital_write(hc[1], 0)
-		board.sleep(0.1)
+	Returns a RelayQueue that pulses device (an HVAC) through the board it is on
+	"""
+	return RelayQueue(device, lambda: BOARDS.core(boardName), SETTINGS["HVAC"]["MIN_ON_TIME"], SETTINGS["HVAC"]["MIN_OFF_TIME"])
+
+# Pulses the relays in the background and checks the sense pins
+turnOnOff = makeRelayQueue(HVAC, HVAC_BOARD)
+# {name: (board, RelayQueue)} for every HVAC
+RELAYS = {"HVAC": (HVAC_BOARD, turnOnOff)}
+
+# Set up the zones.  Each has its own HVAC, or a damper on the main HVAC.
+ZONES = []
+# [(board, pin)] outputs used by the zones
+ZONE_PINS = []
+MAIN_UNIT = None
+for name, zoneSettings in SETTINGS["ZONES"].items():
+	zoneBoard = BOARDS.boardName(zoneSettings.get("BOARD"))
+	if "CONTROL_PINS" in zoneSettings:
+		zoneHVAC = hvac()
+		zoneHVAC.loadSettings({"HVAC": zoneSettings})
+		output = actuate = makeRelayQueue(zoneHVAC, zoneBoard)
+		RELAYS["HVAC." + name.upper()] = (zoneBoard, output)
+	elif "DAMPER_PIN" in zoneSettings:
+		if MAIN_UNIT is None:
+			MAIN_UNIT = SharedUnit(turnOnOff, turnOnOff)
+		output = Damper(MAIN_UNIT, zoneSettings["DAMPER_PIN"])
+		actuate = makeActuator(output, zoneBoard)
+		ZONE_PINS.append((zoneBoard, zoneSettings["DAMPER_PIN"]))
 	else:
-		raise AttributeError("Only 'on' or 'off' are valid attributes")
+		LOGGER.error("Zone {} needs CONTROL_PINS or a DAMPER_PIN".format(name))
+		continue
+	zone = Zone(name, zoneSettings.get("GROUP", name), output, actuate, STATE.compileSchedules(zoneSettings.get("TEMP_SETTINGS", SETTINGS["TEMP_SETTINGS"])), controller=makeController(zoneSettings.get("CONTROL", SETTINGS["CONTROL"])))
+	zone.settings.setpoint = zoneSettings.get("TEMP_SETTINGS", SETTINGS["TEMP_SETTINGS"])["DEFAULT_TEMP"]
+	zone.settings.state = zoneSettings.get("STATE", "HEAT")
+	ZONES.append(zone)
+
+async def setupPins():
+	# Add the sensors to their boards
+	for area, sensor in THERMOSTAT.tempSensors.items():
+		await BOARDS.setPinMode(BOARDS.sensorBoards[area], sensor.controlPin, Constants.ANALOG)
+		LOGGER.debug("Sensor {} of type {} added on board {} pin {}".format(area, sensor.moduleType, BOARDS.sensorBoards[area], sensor.controlPin))
+
+	# Add the HVAC control pins, and watch the sense pins so a change can be checked
+	for relayBoard, relays in RELAYS.values():
+		for pin in relays.hvac.heatControl[:2] + relays.hvac.coolControl[:2]:
+			await BOARDS.setPinMode(relayBoard, pin, Constants.OUTPUT)
+		for pin in (relays.hvac.heatControl[2], relays.hvac.coolControl[2]):
+			await BOARDS.setPinMode(relayBoard, pin, Constants.INPUT, relays.senseChanged)
+	for zoneBoard, pin in ZONE_PINS:
+		await BOARDS.setPinMode(zoneBoard, pin, Constants.OUTPUT)
 
 def setOutput(temp):
 	if SETTINGS["OUTPUT_FORMAT"] == "F":
@@ -191,62 +213,239 @@ def setOutput(temp):
 	LOGGER.debug(temp)
 	return temp
 
-def readSensors():
-	for sensor in THERMOSTAT.tempSensors:
-		THERMOSTAT.tempSensors[sensor].tempC = board.analog_read(THERMOSTAT.tempSensors[sensor].controlPin)
-		LOGGER.debug(THERMOSTAT.tempSensors[sensor].tempC)
-
+# Optionally publish and keep the history in their own processes, so they
+# can't hold up the control loop.  They follow a ring in shared memory.
+PROCESSES = SETTINGS["PROCESSES"]
+RING = None
+SUPERVISOR = None
+if PROCESSES["ENABLED"]:
+	from sharedring import SharedRing
+	from workers import ProcessSupervisor, publishWorker, historyWorker
+	RING = SharedRing(PROCESSES["RING_NAME"], list(THERMOSTAT.tempSensors) + list(RELAYS) + [THERMOSTAT.name, "OUTDOOR"] + [zone.name for zone in ZONES], PROCESSES["RING_SLOTS"])
+	SUPERVISOR = ProcessSupervisor()
+
+# Publish every new set of readings over one MQTT connection
+MQTT_PUBLISHER = None
+MQTT = SETTINGS["MQTT"]
+if MQTT["ENABLED"] and SUPERVISOR:
+	SUPERVISOR.add("MQTT", publishWorker, RING.name, MQTT, PROCESSES["POLL_INTERVAL"])
+elif MQTT["ENABLED"]:
+	# Only load paho when it is going to be used
+	from publisher import MQTTPublisher, MQTT_ENABLED
+if MQTT["ENABLED"] and not SUPERVISOR and MQTT_ENABLED:
+	MQTT_PUBLISHER = MQTTPublisher(MQTT["HOSTNAME"], MQTT["PORT"], MQTT["USERNAME"], MQTT["PASSWORD"], MQTT["BASE_TOPIC"], MQTT["QOS"], MQTT["RETAIN"], MQTT["QUEUE_SIZE"], MQTT["TLS"])
+
+	def publishTemp(snapshot):
+		readings = {}
+		for location in snapshot:
+			temp = THERMOSTAT.getTemp(location)
+			if temp is not None:
+				readings[location.lower()] = round(temp)
+		try:
+			MQTT_PUBLISHER.publish(readings)
+		except Exception as e:
+			LOGGER.error("Something went wrong with publish.  {}".format(e))
+
+	BOARDS.addListener(publishTemp)
+
+# Keep every reading and state change in the binary history
+HISTORY_SETTINGS = SETTINGS["HISTORY_LOG"]
+HISTORY_DIR = Path.home().joinpath(SETTINGS["USER_DIR"]).joinpath(HISTORY_SETTINGS["FILE_DIR"])
+HISTORY = None
+if SUPERVISOR:
+	# Kept here so a restarted history worker goes on where the last one stopped
+	HISTORY_POSITION = SUPERVISOR.context.Value("Q", 0, lock=False)
+	SUPERVISOR.add("HISTORY", historyWorker, RING.name, HISTORY_DIR, HISTORY_SETTINGS["RAW_DAYS"], HISTORY_SETTINGS["MINUTE_DAYS"], PROCESSES["POLL_INTERVAL"], HISTORY_POSITION)
+	# The history worker writes what goes in the ring
+	RECORDER = RING
+else:
+	HISTORY = HistoryLog(HISTORY_DIR)
+	HISTORY.prune(time.time() - HISTORY_SETTINGS["RAW_DAYS"] * 86400, time.time() - HISTORY_SETTINGS["MINUTE_DAYS"] * 86400)
+	RECORDER = HISTORY
+
+BOARDS.addListener(lambda snapshot: RECORDER.addSnapshot(snapshot, THERMOSTAT.tempSensors))
+HVAC.addListener(lambda device, old, new: RECORDER.addTransition("HVAC", new, time.time()))
+for zone in ZONES:
+	if isinstance(zone.hvac, RelayQueue):
+		zone.hvac.hvac.addListener(lambda device, old, new, name=zone.name: RECORDER.addTransition("HVAC." + name, new, time.time()))
+
+def logSettings(settings, setting):
+	if setting in ("state", "mode"):
+		RECORDER.addTransition(settings.name, getattr(settings, setting), time.time())
+
+THERMOSTAT.addListener(logSettings)
+for zone in ZONES:
+	zone.settings.addListener(logSettings)
+
+# The weekly temp program
+SCHEDULES = STATE.compileSchedules(SETTINGS["TEMP_SETTINGS"])
+
+# The outdoor temp and forecast, refreshed in the background
+OUTDOOR = None
+if SETTINGS["OUTDOOR"]["ENABLED"]:
+	from outdoor import OutdoorConditions, makeProvider
+	OUTDOOR_SETTINGS = dict(SETTINGS["OUTDOOR"])
+	OUTDOOR_SETTINGS["FILE"] = Path.home().joinpath(SETTINGS["USER_DIR"]).joinpath(OUTDOOR_SETTINGS["FILE"])
+	OUTDOOR = OutdoorConditions(makeProvider(OUTDOOR_SETTINGS, THERMOSTAT), OUTDOOR_SETTINGS["TTL"], OUTDOOR_SETTINGS["REFRESH_INTERVAL"], OUTDOOR_SETTINGS["TIMEOUT"])
+	OUTDOOR.addListener(lambda conditions: RECORDER.addSample("OUTDOOR", conditions.temp, time.time()))
+
+# Switch the program between the HOME and AWAY settings when everyone leaves
+OCCUPANCY = None
+if SETTINGS["OCCUPANCY"]["ENABLED"]:
+	from occupancy import OccupancyMonitor, makeProbe, setOccupancy
+	OCCUPANCY_SETTINGS = SETTINGS["OCCUPANCY"]
+	OCCUPANCY = OccupancyMonitor([makeProbe(probe) for probe in OCCUPANCY_SETTINGS["PROBES"]], OCCUPANCY_SETTINGS["INTERVAL"], OCCUPANCY_SETTINGS["TIMEOUT"], OCCUPANCY_SETTINGS["MAX_BACKOFF"], OCCUPANCY_SETTINGS["AWAY_DELAY"], OCCUPANCY_SETTINGS["HOME_DELAY"], OCCUPANCY_SETTINGS["MAX_CONCURRENT"])
+
+# Run the HVAC when there is new data or the settings change
+if MAIN_UNIT:
+	# The main HVAC is only run through the zone dampers
+	SCHEDULER = ControlScheduler(THERMOSTAT, convert=setOutput, outdoor=OUTDOOR, seasonBand=SETTINGS["SEASON_BAND"])
+else:
+	SCHEDULER = ControlScheduler(THERMOSTAT, turnOnOff, turnOnOff, area="HOUSE", convert=setOutput, schedules=SCHEDULES, outdoor=OUTDOOR, controller=makeController(SETTINGS["CONTROL"]), seasonBand=SETTINGS["SEASON_BAND"])
+for zone in ZONES:
+	SCHEDULER.addZone(zone)
+BOARDS.addListener(SCHEDULER.notify)
+if OCCUPANCY:
+	OCCUPANCY.addListener(lambda monitor, state: setOccupancy(SCHEDULER, state))
+
+THERMOSTAT.setpoint = SETTINGS["TEMP_SETTINGS"]["DEFAULT_TEMP"]
 THERMOSTAT.state = "HEAT"
 
-# Turn everything off
-turnOnOff("heat", "off")
-turnOnOff("cool", "off")
+# Carry on with the settings and readings from before the restart
+SAVED_SETTINGS = SAVED_STATE.get("SETTINGS", {})
+if "THERMOSTAT" in SAVED_SETTINGS:
+	restoreSettings(THERMOSTAT, SAVED_SETTINGS["THERMOSTAT"])
+for name, zone in SCHEDULER.zones.items():
+	if name in SAVED_SETTINGS:
+		zone.holdUntil = SAVED_SETTINGS[name]["holdUntil"]
+		if zone.settings is not THERMOSTAT:
+			restoreSettings(zone.settings, SAVED_SETTINGS[name])
+restored = restoreReadings(THERMOSTAT, SAVED_STATE.get("READINGS", {}), STATE_SETTINGS["READINGS_MAX_AGE"])
+if restored:
+	LOGGER.info("Using {} saved readings until the sensors are read".format(restored))
+
+def saveState():
+	return STATE.save({
+		"HVAC": {name: {"state": relays.hvac.state, "lastChange": relays.lastChange} for name, (relayBoard, relays) in RELAYS.items()},
+		"SETTINGS": dict({name: captureSettings(zone.settings, zone.holdUntil) for name, zone in SCHEDULER.zones.items()}, THERMOSTAT=captureSettings(THERMOSTAT)),
+		"READINGS": captureReadings(THERMOSTAT),
+		})
+
+async def saveStatePeriodically():
+	while True:
+		await asyncio.sleep(STATE_SETTINGS["SAVE_INTERVAL"])
+		saveState()
+
+# Read the sensors slowly when the house is far from the setpoint and fast near it
+READ_INTERVAL = SETTINGS["READ_INTERVAL"]
+SAMPLER = None
+if SETTINGS["SAMPLING"]["ADAPTIVE"]:
+	from sampling import AdaptiveSampler
+	SAMPLING = SETTINGS["SAMPLING"]
+	SAMPLER = AdaptiveSampler(SCHEDULER, SAMPLING["MIN_INTERVAL"], SAMPLING["MAX_INTERVAL"], SAMPLING["NEAR_BAND"], SAMPLING["FAR_BAND"], SAMPLING["BOOST_TIME"], SETTINGS["READ_INTERVAL"])
+	READ_INTERVAL = SAMPLER.nextInterval
+	BOARDS.addListener(SAMPLER.countReads)
+	# Work out the wait again after every tick so a change takes effect right away
+	SCHEDULER.addListener(lambda scheduler, zones: BOARDS.wakeUp())
+
+# Get the sensor values from Firmata's analog reports instead of reading them
+ACQUISITION = SETTINGS["ACQUISITION"]
+ENGINE = AcquisitionEngine
+if ACQUISITION["MODE"].upper() == "REPORT":
+	ENGINE = functools.partial(ReportingEngine, samplingInterval=ACQUISITION["SAMPLING_INTERVAL"], delta=ACQUISITION["DELTA"], heartbeat=ACQUISITION["HEARTBEAT"], pollInterval=SETTINGS["READ_INTERVAL"])
+
+# Serve the status to the tablet.  Set WEB_API.TOKEN to allow setpoint changes.
+WEB_API = None
+if SETTINGS["WEB_API"]["ENABLED"]:
+	from webapi import StatusAPI
+	WEB = SETTINGS["WEB_API"]
+	WEB_API = StatusAPI(SCHEDULER, HVAC, WEB["TOKEN"] or None, WEB["HOST"], WEB["PORT"], WEB["MAX_CLIENTS"], minSetpoint=WEB["MIN_SETPOINT"], maxSetpoint=WEB["MAX_SETPOINT"])
+
+# Counters and timings for Prometheus, on this machine only by default
+METRICS_SERVER = None
+if SETTINGS["METRICS"]["ENABLED"]:
+	from metrics import ThermostatMetrics, MetricsServer
+	METRICS = ThermostatMetrics(SCHEDULER)
+	METRICS.watchBoards(BOARDS)
+	for name, (relayBoard, relays) in RELAYS.items():
+		METRICS.watchRelays(name, relays)
+	METRICS_SERVER = MetricsServer(METRICS.registry, SETTINGS["METRICS"]["HOST"], SETTINGS["METRICS"]["PORT"])
+
+async def main():
+	# Fork the workers before any serial ports or sockets are opened
+	if SUPERVISOR:
+		SUPERVISOR.startAll()
+
+	if MQTT_PUBLISHER:
+		MQTT_PUBLISHER.start()
+
+	if WEB_API:
+		await WEB_API.start()
+
+	if METRICS_SERVER:
+		await METRICS_SERVER.start()
+
+	await setupPins()
+	failed = await BOARDS.connectAll()
+	if failed:
+		LOGGER.error("Could not connect to boards {}.  Will keep trying".format(failed))
+
+	# Close the dampers, the scheduler opens the ones that are needed
+	for zone in ZONES:
+		if isinstance(zone.hvac, Damper):
+			try:
+				await zone.actuate("heat", "off")
+			except Exception as e:
+				LOGGER.error(e)
+	# The latching relays keep their state, so carry on with whatever the sense
+	# pins show.  Only turn them off if that can't be worked out.  A board that
+	# isn't connected yet is read when it connects.
+	savedHVAC = SAVED_STATE.get("HVAC", {})
+	for name, (relayBoard, relays) in RELAYS.items():
+		await relays.start(savedHVAC.get(name))
+		BOARDS.addConnectListener(lambda boardName, relayBoard=relayBoard, relays=relays: relays.boardConnected() if boardName == relayBoard else None)
+
+	# Each board reads its sensors on a timer, the scheduler reacts to each new
+	# reading, and the relay queues pulse the relays when asked
+	tasks = [BOARDS.run(THERMOSTAT, READ_INTERVAL, ENGINE), SCHEDULER.run(), saveStatePeriodically()]
+	tasks.extend(relays.run() for relayBoard, relays in RELAYS.values())
+	if SUPERVISOR:
+		tasks.append(SUPERVISOR.run())
+	if OUTDOOR:
+		tasks.append(OUTDOOR.run())
+	if OCCUPANCY:
+		tasks.append(OCCUPANCY.run(BOARDS))
+	await asyncio.gather(*tasks)
 
 # Main loop
+LOOP = asyncio.get_event_loop()
+MAIN = asyncio.ensure_future(main(), loop=LOOP)
+
+# Set up the signal handler for shutdown
+LOOP.add_signal_handler(signal.SIGTERM, MAIN.cancel)
+LOOP.add_signal_handler(signal.SIGINT, MAIN.cancel)
 
-while True:
-	while THERMOSTAT.state == "HEAT":
-		while HVAC.state == "OFF":
-			# Get the readings from the sensors
-			readSensors()
-			# Get the average temp of the house
-			houseTemp = setOutput(THERMOSTAT.getTemp("HOUSE"))
-			# Use round to keep the temp +- 0.5 deg
-			print("state off:  {}".format(round(houseTemp)))
-			if round(houseTemp) < SETTINGS["TEMP_SETTINGS"]["DEFAULT_TEMP"]:
-				print("turn heat on")
-				# It's cold, turn the heater on
-				try:
-					turnOnOff("heat", "on")
-				except AttributeError:
-					# Put log entry here
-					pass
-				except Exception as e:
-					LOGGER.error("Could not change HVAC state.  {}".format(e))
-			board.sleep(15)
-		while HVAC.state == "HEAT":
-			# The heater is on, check to see if the temp is warm enough
-			readSensors()
-			# Get the average temp of the house
-			houseTemp = setOutput(THERMOSTAT.getTemp("HOUSE"))
-			# Use round to keep the temp +- 0.5 deg
-			if round(houseTemp) > SETTINGS["TEMP_SETTINGS"]["DEFAULT_TEMP"]:
-				# Warm enough, turn the heater off
-				try:
-					turnOnOff("heat", "off")
-				except AttributeError:
-					# Put log entry here
-					pass
-				except Exception as e:
-					LOGGER.error("Could not change HVAC state.  {}".format(e))
-			board.sleep(15)
-
-	while THERMOSTAT.state == "COOL":
-		# Enable the cool sensor pin callback
-		board.set_pin_mode(HVAC.coolControl[2], Constants.INPUT, HVAC.setCoolState)
-		# Disable the heat sensor callback
-		board.set_pin_mode(HVAC.heatControl[2], Constants.INPUT)
-		while HVAC.state == "OFF":
-			pass
-		while HVAC.state == "COOL":
-			pass
+try:
+	LOOP.run_until_complete(MAIN)
+except asyncio.CancelledError:
+	LOGGER.info("Shutting down")
+	if SAMPLER:
+		LOGGER.info("Sampling:  {}".format(SAMPLER.metrics()))
+	for name, engine in BOARDS.engines.items():
+		if hasattr(engine, "metrics"):
+			LOGGER.info("Analog reports on {}:  {}".format(name, engine.metrics()))
+finally:
+	if MQTT_PUBLISHER:
+		MQTT_PUBLISHER.stop()
+	if WEB_API:
+		LOOP.run_until_complete(WEB_API.stop())
+	if METRICS_SERVER:
+		LOOP.run_until_complete(METRICS_SERVER.stop())
+	saveState()
+	LOOP.run_until_complete(BOARDS.shutdown())
+	if SUPERVISOR:
+		SUPERVISOR.stop()
+		RING.close()
+	if HISTORY:
+		HISTORY.close()
+	LOG_QUEUE.stop()
@@ -0,0 +1,183 @@
+"""
+Save what the thermostat was doing so it can pick up where it left off.
+
+The state file is written on shutdown and every so often while running.  It
+holds the HVAC states and when they last changed, the state / mode /
+setpoint of the Thermostat and each zone, and the last reading of every
+sensor.
+
+The compiled temp programs are kept next to it in a .schedules file so they
+don't have to be built again.  That one is only written when the programs
+change, not on every save, to spare the SD card.  The HOME / AWAY setting
+in them is not kept, the occupancy monitor works it out again.
+
+The files are pickles written to a temp file and moved into place, so a
+power cut while saving leaves the old one.  Anything that can't be read is
+ignored and the thermostat starts cold.
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+import hashlib
+import json
+import os
+import pickle
+import time
+from pathlib import Path
+
+from schedule import compileSchedules
+
+LOGGER = logging.getLogger("__main__.statefile.py")
+
+# Change this when the layout of the saved state changes
+STATE_VERSION = 2
+
+class StateStore:
+	"""
+	Loads and saves the state file
+	"""
+	def __init__(self, path, clock=time.time):
+		"""
+		path => The state file
+
+		<optional> clock => Function returning the current time in seconds
+		"""
+		self.LOGGER = logging.getLogger("__main__.statefile.StateStore")
+
+		self.path = Path(path)
+		self.schedulePath = self.path.with_suffix(".schedules")
+		self.clock = clock
+		self.state = {}
+		# {settings key: {season: Schedule}} from the schedule file, and the
+		# ones used this run which are the only ones saved again
+		self.savedSchedules = {}
+		self.schedules = {}
+		# The settings keys in the schedule file, to know when it needs writing
+		self.writtenSchedules = None
+
+	def load(self):
+		"""
+		Read the state file.  Returns the state, or {} if there isn't a good one.
+		"""
+		self.savedSchedules = self.loadSchedules()
+		try:
+			with open(self.path, "rb") as stateFile:
+				state = pickle.load(stateFile)
+		except FileNotFoundError:
+			self.LOGGER.info("No state file, starting cold")
+			return {}
+		except Exception as e:
+			self.LOGGER.warning("Could not read the state file, starting cold.  {!r}".format(e))
+			return {}
+		if not isinstance(state, dict) or state.get("VERSION") != STATE_VERSION:
+			self.LOGGER.warning("The state file is from a different version, starting cold")
+			return {}
+		self.state = state
+		self.LOGGER.info("Loaded the state saved {:.0f}s ago".format(self.clock() - state.get("SAVED", 0)))
+		return state
+
+	def loadSchedules(self):
+		"""
+		Returns the {settings key: {season: Schedule}} in the schedule file, or {}
+		"""
+		try:
+			with open(self.schedulePath, "rb") as scheduleFile:
+				saved = pickle.load(scheduleFile)
+		except FileNotFoundError:
+			return {}
+		except Exception as e:
+			self.LOGGER.warning("Could not read the schedule file, compiling again.  {!r}".format(e))
+			return {}
+		if not isinstance(saved, dict) or saved.get("VERSION") != STATE_VERSION:
+			return {}
+		schedules = saved.get("SCHEDULES", {})
+		for seasons in schedules.values():
+			for schedule in seasons.values():
+				# HOME / AWAY is set again by the occupancy monitor, if it is on
+				schedule.active = None
+		self.writtenSchedules = set(schedules)
+		return schedules
+
+	def write(self, path, data):
+		"""
+		Pickle data to path through a temp file.  Returns True if it worked.
+		"""
+		temp = path.with_name(path.name + ".tmp")
+		try:
+			os.makedirs(path.parent, exist_ok=True)
+			with open(temp, "wb") as stateFile:
+				pickle.dump(data, stateFile, protocol=pickle.HIGHEST_PROTOCOL)
+				stateFile.flush()
+				os.fsync(stateFile.fileno())
+			os.replace(temp, path)
+		except Exception as e:
+			self.LOGGER.error("Could not save {}.  {!r}".format(path, e))
+			return False
+		return True
+
+	def save(self, state):
+		"""
+		Write the state file, and the schedule file if the compiled schedules
+		aren't the ones in it
+		"""
+		if set(self.schedules) != self.writtenSchedules:
+			if self.write(self.schedulePath, {"VERSION": STATE_VERSION, "SCHEDULES": self.schedules}):
+				self.writtenSchedules = set(self.schedules)
+		state = dict(state, VERSION=STATE_VERSION, SAVED=self.clock())
+		if not self.write(self.path, state):
+			return False
+		self.state = state
+		return True
+
+	def compileSchedules(self, tempSettings):
+		"""
+		The same as schedule.compileSchedules, but uses the saved copy if
+		tempSettings hasn't changed
+		"""
+		key = hashlib.sha1(json.dumps(tempSettings, sort_keys=True).encode()).hexdigest()
+		if key not in self.schedules:
+			if key in self.savedSchedules:
+				self.schedules[key] = self.savedSchedules[key]
+			else:
+				self.schedules[key] = compileSchedules(tempSettings)
+		return self.schedules[key]
+
+def captureSettings(settings, holdUntil=None):
+	"""
+	Returns the state, mode and setpoint of a ControlSettings as a dict
+	"""
+	return {"state": settings.state, "mode": settings.mode, "setpoint": settings.setpoint, "holdUntil": holdUntil}
+
+def restoreSettings(settings, saved):
+	"""
+	Put back what captureSettings saved
+	"""
+	settings.mode = saved["mode"]
+	settings.state = saved["state"]
+	if saved["setpoint"] is not None:
+		settings.setpoint = saved["setpoint"]
+
+def captureReadings(thermostat):
+	"""
+	Returns {location: (raw, temp, timestamp)} of the last reading of every sensor
+	"""
+	return {location: (sensor.rawValue, sensor.tempC, sensor.timestamp) for location, sensor in thermostat.tempSensors.items() if sensor.timestamp is not None}
+
+def restoreReadings(thermostat, readings, maxAge, now=None):
+	"""
+	Put back readings that are newer than maxAge seconds so there is a temp
+	before the first read.  Returns how many were put back.
+	"""
+	now = time.time() if now is None else now
+	restored = 0
+	for location, (raw, temp, timestamp) in readings.items():
+		sensor = thermostat.tempSensors.get(location)
+		if sensor is None or temp is None or now - timestamp > maxAge:
+			continue
+		sensor.update(raw, timestamp, temp)
+		restored += 1
+	thermostat.clearReadings()
+	return restored
@@ -4,40 +4,249 @@ import json
 from pathlib import Path
 import sys
 import os
+import time
+import heapq
+import itertools
+from collections import namedtuple, deque
+
+from conversions import ConversionPlan
+from filters import makeFilterChain
+from sensors import TempSensor, HISTORY_SIZE
 
 LOGGER = logging.getLogger("__main__.  thermostat.py")
 
 CONFIG_FILE = Path(sys.path[0]).joinpath("config/default.json")
 
 MODE = ["AUTO", "MANUAL"]
-STATES = ["OFF", "FAN", "HEAT", "COOL"]
+# AUTO heats or cools, whichever is needed
+STATES = ["OFF", "FAN", "HEAT", "COOL", "AUTO"]
 
-class Thermostat:
-	"""
-	A class to create a Thermostat module.
+# A temp with the time it was read.  For a group the timestamp is the oldest
+# reading used, count is how many sensors were used and total how many are
+# in the group.  count < total means some were left out for being stale or
+# never read.
+Reading = namedtuple("Reading", ["temp", "timestamp", "count", "total"])
 
-	It can contain any number of sensors as long as a formula is created.
+def _readAt(sensor):
+	# Never read sorts before everything so it is always stale
+	return sensor.timestamp if sensor.timestamp is not None else float("-inf")
 
-	You can also group the sensors to get an average temp of the group.
+class SensorGroup:
 	"""
-	# STATES.FAN is not implemented yet
+	A group of sensors, and other groups, that keeps its mean, min, max and
+	count up to date as the sensors change so reading them is O(1).
 
-	def __init__(self, *args, **kwargs):
+	It also keeps the sensors whose reading went stale, so the mean of the
+	fresh ones only costs the sensors that went stale since it was last asked.
+	"""
+	def __init__(self, name):
 		"""
-		args => Not used yet
+		name => Name of the group
+		"""
+		self.LOGGER = logging.getLogger("__main__.thermostat.SensorGroup")
 
-		kwargs => When called, any setting can be overridden here in the
-				format   SETTING=VALUE
+		self.name = name
+		# Sensors and groups added directly to this group.  dicts keep the order.
+		self.sensors = {}
+		self.groups = {}
+		self.parents = {}
+		# Every sensor in this group and the groups inside it, with the number
+		# of ways it got here so a sensor in two sub groups is only counted once
+		self.members = {}
+
+		self.count = 0
+		self.total = 0.0
+		self._min = None
+		self._max = None
+		self._minSensor = None
+		self._maxSensor = None
+		self._dirty = False
+
+		# {sensor: temp counted in total} for the sensors found stale by fresh()
+		self.stale = {}
+		self.staleTotal = 0.0
+		# (time read, order, sensor) for every reading, oldest first.  Readings
+		# nearly always come in time order and just go on the end of the
+		# deque.  The few that don't go in the heap.  Entries for readings
+		# that were replaced are skipped when they get to the front.
+		self._readings = deque()
+		self._late = []
+		self._order = itertools.count()
+		# {sensor: its entry} for every fresh sensor with a temp
+		self._entries = {}
+
+	def __len__(self):
+		return len(self.members)
+
+	def __contains__(self, sensor):
+		return sensor in self.members
+
+	def __iter__(self):
+		return iter(self.members)
+
+	def addMember(self, sensor):
+		"""
+		Count a sensor in the totals.  Returns True if it is new to the group.
 		"""
+		if sensor in self.members:
+			self.members[sensor] += 1
+			return False
+		self.members[sensor] = 1
+		self.update(sensor, None, sensor.tempC)
+		return True
 
+	def update(self, sensor, oldTemp, newTemp):
+		"""
+		Change the totals when a sensor goes from oldTemp to newTemp, or was
+		read again
+		"""
+		if sensor in self.stale:
+			self.staleTotal -= self.stale.pop(sensor)
+			if not self.stale:
+				self.staleTotal = 0.0
+		if oldTemp is not None:
+			self.count -= 1
+			self.total -= oldTemp
+		if newTemp is not None:
+			self.count += 1
+			self.total += newTemp
+			self._addReading(sensor)
+		else:
+			self._entries.pop(sensor, None)
 
-		self.LOGGER = logging.getLogger("__main__.thermostat.Thermostat")
+		if not self.count:
+			# Nothing left, start over so rounding errors don't build up
+			self.total = 0.0
+			self._min = self._max = self._minSensor = self._maxSensor = None
+			self._dirty = False
+			return
 
-		self.tempSensors = {}
-		self.groups = {}
+		if newTemp is not None and (self._min is None or newTemp <= self._min):
+			self._min = newTemp
+			self._minSensor = sensor
+		elif sensor is self._minSensor:
+			# The lowest sensor went up, find the new lowest when it is asked for
+			self._dirty = True
+
+		if newTemp is not None and (self._max is None or newTemp >= self._max):
+			self._max = newTemp
+			self._maxSensor = sensor
+		elif sensor is self._maxSensor:
+			self._dirty = True
+
+	def _addReading(self, sensor):
+		when = _readAt(sensor)
+		entry = self._entries.get(sensor)
+		if entry is not None and entry[0] == when:
+			# Only the temp changed, the entry is still right
+			return
+		entry = (when, next(self._order), sensor)
+		self._entries[sensor] = entry
+		if not self._readings or when >= self._readings[-1][0]:
+			self._readings.append(entry)
+		else:
+			heapq.heappush(self._late, entry)
+		# Every reading adds an entry, so drop the replaced ones now and then
+		if len(self._readings) + len(self._late) > 2 * len(self._entries) + 64:
+			entries = self._entries
+			self._readings = deque(entry for entry in self._readings if entries.get(entry[2]) is entry)
+			self._late = [entry for entry in self._late if entries.get(entry[2]) is entry]
+			heapq.heapify(self._late)
+
+	def fresh(self, cutoff=None):
+		"""
+		Returns (count, total, oldest time read) of the sensors with a temp
+		read at or after cutoff.  Every sensor counts if cutoff is None.
+		"""
+		readings = self._readings
+		late = self._late
+		oldest = None
+		while readings or late:
+			if late and (not readings or late[0] < readings[0]):
+				entry = late[0]
+				pop = lambda: heapq.heappop(late)
+			else:
+				entry = readings[0]
+				pop = readings.popleft
+			when, order, sensor = entry
+			if self._entries.get(sensor) is not entry:
+				# Replaced by a newer reading
+				pop()
+			elif cutoff is not None and when < cutoff:
+				pop()
+				del self._entries[sensor]
+				self.stale[sensor] = sensor.tempC
+				self.staleTotal += sensor.tempC
+			else:
+				oldest = when
+				break
+
+		if oldest == float("-inf"):
+			oldest = None
+		if not self.stale:
+			return self.count, self.total, oldest
+		return self.count - len(self.stale), self.total - self.staleTotal, oldest
+
+	def _refresh(self):
+		self._min = self._max = self._minSensor = self._maxSensor = None
+		for sensor in self.members:
+			temp = sensor.tempC
+			if temp is None:
+				continue
+			if self._min is None or temp < self._min:
+				self._min = temp
+				self._minSensor = sensor
+			if self._max is None or temp > self._max:
+				self._max = temp
+				self._maxSensor = sensor
+		self._dirty = False
+
+	@property
+	def mean(self):
+		if not self.count:
+			return None
+		return self.total / self.count
+
+	@property
+	def min(self):
+		if self._dirty:
+			self._refresh()
+		return self._min
+
+	@property
+	def max(self):
+		if self._dirty:
+			self._refresh()
+		return self._max
+
+class ControlSettings:
+	"""
+	The state, mode and setpoint for something being controlled, the whole
+	Thermostat or one zone of the house.  Listeners are told when they change.
+	"""
+	def __init__(self, name="Thermostat"):
+		"""
+		<optional> name => Used in the log messages
+		"""
+		self.LOGGER = logging.getLogger("__main__.thermostat.ControlSettings")
+		self.name = name
 
 		self._state = "OFF"
 		self._mode = "AUTO"
+		self._setpoint = None
+
+		self.listeners = []
+
+	def addListener(self, callback):
+		"""
+		callback => Called as callback(settings, setting) when the state, mode
+			or setpoint changes
+		"""
+		self.listeners.append(callback)
+
+	def _changed(self, setting):
+		for callback in self.listeners:
+			callback(self, setting)
 
 	@property
 	def state(self):
@@ -48,9 +257,10 @@ class Thermostat:
 		if state in STATES:
 			if state != self.state:
 				self._state = state
-				self.LOGGER.debug("Thermostat state changed to {}".format(state))
+				self.LOGGER.debug("%s state changed to %s", self.name, state)
+				self._changed("state")
 		else:
-			self.LOGGER.warning("{} is not a valid STATE for Thermostat").format(state)
+			self.LOGGER.warning("{} is not a valid STATE for {}".format(state, self.name))
 
 	@property
 	def mode(self):
@@ -61,9 +271,94 @@ class Thermostat:
 		if mode in MODE:
 			if mode != self.mode:
 				self._mode = mode
-				self.LOGGER.info("Thermostat mode changed to {}".format(mode))
+				self.LOGGER.info("{} mode changed to {}".format(self.name, mode))
+				self._changed("mode")
 		else:
-			self.LOGGER.warning("{} is not a valid MODE for Thermostat".format(mode))
+			self.LOGGER.warning("{} is not a valid MODE for {}".format(mode, self.name))
+
+	@property
+	def setpoint(self):
+		return self._setpoint
+
+	@setpoint.setter
+	def setpoint(self, temp):
+		"""
+		temp => The temp to hold, in the OUTPUT_FORMAT units
+		"""
+		if temp != self.setpoint:
+			self._setpoint = temp
+			self.LOGGER.info("{} setpoint changed to {}".format(self.name, temp))
+			self._changed("setpoint")
+
+class Thermostat(ControlSettings):
+	"""
+	A class to create a Thermostat module.
+
+	It can contain any number of sensors as long as a formula is created.
+
+	You can also group the sensors to get an average temp of the group.
+	"""
+	# STATES.FAN is not implemented yet
+
+	def __init__(self, *args, **kwargs):
+		"""
+		args => Not used yet
+
+		kwargs => When called, any setting can be overridden here in the
+				format   SETTING=VALUE
+		"""
+
+
+		ControlSettings.__init__(self)
+		self.LOGGER = logging.getLogger("__main__.thermostat.Thermostat")
+
+		self.tempSensors = {}
+		self.groups = {}
+		# sensor => names of every group it is counted in
+		self.sensorGroups = {}
+		# Converts all of the sensors at once, made when it is first needed
+		self._plan = None
+
+		# Readings older than this many seconds are left out.  None keeps them forever.
+		self.ttl = None
+		self.clock = time.time
+		# {area: (Reading, time it goes stale)} so everything that asks between
+		# reads shares one answer
+		self._readings = {}
+
+	def loadSettings(self, settings):
+		"""
+		Add the sensors and groups from the config
+
+		settings => The config with SENSORS, and optionally SENSOR_CALIBRATION,
+			SENSOR_FILTERS, SENSOR_GROUPS, HISTORY_SIZE and READING_TTL
+		"""
+		self.ttl = settings.get("READING_TTL", self.ttl)
+		calibrations = settings.get("SENSOR_CALIBRATION", {})
+		filters = settings.get("SENSOR_FILTERS", {})
+		for area, sensor in settings["SENSORS"].items():
+			self.addSensor(TempSensor(sensor[0], sensor[1], settings.get("HISTORY_SIZE", HISTORY_SIZE)), area)
+			# Correct sensors that read high or low
+			if area in calibrations:
+				self.tempSensors[area.upper()].calibrate(calibrations[area].get("OFFSET", 0.0), calibrations[area].get("GAIN", 1.0))
+			# Smooth out the noise, each sensor has its own filters
+			chain = makeFilterChain(filters.get(area, filters.get("DEFAULT")))
+			if chain:
+				self.tempSensors[area.upper()].filter = chain
+
+		groups = settings.get("SENSOR_GROUPS", {})
+		# Make all of the groups first so groups can be put inside of other groups
+		for group in groups:
+			self.createGroup(group)
+		for group, sensors in groups.items():
+			# Add the sensors, or other groups, to the group
+			for sensor in sensors:
+				if sensor.upper() in self.tempSensors:
+					self.addSensorToGroup(group, self.tempSensors[sensor.upper()])
+				elif sensor.upper() in self.groups:
+					self.addGroupToGroup(group, sensor)
+				else:
+					self.LOGGER.warning("No sensor or group {} for group {}".format(sensor, group))
 
 	def addSensor(self, sensor, location):
 		"""
@@ -71,8 +366,18 @@ class Thermostat:
 		location => <str> Where the sensor is located.  Used for id
 		"""
 		self.tempSensors[location.upper()] = sensor
+		sensor.addListener(self._sensorChanged)
+		self._plan = None
+		self._readings.clear()
 		self.LOGGER.debug("Sensor {} is added.".format(location.upper()))
 
+	def resetConversions(self):
+		"""
+		Call this after changing the type or calibration of a sensor that is
+		already added
+		"""
+		self._plan = None
+
 	def createGroup(self, name, *args):
 		"""
 		name => Name of the group to be created.
@@ -81,15 +386,30 @@ class Thermostat:
 		"""
 		name = name.upper()
 		if name not in self.groups:
-			groupedSensors = []
+			self.groups[name] = SensorGroup(name)
 			for sensor in args:
-				groupedSensors.append(sensor)
-			self.groups[name] = groupedSensors
+				self.addSensorToGroup(name, sensor)
 			self.LOGGER.debug("Created the group {}".format(name))
 			return True
 		self.LOGGER.warning("The group {} already exists".format(name))
 		return False
 
+	def _addMember(self, group, sensor):
+		"""
+		Count the sensor in a group and every group that group is inside of
+		"""
+		if not group.addMember(sensor):
+			return
+		self.sensorGroups.setdefault(sensor, set()).add(group.name)
+		self._readings.clear()
+		for parent in group.parents.values():
+			self._addMember(parent, sensor)
+
+	def _sensorChanged(self, sensor, oldTemp, newTemp):
+		self._readings.clear()
+		for name in self.sensorGroups.get(sensor, ()):
+			self.groups[name].update(sensor, oldTemp, newTemp)
+
 	def addSensorToGroup(self, group, sensor):
 		"""
 		This function adds a senor to a group so that it's value is added to the
@@ -102,8 +422,9 @@ class Thermostat:
 		group = group.upper()
 
 		if group in self.groups:
-			if sensor not in self.groups[group]:
-				self.groups[group].append(sensor)
+			if sensor not in self.groups[group].sensors:
+				self.groups[group].sensors[sensor] = None
+				self._addMember(self.groups[group], sensor)
 				self.LOGGER.info("Added sensor {} to group {}".format(sensor, group))
 				return True
 			self.LOGGER.warning("{} sensor is already a member of the group {}".format(sensor, group))
@@ -111,30 +432,140 @@ class Thermostat:
 		self.LOGGER.warning("There is no group {}".format(group))
 		return False
 
-	def getTemp(self, area):
+	def addGroupToGroup(self, group, subGroup):
+		"""
+		Put a group inside of another group, like a floor inside of the house.
+		All of the sensors in subGroup are added to the average of group.
+
+		group => The name of the group to add to
+
+		subGroup => The name of the group being added
+		"""
+		group = group.upper()
+		subGroup = subGroup.upper()
+
+		if group not in self.groups or subGroup not in self.groups:
+			self.LOGGER.warning("There is no group {}".format(subGroup if group in self.groups else group))
+			return False
+		if subGroup in self.groups[group].groups:
+			self.LOGGER.warning("{} group is already a member of the group {}".format(subGroup, group))
+			return False
+		# A group can't end up inside of itself
+		if group == subGroup or group in self.getSubGroups(subGroup):
+			self.LOGGER.warning("Adding group {} to {} would make a loop".format(subGroup, group))
+			return False
+
+		parent = self.groups[group]
+		child = self.groups[subGroup]
+		parent.groups[subGroup] = child
+		child.parents[group] = parent
+		for sensor in child.members:
+			self._addMember(parent, sensor)
+		self.LOGGER.info("Added group {} to group {}".format(subGroup, group))
+		return True
+
+	def getSubGroups(self, name):
+		"""
+		Returns the names of every group inside of the group name
+		"""
+		found = set()
+		waiting = list(self.groups[name.upper()].groups)
+		while waiting:
+			subGroup = waiting.pop()
+			if subGroup not in found:
+				found.add(subGroup)
+				waiting.extend(self.groups[subGroup].groups)
+		return found
+
+	def getGroupsFor(self, sensor):
+		"""
+		Returns the names of every group the sensor is counted in
+		"""
+		return self.sensorGroups.get(sensor, set())
+
+	def updateReadings(self, snapshot):
+		"""
+		Update all of the sensors from one read of the board so they all match.
+
+		snapshot => <dict> {location: acquisition.Sample}
+		"""
+		if self._plan is None:
+			self._plan = ConversionPlan(list(self.tempSensors.values()))
+
+		# Convert every reading at once
+		samples = [snapshot.get(location) for location in self.tempSensors]
+		temps = self._plan.convert([sample.raw if sample else None for sample in samples])
+
+		for sensor, sample, temp in zip(self.tempSensors.values(), samples, temps):
+			if sample:
+				sensor.update(sample.raw, sample.timestamp, temp)
+		self._readings.clear()
+
+		for location in snapshot:
+			if location not in self.tempSensors:
+				self.LOGGER.warning("No sensor {} for reading".format(location))
+
+	def clearReadings(self):
+		"""
+		Forget the saved readings.  Call this after updating a sensor without
+		updateReadings.
+		"""
+		self._readings.clear()
+
+	def getReading(self, area):
 		"""
+		Returns a Reading for a sensor or a group, or None if there is no such
+		area.  Sensors read more than ttl seconds ago are left out of it.
+
+		The answer is kept until the next read, or until the oldest reading in
+		it goes stale, so asking again doesn't cost anything.
+
 		area => <str> Can either be the specific location of the sensor,
 			or a group of senors.
 		"""
 		area = area.upper()
-		temp = None
-		# Check the single areas first
-		if area in self.tempSensors:
-			temp = self.tempSensors[area].tempC
-			self.LOGGER.debug("Temp in area {} is {}C".format(area, self.tempSensors[area].tempC))
+		now = self.clock()
+		cached = self._readings.get(area)
+		if cached is not None and now < cached[1]:
+			return cached[0]
 
-		# If not there, check if a group is asked for
+		cutoff = now - self.ttl if self.ttl is not None else None
+		if area in self.tempSensors:
+			sensor = self.tempSensors[area]
+			size = 1
+			count = 0
+			total = 0.0
+			oldest = sensor.timestamp
+			if sensor.tempC is not None and (cutoff is None or (sensor.timestamp is not None and sensor.timestamp >= cutoff)):
+				count = 1
+				total = sensor.tempC
 		elif area in self.groups:
-			tempList = []
-
-			for sensor in self.groups[area]:
-				tempList.append(sensor.tempC)
-			temp = sum(tempList) / len(tempList)
-			self.LOGGER.debug("Temp in area {} is {}C".format(area, sensor.tempC))
-
+			group = self.groups[area]
+			size = len(group)
+			# The group keeps the totals of its fresh sensors
+			count, total, oldest = group.fresh(cutoff)
 		else:
 			self.LOGGER.warning("No area {} in senors or groups".format(area))
 			return None
-		self.LOGGER.debug(temp)
-		return temp
+
+		temp = total / count if count else None
+		if count < size:
+			self.LOGGER.debug("%s of %s sensors used for %s", count, size, area)
+
+		reading = Reading(temp, oldest if count else None, count, size)
+		expires = oldest + self.ttl if cutoff is not None and oldest is not None else float("inf")
+		self._readings[area] = (reading, expires)
+		return reading
+
+	def getTemp(self, area):
+		"""
+		Returns the temp in C, or None if no sensor in the area has a fresh one
+
+		area => <str> Can either be the specific location of the sensor,
+			or a group of senors.
+		"""
+		reading = self.getReading(area)
+		if reading is None:
+			return None
+		return reading.temp
 
@@ -0,0 +1,18 @@
+"""
+Small helpers shared by the modules that are set up from the config.
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+
+LOGGER = logging.getLogger("__main__.utils.py")
+
+def camelCase(name):
+	"""
+	Returns a config key as an argument name, MAX_STEP as maxStep
+	"""
+	parts = name.lower().split("_")
+	return parts[0] + "".join(part.title() for part in parts[1:])
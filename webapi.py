@@ -0,0 +1,362 @@
+"""
+A small HTTP API for the tablet, or anything else, to show and change the
+thermostat.
+
+Only the standard library is used, asyncio.start_server runs in the same
+event loop as the control loop.  The status is turned into JSON once per
+control tick, so a request never touches a board and only has to send bytes
+that are already made.
+
+	GET /status				<- The current status.  Sends an ETag and answers
+								If-None-Match with 304.  Add ?wait=<seconds> with
+								If-None-Match to wait for the next change (long poll).
+	GET /events				<- The status as server sent events, every time it changes
+	POST /setpoint			<- {"zone": "HOUSE", "setpoint": 70}
+								Needs "Authorization: Bearer <token>".  The setpoint
+								is held until the program next changes.  It has to be
+								between MIN_SETPOINT and MAX_SETPOINT.
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+import asyncio
+import hmac
+import json
+import math
+import time
+from urllib.parse import urlsplit, parse_qs
+
+LOGGER = logging.getLogger("__main__.webapi.py")
+
+REASONS = {
+	200: "OK",
+	204: "No Content",
+	304: "Not Modified",
+	400: "Bad Request",
+	401: "Unauthorized",
+	403: "Forbidden",
+	404: "Not Found",
+	405: "Method Not Allowed",
+	413: "Payload Too Large",
+	503: "Service Unavailable",
+	}
+
+MAX_BODY = 4096
+
+class HTTPServer:
+	"""
+	The HTTP/1.1 part of a server: keep alive connections, a limit on clients
+	and answering self.routes.  Each route is called as
+	route(writer, query, headers, body).
+	"""
+	name = "HTTP server"
+
+	def __init__(self, host="0.0.0.0", port=8080, maxClients=100, idleTimeout=30):
+		"""
+		<optional> host, port => Where to listen
+
+		<optional> maxClients => The most connections at once.  Any more get a 503.
+
+		<optional> idleTimeout => Seconds to wait for a request before closing a connection
+		"""
+		self.LOGGER = logging.getLogger("__main__.webapi.HTTPServer")
+
+		self.host = host
+		self.port = port
+		self.maxClients = maxClients
+		self.idleTimeout = idleTimeout
+
+		self.clients = 0
+		self.requests = 0
+		self.server = None
+		# {(method, path): coroutine function}
+		self.routes = {}
+
+	async def start(self):
+		self.server = await asyncio.start_server(self.handle, self.host, self.port)
+		self.LOGGER.info("{} listening on {}:{}".format(self.name, self.host, self.port))
+
+	async def stop(self):
+		if self.server:
+			self.server.close()
+			await self.server.wait_closed()
+			self.server = None
+
+	async def readRequest(self, reader):
+		"""
+		Returns (method, path, query, headers, body), or None if the client is done
+		"""
+		line = await asyncio.wait_for(reader.readline(), self.idleTimeout)
+		if not line:
+			return None
+		parts = line.decode("latin-1").split()
+		if len(parts) != 3:
+			raise ValueError("Bad request line")
+		method, target, version = parts
+
+		headers = {}
+		while True:
+			line = await asyncio.wait_for(reader.readline(), self.idleTimeout)
+			if line in (b"\r\n", b"\n", b""):
+				break
+			name, _, value = line.decode("latin-1").partition(":")
+			headers[name.strip().lower()] = value.strip()
+		if version == "HTTP/1.0" and headers.get("connection", "").lower() != "keep-alive":
+			headers["connection"] = "close"
+
+		length = int(headers.get("content-length", 0))
+		if length > MAX_BODY:
+			raise OverflowError("Body is too big")
+		body = await asyncio.wait_for(reader.readexactly(length), self.idleTimeout) if length else b""
+
+		url = urlsplit(target)
+		return method.upper(), url.path.rstrip("/") or "/", parse_qs(url.query), headers, body
+
+	async def handle(self, reader, writer):
+		"""
+		Answer requests on one connection until the client closes it
+		"""
+		self.clients += 1
+		try:
+			if self.clients > self.maxClients:
+				await self.respond(writer, 503, {"error": "Too many clients"}, close=True)
+				return
+			while True:
+				try:
+					request = await self.readRequest(reader)
+				except OverflowError as e:
+					await self.respond(writer, 413, {"error": str(e)}, close=True)
+					return
+				except (ValueError, asyncio.IncompleteReadError) as e:
+					await self.respond(writer, 400, {"error": str(e)}, close=True)
+					return
+				if request is None:
+					return
+				self.requests += 1
+				method, path, query, headers, body = request
+				route = self.routes.get((method, path))
+				if route is None:
+					if any(key[1] == path for key in self.routes):
+						await self.respond(writer, 405, {"error": "Method not allowed"})
+					else:
+						await self.respond(writer, 404, {"error": "Not found"})
+				else:
+					await route(writer, query, headers, body)
+				if headers.get("connection", "").lower() == "close":
+					return
+		except (asyncio.TimeoutError, ConnectionError):
+			pass
+		except Exception as e:
+			self.LOGGER.error("Problem answering a request.  {!r}".format(e))
+		finally:
+			self.clients -= 1
+			writer.close()
+
+	async def respond(self, writer, code, body=None, headers=None, close=False, contentType="application/json"):
+		"""
+		Send a whole response
+
+		<optional> body => bytes, or anything json can dump
+		"""
+		if body is None:
+			body = b""
+		elif not isinstance(body, bytes):
+			body = json.dumps(body).encode()
+		lines = ["HTTP/1.1 {} {}".format(code, REASONS[code])]
+		if body or code not in (204, 304):
+			lines.append("Content-Type: {}".format(contentType))
+			lines.append("Content-Length: {}".format(len(body)))
+		for name, value in (headers or {}).items():
+			lines.append("{}: {}".format(name, value))
+		if close:
+			lines.append("Connection: close")
+		writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+		await writer.drain()
+
+class StatusAPI(HTTPServer):
+	"""
+	Serves a cached snapshot of the Thermostat, zones and HVAC
+	"""
+	name = "Web API"
+
+	def __init__(self, scheduler, hvac=None, token=None, host="0.0.0.0", port=8080, maxClients=100, pollTimeout=60, idleTimeout=30, heartbeat=15, clock=time.time, minSetpoint=45, maxSetpoint=90):
+		"""
+		scheduler => The ControlScheduler.  Its zones, and its thermostat's
+			sensors, are what is shown.
+
+		<optional> hvac => The main HVAC, shown when every zone uses a damper
+
+		<optional> token => The password for changing the setpoint.  Changes
+			are turned off if not given.
+
+		<optional> host, port => Where to listen
+
+		<optional> maxClients => The most connections at once.  Any more get a 503.
+
+		<optional> pollTimeout => The longest a long poll can wait, in seconds
+
+		<optional> idleTimeout => Seconds to wait for a request before closing a connection
+
+		<optional> heartbeat => Seconds between keep alive comments on /events
+
+		<optional> clock => Function returning the current time in seconds
+
+		<optional> minSetpoint, maxSetpoint => The lowest and highest setpoint
+			that can be set, in the same units as the setpoint
+		"""
+		super().__init__(host, port, maxClients, idleTimeout)
+		self.LOGGER = logging.getLogger("__main__.webapi.StatusAPI")
+
+		self.scheduler = scheduler
+		self.hvac = hvac
+		self.token = token
+		self.pollTimeout = pollTimeout
+		self.heartbeat = heartbeat
+		self.clock = clock
+		self.minSetpoint = minSetpoint
+		self.maxSetpoint = maxSetpoint
+
+		self.version = 0
+		self.body = b"{}"
+		self.etag = '"0"'
+		self.updated = None
+		self._update = None
+
+		self.routes = {
+			("GET", "/status"): self.getStatus,
+			("GET", "/events"): self.getEvents,
+			("POST", "/setpoint"): self.postSetpoint,
+			}
+
+		scheduler.addListener(lambda scheduler, zones: self.refresh())
+
+	def status(self):
+		"""
+		Returns the status as a dict
+		"""
+		scheduler = self.scheduler
+		zones = {}
+		for name, zone in scheduler.zones.items():
+			temp = scheduler.currentTemp(zone)
+			reading = scheduler.thermostat.getReading(zone.area)
+			zones[name] = {
+				"temp": round(temp, 1) if temp is not None else None,
+				"sensorsUsed": reading.count if reading else 0,
+				"setpoint": zone.settings.setpoint,
+				"state": zone.settings.state,
+				"mode": zone.settings.mode,
+				"hvac": zone.hvac.state,
+				"holdUntil": zone.holdUntil,
+				}
+		sensors = {}
+		for location in scheduler.thermostat.tempSensors:
+			# Stale readings show as null
+			temp = scheduler.thermostat.getTemp(location)
+			if temp is not None and scheduler.convert:
+				temp = scheduler.convert(temp)
+			sensors[location] = round(temp, 1) if temp is not None else None
+		status = {"zones": zones, "sensors": sensors}
+		if scheduler.outdoor is not None:
+			outdoor = scheduler.outdoor
+			low, high = outdoor.highLow()
+			status["outdoor"] = {name: round(scheduler.convert(temp) if scheduler.convert else temp, 1) if temp is not None else None for name, temp in (("temp", outdoor.temp), ("low", low), ("high", high))}
+		if self.hvac is not None:
+			status["hvac"] = self.hvac.state
+		return status
+
+	def refresh(self):
+		"""
+		Make the JSON for the status again.  The version and ETag only change
+		when the status does.
+		"""
+		body = json.dumps(self.status(), sort_keys=True).encode()
+		self.updated = self.clock()
+		if body == self.body:
+			return False
+		self.body = body
+		self.version += 1
+		self.etag = '"{}"'.format(self.version)
+		# Wake up everything waiting for a change
+		if self._update is not None and not self._update.done():
+			self._update.set_result(self.version)
+		self._update = None
+		return True
+
+	async def waitForUpdate(self, timeout):
+		"""
+		Wait until the status changes.  Returns False if timeout ran out first.
+		"""
+		if self._update is None:
+			self._update = asyncio.get_event_loop().create_future()
+		try:
+			await asyncio.wait_for(asyncio.shield(self._update), timeout)
+		except asyncio.TimeoutError:
+			return False
+		return True
+
+	async def start(self):
+		self.refresh()
+		await super().start()
+
+	async def getStatus(self, writer, query, headers, body):
+		etag = headers.get("if-none-match")
+		if etag == self.etag and "wait" in query:
+			try:
+				wait = min(float(query["wait"][0]), self.pollTimeout)
+			except ValueError:
+				await self.respond(writer, 400, {"error": "wait must be a number"})
+				return
+			await self.waitForUpdate(wait)
+		cache = {"ETag": self.etag, "Cache-Control": "no-cache"}
+		if etag == self.etag:
+			await self.respond(writer, 304, headers=cache)
+		else:
+			await self.respond(writer, 200, self.body, cache)
+
+	async def getEvents(self, writer, query, headers, body):
+		writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n")
+		sent = headers.get("last-event-id")
+		while True:
+			if sent != str(self.version):
+				sent = str(self.version)
+				writer.write("id: {}\nevent: status\ndata: ".format(sent).encode() + self.body + b"\n\n")
+			elif not await self.waitForUpdate(self.heartbeat):
+				writer.write(b": keep alive\n\n")
+			# Raises ConnectionError when the client goes away
+			await writer.drain()
+
+	def authorized(self, headers):
+		scheme, _, token = headers.get("authorization", "").partition(" ")
+		return scheme.lower() == "bearer" and hmac.compare_digest(token.strip().encode(), self.token.encode())
+
+	async def postSetpoint(self, writer, query, headers, body):
+		if not self.token:
+			await self.respond(writer, 403, {"error": "Changes are turned off"})
+			return
+		if not self.authorized(headers):
+			await self.respond(writer, 401, {"error": "Not authorized"}, {"WWW-Authenticate": "Bearer"})
+			return
+		try:
+			change = json.loads(body.decode() or "{}")
+			zones = self.scheduler.zones
+			name = str(change.get("zone", next(iter(zones), ""))).upper()
+			setpoint = float(change["setpoint"])
+			if not math.isfinite(setpoint):
+				raise ValueError("The setpoint has to be a number")
+			if setpoint == int(setpoint):
+				setpoint = int(setpoint)
+		except (ValueError, KeyError, TypeError, AttributeError) as e:
+			await self.respond(writer, 400, {"error": "Needs a setpoint.  {}".format(e)})
+			return
+		if not self.minSetpoint <= setpoint <= self.maxSetpoint:
+			await self.respond(writer, 400, {"error": "The setpoint has to be from {} to {}".format(self.minSetpoint, self.maxSetpoint)})
+			return
+		if name not in zones:
+			await self.respond(writer, 404, {"error": "No zone {}".format(name)})
+			return
+		self.LOGGER.info("Setpoint for {} changed to {} from the web".format(name, setpoint))
+		self.scheduler.holdSetpoint(zones[name], setpoint)
+		await self.respond(writer, 200, {"zone": name, "setpoint": setpoint, "holdUntil": zones[name].holdUntil})
@@ -0,0 +1,225 @@
+"""
+Processes that follow the control process through the shared ring, so a
+slow MQTT broker or SD card can't hold up the sensor reads and the relays.
+
+The control process keeps the serial boards, the control decisions and the
+relays, because the relays are pulsed through the same serial port as the
+sensors are read.  It writes every reading and state change to a
+sharedring.SharedRing.  Each worker here runs in its own process, reads the
+ring and does the slow part:
+
+	publishWorker		<- Publishes the readings to MQTT
+	historyWorker		<- Writes the readings and state changes to the HistoryLog
+
+ProcessSupervisor starts the workers and starts them again if one dies.
+The processes are forked, so this only works on Linux like the Raspberry Pi.
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+import asyncio
+import multiprocessing
+import signal
+import time
+
+from historylog import SAMPLE, TRANSITION
+from sharedring import RingReader
+
+LOGGER = logging.getLogger("__main__.workers.py")
+
+class _Stop:
+	"""
+	Set by SIGTERM so a worker can finish what it is doing and clean up
+	"""
+	def __init__(self):
+		self.stopping = False
+		# The control process handles Ctrl-C and stops the workers itself
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+		signal.signal(signal.SIGTERM, self.stop)
+		# Forked from the asyncio loop, which was using this for its own signals
+		signal.set_wakeup_fd(-1)
+
+	def stop(self, signum, frame):
+		self.stopping = True
+
+def follow(reader, handle, stop, interval):
+	"""
+	Hand each batch of new records to handle until stop is set
+	"""
+	while not stop.stopping:
+		records = reader.read()
+		if records:
+			try:
+				handle(records)
+			except Exception as e:
+				LOGGER.error("Could not handle {} records.  {!r}".format(len(records), e))
+		else:
+			time.sleep(interval)
+
+def publishWorker(ringName, mqtt, interval=0.5):
+	"""
+	Publish every reading in the ring to MQTT
+
+	ringName => The name of the SharedRing
+
+	mqtt => The MQTT settings
+
+	<optional> interval => Seconds to wait when there is nothing new
+	"""
+	stop = _Stop()
+	from publisher import MQTTPublisher, MQTT_ENABLED
+	if not MQTT_ENABLED:
+		return
+	publisher = MQTTPublisher(mqtt["HOSTNAME"], mqtt["PORT"], mqtt["USERNAME"], mqtt["PASSWORD"], mqtt["BASE_TOPIC"], mqtt["QOS"], mqtt["RETAIN"], mqtt["QUEUE_SIZE"], mqtt["TLS"])
+	reader = RingReader(ringName)
+	publisher.start()
+
+	def publish(records):
+		readings = {}
+		for record in records:
+			if record.kind == SAMPLE and record.value is not None:
+				readings[record.name.lower()] = round(record.value)
+		if readings:
+			publisher.publish(readings)
+
+	try:
+		follow(reader, publish, stop, interval)
+	finally:
+		publisher.stop()
+		reader.close()
+
+def historyWorker(ringName, directory, rawDays, minuteDays, interval=0.5, position=None):
+	"""
+	Write every reading and state change in the ring to the history
+
+	ringName => The name of the SharedRing
+
+	directory => The history directory
+
+	rawDays, minuteDays => Days of raw and 1 minute records to keep
+
+	<optional> interval => Seconds to wait when there is nothing new
+
+	<optional> position => A multiprocessing.Value("Q") from the control
+		process with the sequence of the last record written.  A worker that
+		is started again goes on after it instead of writing the ring again.
+	"""
+	stop = _Stop()
+	from historylog import HistoryLog
+	history = HistoryLog(directory)
+	history.prune(time.time() - rawDays * 86400, time.time() - minuteDays * 86400)
+	if position is not None and position.value:
+		reader = RingReader(ringName, after=position.value)
+	else:
+		# Pick up what was written while this worker was starting
+		reader = RingReader(ringName, fromStart=True)
+
+	def write(records):
+		for record in records:
+			if record.kind == SAMPLE:
+				history.addSample(record.name, record.value, record.timestamp)
+			elif record.kind == TRANSITION:
+				history.addTransition(record.name, record.value, record.timestamp)
+		history.flush()
+		if position is not None:
+			position.value = records[-1].sequence
+
+	try:
+		follow(reader, write, stop, interval)
+	finally:
+		history.close()
+		reader.close()
+
+class ProcessSupervisor:
+	"""
+	Starts the worker processes and keeps them running
+	"""
+	def __init__(self, checkInterval=5.0, restartDelay=5.0, maxRestartDelay=300.0):
+		"""
+		<optional> checkInterval => Seconds between checks that each worker is alive
+
+		<optional> restartDelay, maxRestartDelay => Seconds to wait before
+			starting a worker that died.  The wait doubles every time it dies
+			again soon after starting, up to maxRestartDelay.
+		"""
+		self.LOGGER = logging.getLogger("__main__.workers.ProcessSupervisor")
+
+		self.context = multiprocessing.get_context("fork")
+		self.checkInterval = checkInterval
+		self.restartDelay = restartDelay
+		self.maxRestartDelay = maxRestartDelay
+
+		# {name: (target, args)}
+		self.workers = {}
+		self.processes = {}
+		# {name: [time started, seconds to wait before starting it again]}
+		self.started = {}
+		# {name: time to start it again} for the workers that died
+		self.waiting = {}
+		self.restarts = {}
+
+	def add(self, name, target, *args):
+		"""
+		name => What to call the worker in the log
+
+		target => The function the process runs, like publishWorker
+		"""
+		self.workers[name] = (target, args)
+		self.restarts[name] = 0
+
+	def start(self, name):
+		target, args = self.workers[name]
+		process = self.context.Process(target=target, args=args, name="thermostat-" + name.lower(), daemon=True)
+		process.start()
+		self.processes[name] = process
+		delay = self.started.get(name, [None, self.restartDelay])[1]
+		self.started[name] = [time.monotonic(), delay]
+		self.LOGGER.info("Started worker {} as pid {}".format(name, process.pid))
+
+	def startAll(self):
+		for name in self.workers:
+			self.start(name)
+
+	async def run(self):
+		"""
+		Start a worker again when it dies.  Runs until cancelled.
+		"""
+		if not self.processes:
+			self.startAll()
+		while True:
+			await asyncio.sleep(self.checkInterval)
+			now = time.monotonic()
+			for name, process in list(self.processes.items()):
+				if process.is_alive():
+					continue
+				if name not in self.waiting:
+					started, delay = self.started[name]
+					self.LOGGER.error("Worker {} stopped with exit code {}".format(name, process.exitcode))
+					if now - started > self.maxRestartDelay:
+						# It ran for a good while, so this isn't a crash loop
+						delay = self.restartDelay
+					self.started[name][1] = min(delay * 2, self.maxRestartDelay)
+					self.waiting[name] = now + delay
+				elif now >= self.waiting[name]:
+					del self.waiting[name]
+					self.restarts[name] += 1
+					self.start(name)
+
+	def stop(self, timeout=5.0):
+		"""
+		Ask every worker to finish, and kill the ones that don't
+		"""
+		for process in self.processes.values():
+			if process.is_alive():
+				process.terminate()
+		deadline = time.monotonic() + timeout
+		for name, process in self.processes.items():
+			process.join(max(0, deadline - time.monotonic()))
+			if process.is_alive():
+				self.LOGGER.warning("Worker {} didn't stop, killing it".format(name))
+				process.kill()
+				process.join()
+		self.processes = {}
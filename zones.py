@@ -0,0 +1,170 @@
+"""
+Zones of the house that are controlled on their own.
+
+Each Zone has its own sensor group, program, state / mode / setpoint and an
+output.  The output is either its own HVAC, or a Damper on a SharedUnit when
+one furnace and A/C feeds more than one zone.  Every zone is run by the same
+ControlScheduler in one event loop.
+
+The ZONES setting looks like:
+	"UPSTAIRS": {
+		"GROUP": "UPSTAIRS",
+		"STATE": "HEAT",
+		"CONTROL_PINS": {...}		<- its own HVAC, the same as HVAC.CONTROL_PINS
+		or
+		"DAMPER_PIN": 8				<- a damper on the main HVAC
+		"BOARD": "MAIN",
+		"TEMP_SETTINGS": {...}		<- optional, the main program is used if not given
+		"CONTROL": {...}			<- optional, the main CONTROL is used if not given
+		}
+"""
+
+__author__ = "builderjer"
+__version__ = "0.1.0"
+
+# Builtins
+import logging
+import time
+
+from thermostat import ControlSettings
+from controllers import HysteresisController
+from schedule import SEASONS
+
+LOGGER = logging.getLogger("__main__.zones.py")
+
+class Zone:
+	"""
+	One area of the house with its own sensors, program and output
+	"""
+	def __init__(self, name, area, hvac, actuate, schedules=None, settings=None, controller=None):
+		"""
+		name => Name of the zone
+
+		area => The sensor or group used for the zone's temp
+
+		hvac => The HVAC, RelayQueue or Damper.  Only its state is read here.
+
+		actuate => Coroutine function called as actuate(heatCool, onOff)
+
+		<optional> schedules => {season: schedule.Schedule} for the zone
+
+		<optional> settings => The ControlSettings (state, mode, setpoint) for the
+			zone.  The main zone uses the Thermostat itself.  New ones are made
+			if not given.
+
+		<optional> controller => The controllers.Controller that decides when to
+			run the HVAC.  A HysteresisController if not given.
+		"""
+		self.LOGGER = logging.getLogger("__main__.zones.Zone")
+
+		self.name = name.upper()
+		self.area = area.upper()
+		self.hvac = hvac
+		self.actuate = actuate
+		self.schedules = schedules or {}
+		self.settings = settings or ControlSettings(self.name)
+		self.controller = controller or HysteresisController()
+		# A setpoint set by hand is kept until this time instead of the program
+		self.holdUntil = None
+		# The season of the program in use, set by the ControlScheduler
+		self.season = None
+
+		self.ticks = 0
+
+	def decide(self, temp, now=None):
+		"""
+		Figure out what should change.
+
+		<optional> now => Time in seconds, time.time() if not given
+
+		Returns a list of (heatCool, onOff) commands.  An empty list means
+		leave everything alone.
+		"""
+		if self.settings.mode == "MANUAL":
+			return []
+		return self.controller.decide(temp, self.settings.setpoint, self.settings.state, self.hvac.state, time.time() if now is None else now, self.prefer)
+
+	@property
+	def prefer(self):
+		"""
+		The state that goes with the program in use, so AUTO knows which way to favour
+		"""
+		return {season: state for state, season in SEASONS.items()}.get(self.season)
+
+	def thresholds(self):
+		"""
+		Returns the temps where the controller turns the HVAC on or off
+		"""
+		if self.settings.mode == "MANUAL":
+			return []
+		return self.controller.thresholds(self.settings.setpoint, self.settings.state, self.prefer)
+
+class SharedUnit:
+	"""
+	One furnace and A/C that feeds several zones through dampers.  The unit
+	runs while any damper is calling for it.
+	"""
+	def __init__(self, hvac, actuate):
+		"""
+		hvac => The HVAC for the unit
+
+		actuate => Coroutine function that turns the unit on and off, called as
+			actuate(heatCool, onOff)
+		"""
+		self.LOGGER = logging.getLogger("__main__.zones.SharedUnit")
+
+		self.hvac = hvac
+		self.actuate = actuate
+		self.dampers = []
+
+	def addDamper(self, damper):
+		self.dampers.append(damper)
+
+	async def demandChanged(self, heatCool):
+		"""
+		Turn the unit on or off to match what the dampers are calling for
+		"""
+		calling = [damper for damper in self.dampers if damper.state == heatCool.upper()]
+		if calling and self.hvac.state == "OFF":
+			await self.actuate(heatCool, "on")
+		elif not calling and self.hvac.state == heatCool.upper():
+			await self.actuate(heatCool, "off")
+
+class Damper:
+	"""
+	A damper that lets a SharedUnit heat or cool one zone.  It has the same
+	state and turnOnOff as an HVAC so a Zone can use it the same way.
+	"""
+	def __init__(self, unit, pin):
+		"""
+		unit => The SharedUnit the damper is on
+
+		pin => The digital pin that opens the damper when high
+		"""
+		self.LOGGER = logging.getLogger("__main__.zones.Damper")
+
+		self.unit = unit
+		self.pin = pin
+		self.state = "OFF"
+		unit.addDamper(self)
+
+	async def turnOnOff(self, core, heatCool, onOff):
+		"""
+		Open or close the damper and let the unit know
+
+		core => The asyncio board interface the damper is on
+		"""
+		heatCool = heatCool.upper()
+		if onOff.upper() == "ON":
+			# The unit can't heat one zone and cool another at the same time
+			if self.unit.hvac.state not in ("OFF", heatCool):
+				raise AttributeError("The HVAC is already set to {}".format(self.unit.hvac.state))
+			await core.digital_write(self.pin, 1)
+			self.state = heatCool
+		elif onOff.upper() == "OFF":
+			await core.digital_write(self.pin, 0)
+			self.state = "OFF"
+		else:
+			raise AttributeError("Only 'on' or 'off' are valid attributes")
+		self.LOGGER.info("Damper on pin {} set to {}".format(self.pin, self.state))
+		await self.unit.demandChanged(heatCool)